@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""EPG 受信 (recpt1 の出力) を番組表が揃った時点で打ち切る (epg-scan.sh から実行)
+
+Usage:
+  recpt1 --b25 CH SEC - | python3 epg-capture.py [--multiplex] <ch> <秒数> <out.ts> <state.json>
+      EIT の番組表が揃うか、前回から version が変わっていなければ読むのをやめる
+      終了コード: 0 = 受信した (取り込む), 3 = 変わっていない, 1 = 何も受信できなかった
+  python3 epg-capture.py --record <state.json>
+      取り込みに成功した受信を epg_scan に記録する (揃っていれば version も)
+"""
+
+import json
+import os
+import sys
+import time
+
+AUTOREC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(AUTOREC_DIR, 'web'))
+
+import eit_scan  # noqa: E402
+
+EXIT_UNCHANGED = 3
+
+
+def usage():
+    print(f'Usage: {sys.argv[0]} [--multiplex] <channel> <seconds> <out.ts> <state.json>\n'
+          f'       {sys.argv[0]} --record <state.json>', file=sys.stderr)
+    sys.exit(1)
+
+
+def record(state_path):
+    with open(state_path) as f:
+        state = json.load(f)
+    eit_scan.record(state['channel'], state['multiplex'], state['result'],
+                    state['seconds'], state['bytes'], state['versions'])
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) == 2 and args[0] == '--record':
+        record(args[1])
+        return
+    multiplex = bool(args) and args[0] == '--multiplex'
+    if multiplex:
+        args = args[1:]
+    if len(args) != 4:
+        usage()
+    channel, seconds, out_path, state_path = args
+    try:
+        limit = int(seconds)
+    except ValueError:
+        usage()
+
+    previous = eit_scan.previous_versions(channel, multiplex)
+    started = time.monotonic()
+    with open(out_path, 'wb') as dst:
+        result, tracker, size = eit_scan.capture(
+            sys.stdin.buffer, dst, limit, previous, other=multiplex)
+    elapsed = time.monotonic() - started
+    print(f'[epg-capture] ch={channel} {result} {elapsed:.1f}秒 '
+          f'(サブテーブル {len(tracker.subtables)} 件, {size / 1048576:.1f}MB)')
+    if size == 0:
+        sys.exit(1)
+    if result == eit_scan.RESULT_UNCHANGED:
+        eit_scan.record(channel, multiplex, result, elapsed, size)
+        sys.exit(EXIT_UNCHANGED)
+    with open(state_path, 'w') as f:
+        json.dump({
+            'channel': channel, 'multiplex': multiplex, 'result': result,
+            'seconds': elapsed, 'bytes': size,
+            'versions': tracker.versions() if result == eit_scan.RESULT_COMPLETE else None,
+        }, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""録画中の TS ファイルから番組表 (EIT) を拾って programme に反映する (record.sh から実行)
+
+Usage:
+  python3 epg-harvest.py <チャンネル名> <file.ts>          SIGTERM まで追記を追いかける
+  python3 epg-harvest.py --once <チャンネル名> <file.ts>   最後まで読んで終わる (録画済みのファイル)
+"""
+
+import os
+import signal
+import sys
+import threading
+import time
+
+AUTOREC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(AUTOREC_DIR, 'web'))
+
+import eit_harvest  # noqa: E402
+
+FILE_WAIT_SECONDS = 30  # recpt1 が録画ファイルを作るまで待つ上限
+
+
+def main():
+    args = sys.argv[1:]
+    once = bool(args) and args[0] == '--once'
+    if once:
+        args = args[1:]
+    if len(args) != 2:
+        print(f'Usage: {sys.argv[0]} [--once] <channel_name> <file.ts>', file=sys.stderr)
+        sys.exit(1)
+    channel_name, path = args
+
+    stop_event = threading.Event()
+    if once:
+        stop_event.set()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop_event.set())
+
+    deadline = time.monotonic() + FILE_WAIT_SECONDS
+    while not os.path.exists(path):
+        if stop_event.is_set() or time.monotonic() > deadline:
+            print(f'[epg-harvest] ファイルがありません: {path}', file=sys.stderr)
+            sys.exit(1)
+        time.sleep(1)
+
+    total = eit_harvest.follow_file(path, channel_name, stop_event)
+    print(f'[epg-harvest] {channel_name}: 追加 {total["inserted"]} 件, 時刻更新 {total["updated"]} 件')
+
+
+if __name__ == '__main__':
+    main()
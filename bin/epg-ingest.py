@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""epgdump の出力を番組表 DB に取り込む (epg-scan.sh から実行)
+
+Usage:
+  python3 epg-ingest.py <チャンネル名> <epg.json | epg.xml>
+  python3 epg-ingest.py --services <epg.json | epg.xml>
+      BS/CS の全サービス分をサービス名で channels.conf のチャンネルに振り分ける
+
+拡張子が .xml なら XMLTV、それ以外は JSON として読む。
+"""
+
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+AUTOREC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(AUTOREC_DIR, 'web'))
+
+import api  # noqa: E402
+import epg_ingest  # noqa: E402
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(f'Usage: {sys.argv[0]} <channel_name>|--services <epg.json|epg.xml>', file=sys.stderr)
+        sys.exit(1)
+    channel_name, path = sys.argv[1], sys.argv[2]
+    services = None
+    if channel_name == '--services':
+        channel_name = None
+        services = epg_ingest.service_map(api._get_valid_channels())
+    if path.endswith('.xml'):
+        programmes = epg_ingest.parse_xml(path, channel_name, services)
+    else:
+        programmes = epg_ingest.parse_json(path, channel_name, services)
+    try:
+        stats = epg_ingest.ingest(programmes)
+    except (OSError, ValueError, ET.ParseError) as e:
+        print(f'[epg-ingest] エラー: {path}: {e}', file=sys.stderr)
+        sys.exit(1)
+    total = stats['inserted'] + stats['updated'] + stats['unchanged']
+    print(f'[epg-ingest] {total} 番組 (新規 {stats["inserted"]}, 更新 {stats["updated"]}, '
+          f'変更なし {stats["unchanged"]})')
+    if total == 0:
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""全チャンネルの EPG をチューナー数まで並行して受信する (epg-update.sh から実行)
+
+Usage:
+  python3 epg-update.py [秒数]   地上波 1 チャンネルあたりの受信秒数 (既定 30)
+
+BS/CS は帯域ごとに 1 チャンネルだけ EPG_SAT_SCAN_SECONDS 秒受信し、全サービス分を登録する。
+"""
+
+import os
+import sys
+import time
+
+AUTOREC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(AUTOREC_DIR, 'web'))
+
+import epg_update  # noqa: E402
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) > 1:
+        print(f'Usage: {sys.argv[0]} [seconds]', file=sys.stderr)
+        sys.exit(1)
+    try:
+        seconds = int(args[0]) if args else 30
+    except ValueError:
+        print(f'Usage: {sys.argv[0]} [seconds]', file=sys.stderr)
+        sys.exit(1)
+    started = time.monotonic()
+    result = epg_update.run(seconds)
+    elapsed = time.monotonic() - started
+    print(f'[epg-update] 成功: {len(result["success"])} 失敗: {len(result["failed"])} '
+          f'見送り: {len(result["skipped"])} ({elapsed:.0f}秒)')
+    if result["failed"] and not result["success"]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 #!/bin/bash
 # epg-update.sh - EPG一括更新
-# 全チャンネルのEPGデータを取得してDBに格納
+# 全チャンネルのEPGデータを取得してDBに格納 (並行受信は bin/epg-update.py)
 #
 # Usage: epg-update.sh [スキャン秒数]
 set -euo pipefail
@@ -14,49 +14,19 @@ CHANNELS_CONF="$AUTOREC_DIR/conf/channels.conf"
 echo "[epg-update] === EPG一括更新開始 ==="
 echo "[epg-update] 日時: $(date '+%Y-%m-%d %H:%M:%S')"
 
-# 録画中チェック: recpt1 プロセスが動いていたら中断
-if pgrep -x recpt1 >/dev/null 2>&1; then
-    echo "[epg-update] 警告: recpt1 が実行中のため、EPG更新をスキップします" >&2
-    exit 0
-fi
-
 # チャンネル一覧読み込み
 if [ ! -f "$CHANNELS_CONF" ]; then
     echo "[epg-update] エラー: $CHANNELS_CONF が見つかりません" >&2
     exit 1
 fi
 
-SUCCESS=0
-FAIL=0
-TOTAL=0
-
-while IFS= read -r line; do
-    # コメント・空行スキップ
-    line="$(echo "$line" | sed 's/#.*//' | xargs)"
-    [ -z "$line" ] && continue
-
-    CH_NUM="$(echo "$line" | awk '{print $1}')"
-    CH_NAME="$(echo "$line" | awk '{for(i=2;i<=NF;i++) printf "%s%s", (i>2?" ":""), $i; print ""}')"
-    TOTAL=$((TOTAL + 1))
-
-    echo ""
-    echo "[epg-update] --- $CH_NAME (ch=$CH_NUM) ---"
-
-    if "$AUTOREC_DIR/bin/epg-scan.sh" "$CH_NUM" "$SCAN_DURATION"; then
-        SUCCESS=$((SUCCESS + 1))
-    else
-        echo "[epg-update] 失敗: ch=$CH_NUM ($CH_NAME)" >&2
-        FAIL=$((FAIL + 1))
-    fi
-
-    # チューナー解放のため少し待つ
-    sleep 2
-done < "$CHANNELS_CONF"
+# チューナー数 (TUNERS_GR / TUNERS_SAT) まで並行して受信する。
+# 録画中・ライブ視聴中のチューナーと、受信中に始まる録画予定の分は空けておく
+python3 "$AUTOREC_DIR/bin/epg-update.py" "$SCAN_DURATION" || {
+    echo "[epg-update] 警告: EPG 受信に失敗しました" >&2
+}
 
-echo ""
 echo "[epg-update] === EPG更新完了 ==="
-echo "[epg-update] 成功: $SUCCESS / $TOTAL チャンネル"
-[ "$FAIL" -gt 0 ] && echo "[epg-update] 失敗: $FAIL チャンネル"
 echo "[epg-update] 日時: $(date '+%Y-%m-%d %H:%M:%S')"
 
 # スケジュール更新を実行
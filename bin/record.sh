@@ -12,6 +12,8 @@ AUTOREC_DB="${AUTOREC_DB:-$AUTOREC_DIR/db/autorec.sqlite}"
 RECORD_DIR="${RECORD_DIR:-/mnt/data}"
 START_OFFSET="${START_OFFSET:-1}"
 END_OFFSET="${END_OFFSET:-0}"
+RECORD_PREWARM_SECONDS="${RECORD_PREWARM_SECONDS:-3}"
+TRANSCODE_CONCURRENCY="${TRANSCODE_CONCURRENCY:-1}"
 
 SCHEDULE_ID="$1"
 
@@ -54,21 +56,37 @@ END_EPOCH=$(date -d "$END_TIME" '+%s' 2>/dev/null) || \
     END_EPOCH=$(python3 -c "from datetime import datetime; print(int(datetime.fromisoformat('$END_TIME').timestamp()))")
 NOW_EPOCH=$(date '+%s')
 
-# 開始まで待機 (オフセット考慮)
-RECORD_START=$((START_EPOCH - START_OFFSET))
-if [ "$NOW_EPOCH" -lt "$RECORD_START" ]; then
-    WAIT=$((RECORD_START - NOW_EPOCH))
+# recpt1 の起動時刻 (オフセット + 選局の時間を見込んで早めに起動する)
+RECORD_START=$((START_EPOCH - START_OFFSET - RECORD_PREWARM_SECONDS))
+PREPARE_SECONDS=10
+if [ "$NOW_EPOCH" -lt "$((RECORD_START - PREPARE_SECONDS))" ]; then
+    # 早く起動された場合 (手動実行など) は準備の分を残して待機
+    WAIT=$((RECORD_START - PREPARE_SECONDS - NOW_EPOCH))
     log_msg "info" "録画開始まで ${WAIT}秒 待機: $TITLE"
     sleep "$WAIT"
 fi
 
-# 録画時間 = 番組時間 + 前後オフセット
-DURATION=$((END_EPOCH - START_EPOCH + START_OFFSET + END_OFFSET))
+# 録画時間 = 番組時間 + 前後オフセット + 選局分
+DURATION=$((END_EPOCH - START_EPOCH + START_OFFSET + END_OFFSET + RECORD_PREWARM_SECONDS))
+ACTUAL_END=$((END_EPOCH + END_OFFSET))
+
+# RECORD_START まで秒未満の精度で待つ (準備を済ませてから recpt1 の起動直前に呼ぶ)
+wait_record_start() {
+    local now_ns wait_ns
+    now_ns=$(date '+%s%N')
+    wait_ns=$((RECORD_START * 1000000000 - now_ns))
+    if [ "$wait_ns" -gt 0 ]; then
+        sleep "$((wait_ns / 1000000000)).$(printf '%09d' $((wait_ns % 1000000000)))"
+    fi
+    # 既に起動時刻を過ぎている場合は終了時刻から計算し直す
+    NOW_EPOCH=$(date '+%s')
+    if [ "$NOW_EPOCH" -gt "$RECORD_START" ]; then
+        DURATION=$((ACTUAL_END - NOW_EPOCH))
+    fi
+}
 
-# 現在時刻から計算し直す (既に開始時刻を過ぎている場合)
 NOW_EPOCH=$(date '+%s')
-ACTUAL_END=$((END_EPOCH + END_OFFSET))
-if [ "$NOW_EPOCH" -gt "$START_EPOCH" ]; then
+if [ "$NOW_EPOCH" -gt "$RECORD_START" ]; then
     DURATION=$((ACTUAL_END - NOW_EPOCH))
 fi
 
@@ -126,8 +144,24 @@ if [ -f "$JIKKYO_MAP_FILE" ]; then
     fi
 fi
 
+# 録画中のファイルから番組表 (EIT) を拾う (EPG 受信用のチューナーを使わずに番組表を更新)
+HARVEST_PID=""
+python3 "$AUTOREC_DIR/bin/epg-harvest.py" "$CHANNEL" "$OUTPUT_FILE" 2>&1 &
+HARVEST_PID=$!
+
+# 番組表取り込みを停止 (SIGTERM で残りを読んでから終わる)
+stop_harvest() {
+    if [ -n "$HARVEST_PID" ]; then
+        kill "$HARVEST_PID" 2>/dev/null || true
+        wait "$HARVEST_PID" 2>/dev/null || true
+        HARVEST_PID=""
+    fi
+}
+
 # recpt1 で録画実行
+wait_record_start
 if recpt1 --b25 "$CH_NUM" "$DURATION" "$OUTPUT_FILE" 2>&1; then
+    stop_harvest
     # 成功
     FILE_SIZE=$(stat -c%s "$OUTPUT_FILE" 2>/dev/null || echo "0")
     FILE_SIZE_MB=$((FILE_SIZE / 1024 / 1024))
@@ -146,9 +180,25 @@ if recpt1 --b25 "$CH_NUM" "$DURATION" "$OUTPUT_FILE" 2>&1; then
         fi
     fi
 
+    # 録画一覧の索引に登録し (Web UI の差分照合でも拾われるが、完了直後から一覧に出す)、
+    # 再生時間・開始時刻とシーク索引を計算しておく (再生・シーク時にファイルを読まずに済む)
+    python3 "$AUTOREC_DIR/bin/recording-meta.py" "$OUTPUT_FILE" >/dev/null 2>&1 || true
+
+    # 録画後トランスコードを登録してワーカーを起動 (失敗しても録画結果に影響しない)
+    if [ "$TRANSCODE_CONCURRENCY" -gt 0 ] 2>/dev/null; then
+        if python3 "$AUTOREC_DIR/bin/transcode-worker.py" --enqueue "$OUTPUT_FILE" >/dev/null 2>&1; then
+            mkdir -p "$AUTOREC_DIR/log"
+            nohup python3 "$AUTOREC_DIR/bin/transcode-worker.py" \
+                >> "$AUTOREC_DIR/log/transcode.log" 2>&1 < /dev/null &
+        else
+            log_msg "warn" "トランスコード登録失敗: $OUTPUT_FILE"
+        fi
+    fi
+
     # 通知
     "$AUTOREC_DIR/bin/notify.sh" "録画完了" "$TITLE ($CHANNEL) - ${FILE_SIZE_MB}MB" || true
 else
+    stop_harvest
     # 失敗 — 実況コメントも停止
     if [ -n "$JIKKYO_PID" ]; then
         kill "$JIKKYO_PID" 2>/dev/null || true
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""録画スケジューラ (常駐)。録画予定の開始に合わせて record.sh を起動する
+
+Usage:
+  python3 recorder.py              常駐 (cron.txt の @reboot で起動)
+  python3 recorder.py --watchdog   常駐していなければ常駐する (していれば何もせず終了。
+                                   cron.txt で毎分実行し、異常終了しても録画を取りこぼさない)
+  python3 recorder.py --notify     録画予定の変更を常駐中のスケジューラに知らせる
+                                   (常駐していなければ終了コード 1)
+"""
+
+import os
+import sys
+
+AUTOREC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(AUTOREC_DIR, 'web'))
+
+import api  # noqa: E402
+import recorder  # noqa: E402
+
+
+def main():
+    args = sys.argv[1:]
+    if args == ['--notify']:
+        sys.exit(0 if api.notify_recorder() else 1)
+    if args == ['--watchdog']:
+        recorder.Recorder().serve()
+        return
+    if args:
+        print(f'Usage: {sys.argv[0]} [--notify | --watchdog]', file=sys.stderr)
+        sys.exit(1)
+    if not recorder.Recorder().serve():
+        print('[recorder] 既に起動しています', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
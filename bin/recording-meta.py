@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""録画ファイルのメタデータ (再生時間・録画開始時刻) とシーク索引を事前計算してキャッシュする
+
+Usage:
+  python3 recording-meta.py FILE...   指定ファイルを録画一覧の索引に登録して計算
+                                      (record.sh が録画完了時に実行)
+  python3 recording-meta.py --all     キャッシュ・索引のない録画をすべて計算
+"""
+
+import os
+import sys
+
+AUTOREC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(AUTOREC_DIR, 'web'))
+
+import api  # noqa: E402
+import tsindex  # noqa: E402
+
+
+def main():
+    args = sys.argv[1:]
+    if not args:
+        print(f'Usage: {sys.argv[0]} <file>... | --all', file=sys.stderr)
+        sys.exit(1)
+
+    if args == ['--all']:
+        api._reconcile_recordings(force=True)
+        conn = api._get_db(api.AUTOREC_DB)
+        rows = conn.execute(
+            "SELECT r.path, m.path IS NULL AS missing FROM recording r LEFT JOIN recording_meta m "
+            "ON r.path = m.path AND r.size = m.size AND r.mtime = m.mtime "
+            "ORDER BY r.mtime DESC"
+        ).fetchall()
+        files = []
+        for row in rows:
+            file_path = os.path.join(api.RECORD_DIR, row['path'])
+            if row['missing'] or tsindex.load_seek_index(file_path) is None:
+                files.append(file_path)
+    else:
+        files = [os.path.abspath(path) for path in args]
+
+    failed = 0
+    for file_path in files:
+        file_path = os.path.realpath(file_path)
+        if args != ['--all']:
+            # 索引の mtime は recording_meta と同じ (st_mtime の) 値で書く
+            api.update_recording(file_path)
+        try:
+            # 索引を先に作る (ffprobe にフォールバックしたときの TDT 補正に使う)
+            index = tsindex.load_seek_index(file_path) or tsindex.build_seek_index(file_path)
+            meta = api.get_recording_meta(file_path)
+        except Exception as e:
+            print(f'[meta] 失敗: {file_path}: {e}', file=sys.stderr)
+            failed += 1
+            continue
+        points = len(index) if index is not None else 0
+        print(f'[meta] {file_path}: {meta["duration"]:.1f}秒 (シーク索引 {points} 点)')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""録画ルールと番組表を照合して録画予定を追加する (schedule-update.sh から実行)
+
+Usage:
+  python3 schedule-match.py [NOW]   NOW ("YYYY-MM-DD HH:MM:SS") より後の番組が対象
+
+前回から変わっていないルールは前回以降に更新された番組だけと照合し、
+新規・編集されたルールだけ未来の番組すべてと照合する。
+照合のあと、チューナー数を超えて重なる録画予定を優先度で conflict に振り分ける。
+"""
+
+import os
+import sys
+import time
+
+AUTOREC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(AUTOREC_DIR, 'web'))
+
+import schedule_conflict  # noqa: E402
+import schedule_match  # noqa: E402
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) > 1:
+        print(f'Usage: {sys.argv[0]} [NOW]', file=sys.stderr)
+        sys.exit(1)
+    started = time.monotonic()
+    stats = schedule_match.run(args[0] if args else None)
+    elapsed = time.monotonic() - started
+    print(f'[schedule] 照合: 新規・変更ルール {stats["full_rules"]} 件 × 番組 {stats["full_examined"]} 件, '
+          f'既存ルール {stats["delta_rules"]} 件 × 更新番組 {stats["delta_examined"]} 件 '
+          f'→ {stats["added"]} 件追加 ({elapsed:.2f}秒)')
+    started = time.monotonic()
+    resolved = schedule_conflict.resolve(args[0] if args else None)
+    elapsed = time.monotonic() - started
+    print(f'[schedule] 重複解決: 録画 {resolved["scheduled"]} 件, 重複 {resolved["conflict"]} 件 '
+          f'(変更 {resolved["changed"]} 件, {elapsed:.2f}秒)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""録画後トランスコードワーカー
+
+Usage:
+  python3 transcode-worker.py                 キューが空になるまで変換
+  python3 transcode-worker.py --enqueue FILE  録画ファイルをキューに登録 (複数可)
+  python3 transcode-worker.py --scan          未変換の録画をすべてキューに登録
+
+同時実行数・nice 値・x264 設定は autorec.conf の TRANSCODE_* で指定する。
+"""
+
+import os
+import sys
+
+AUTOREC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(AUTOREC_DIR, 'web'))
+
+import api  # noqa: E402
+import transcode_queue  # noqa: E402
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == '--enqueue':
+        if len(args) < 2:
+            print(f'Usage: {sys.argv[0]} --enqueue <file>...', file=sys.stderr)
+            sys.exit(1)
+        for path in args[1:]:
+            try:
+                rel_path = transcode_queue.enqueue(os.path.abspath(path))
+            except ValueError as e:
+                print(f'[transcode] {e}', file=sys.stderr)
+                sys.exit(1)
+            print(f'[transcode] 登録: {rel_path}')
+        return
+    if args and args[0] == '--scan':
+        count = transcode_queue.enqueue_missing()
+        print(f'[transcode] {count} 件登録')
+        return
+    if args:
+        print(f'Usage: {sys.argv[0]} [--enqueue <file>... | --scan]', file=sys.stderr)
+        sys.exit(1)
+
+    if api.TRANSCODE_CONCURRENCY <= 0:
+        print('[transcode] TRANSCODE_CONCURRENCY=0 のため無効')
+        return
+    transcode_queue.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""MPEG-TS パケット走査のベンチマーク (1 パケットずつ回すループ vs tsindex.iter_packets)
+
+Usage:
+  python3 tsscan-bench.py FILE [MB]   先頭 MB (既定 10) を読んで比較する
+
+比較する処理:
+  tdt  … 最初の TDT/TOT を探す (以前の api._extract_ts_start_time と同じループ)
+  pid  … 指定 PID (PCR を持つ PID) のパケットをすべて列挙
+  pcr  … PCR を持つパケットをすべて列挙
+"""
+
+import os
+import sys
+import time
+
+AUTOREC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(AUTOREC_DIR, 'web'))
+
+import tsindex  # noqa: E402
+
+TS_PACKET_SIZE = tsindex.TS_PACKET_SIZE
+REPEAT = 5
+
+
+def legacy_tdt(buf):
+    """以前の実装: sync を探して 1 パケットずつ PID を調べる"""
+    start = tsindex.find_sync(buf)
+    if start < 0:
+        return None
+    pos = start
+    buf_len = len(buf)
+    while pos + TS_PACKET_SIZE <= buf_len:
+        if buf[pos] != 0x47:
+            pos += 1
+            continue
+        pid = ((buf[pos + 1] & 0x1F) << 8) | buf[pos + 2]
+        if pid != tsindex.TDT_PID:
+            pos += TS_PACKET_SIZE
+            continue
+        epoch = tsindex.packet_tdt(buf, pos)
+        if epoch is not None:
+            return epoch, pos - start
+        pos += TS_PACKET_SIZE
+    return None
+
+
+def legacy_pid(buf, target):
+    result = []
+    pos = tsindex.find_sync(buf)
+    while 0 <= pos and pos + TS_PACKET_SIZE <= len(buf):
+        if buf[pos] != 0x47:
+            pos += 1
+            continue
+        if (((buf[pos + 1] & 0x1F) << 8) | buf[pos + 2]) == target:
+            result.append(pos)
+        pos += TS_PACKET_SIZE
+    return result
+
+
+def legacy_pcr(buf):
+    result = []
+    pos = tsindex.find_sync(buf)
+    while 0 <= pos and pos + TS_PACKET_SIZE <= len(buf):
+        if buf[pos] != 0x47:
+            pos += 1
+            continue
+        if tsindex.packet_pcr(buf, pos) is not None:
+            result.append(pos)
+        pos += TS_PACKET_SIZE
+    return result
+
+
+def new_tdt(buf):
+    found = tsindex._find_tdt(buf, 0, len(buf))
+    if found is None:
+        return None
+    return found[0], found[1] - tsindex.find_sync(buf)
+
+
+def bench(func, *args):
+    best = None
+    for _ in range(REPEAT):
+        t = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    args = sys.argv[1:]
+    if not args or len(args) > 2:
+        print(f'Usage: {sys.argv[0]} <file.ts> [MB]', file=sys.stderr)
+        sys.exit(1)
+    size = int(float(args[1] if len(args) > 1 else 10) * 1024 * 1024)
+    with open(args[0], 'rb') as f:
+        buf = f.read(size)
+    pcr_packets = legacy_pcr(buf)
+    if not pcr_packets:
+        print('PCR が見つかりません (MPEG-TS ではない?)', file=sys.stderr)
+        sys.exit(1)
+    pcr_pid = tsindex.packet_pid(buf, pcr_packets[0])
+
+    backends = [('stdlib', None)]
+    if tsindex.numpy is not None:
+        backends.append(('numpy', tsindex.numpy))
+    print(f'{args[0]}: 先頭 {len(buf) / 1048576:.1f}MB, PCR PID 0x{pcr_pid:04x}')
+    cases = [
+        ('tdt', (legacy_tdt, buf), (new_tdt, buf)),
+        ('pid', (legacy_pid, buf, pcr_pid),
+         (lambda b, p: list(tsindex.iter_packets(b, p)), buf, pcr_pid)),
+        ('pcr', (legacy_pcr, buf),
+         (lambda b: list(tsindex.iter_packets(b, pcr=True)), buf)),
+    ]
+    numpy_module = tsindex.numpy
+    try:
+        for name, legacy, new in cases:
+            legacy_time, expected = bench(*legacy)
+            line = f'{name:4s} loop {legacy_time * 1000:8.1f}ms'
+            for label, module in backends:
+                tsindex.numpy = module
+                new_time, result = bench(*new)
+                mark = '' if result == expected else ' (結果不一致)'
+                line += f'  {label} {new_time * 1000:7.2f}ms x{legacy_time / new_time:5.0f}{mark}'
+            print(line)
+    finally:
+        tsindex.numpy = numpy_module
+
+
+if __name__ == '__main__':
+    main()
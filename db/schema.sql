@@ -18,6 +18,7 @@ CREATE TABLE IF NOT EXISTS programme (
     end_time    TEXT NOT NULL,
     category    TEXT,           -- ジャンル (JSON配列)
     extra       TEXT,           -- 詳細情報 (JSON)
+    content_hash TEXT,          -- 取り込み時の内容のハッシュ (変わらなければ更新しない)
     updated_at  TEXT DEFAULT (datetime('now','localtime')),
     PRIMARY KEY (event_id, channel)
 );
@@ -26,6 +27,61 @@ CREATE INDEX IF NOT EXISTS idx_programme_start ON programme(start_time);
 CREATE INDEX IF NOT EXISTS idx_programme_channel ON programme(channel);
 CREATE INDEX IF NOT EXISTS idx_programme_title ON programme(title);
 CREATE INDEX IF NOT EXISTS idx_programme_category ON programme(category);
+CREATE INDEX IF NOT EXISTS idx_programme_updated ON programme(updated_at);
+
+-- 番組名・説明の全文検索索引 (trigram: 日本語の部分一致に使える。3 文字以上の語のみ)
+-- 本文は programme から読む外部コンテンツ表 (索引だけを持ち、番組名・説明の複製は持たない)。
+-- rowid は programme の rowid。programme への書き込みはトリガーで反映する
+-- (外部コンテンツ表からの削除は、索引に登録したときの値を渡す 'delete' コマンドで行う)
+CREATE VIRTUAL TABLE IF NOT EXISTS programme_fts USING fts5(
+    title, description, tokenize = 'trigram', content = 'programme', content_rowid = 'rowid'
+);
+
+-- INSERT OR REPLACE で置き換えられる行には DELETE トリガーが動かない
+-- (recursive_triggers 無効時) ため、挿入前に同じキーの古い行を索引から外す
+CREATE TRIGGER IF NOT EXISTS programme_fts_before_insert BEFORE INSERT ON programme BEGIN
+    INSERT INTO programme_fts (programme_fts, rowid, title, description)
+    SELECT 'delete', rowid, title, description FROM programme
+    WHERE event_id = new.event_id AND channel = new.channel;
+END;
+
+CREATE TRIGGER IF NOT EXISTS programme_fts_insert AFTER INSERT ON programme BEGIN
+    INSERT INTO programme_fts (rowid, title, description)
+    VALUES (new.rowid, new.title, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS programme_fts_update AFTER UPDATE OF title, description ON programme BEGIN
+    INSERT INTO programme_fts (programme_fts, rowid, title, description)
+    VALUES ('delete', old.rowid, old.title, old.description);
+    INSERT INTO programme_fts (rowid, title, description)
+    VALUES (new.rowid, new.title, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS programme_fts_delete AFTER DELETE ON programme BEGIN
+    INSERT INTO programme_fts (programme_fts, rowid, title, description)
+    VALUES ('delete', old.rowid, old.title, old.description);
+END;
+
+-- EPG 受信の記録 (bin/epg-capture.py が追加。versions は揃った受信を取り込めたときだけ)
+CREATE TABLE IF NOT EXISTS epg_scan (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel     TEXT NOT NULL,            -- 受信したチャンネル番号
+    multiplex   INTEGER DEFAULT 0,        -- BS/CS の全サービス分を受信したか
+    result      TEXT NOT NULL,            -- complete / unchanged / timeout
+    seconds     REAL NOT NULL,            -- 受信にかかった秒数
+    bytes       INTEGER,
+    versions    TEXT,                     -- EIT サブテーブルごとの version_number (JSON)
+    scanned_at  TEXT DEFAULT (datetime('now','localtime'))
+);
+
+CREATE INDEX IF NOT EXISTS idx_epg_scan_channel ON epg_scan(channel, multiplex, id);
+
+-- 番組表の世代 (取り込みで番組が変わるたびに 1 増える。Web UI の番組表グリッドのキャッシュキー)
+CREATE TABLE IF NOT EXISTS epg_generation (
+    id          INTEGER PRIMARY KEY CHECK (id = 1),
+    generation  INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO epg_generation (id, generation) VALUES (1, 0);
 -- [EPG_END]
 
 ----------------------------------------------
@@ -56,11 +112,26 @@ CREATE TABLE IF NOT EXISTS schedule (
     title       TEXT NOT NULL,
     start_time  TEXT NOT NULL,
     end_time    TEXT NOT NULL,
-    status      TEXT DEFAULT 'scheduled'  -- scheduled / recording / done / failed / skipped
+    status      TEXT DEFAULT 'scheduled', -- scheduled / conflict / recording / done / failed / skipped
+    tuner       INTEGER                   -- 割り当てたチューナー (系統ごとの番号, conflict は NULL)
 );
 
 CREATE INDEX IF NOT EXISTS idx_schedule_start ON schedule(start_time);
 CREATE INDEX IF NOT EXISTS idx_schedule_status ON schedule(status);
+CREATE INDEX IF NOT EXISTS idx_schedule_event ON schedule(event_id, channel);
+
+-- ルール照合の状態 (bin/schedule-match.py が更新。signature が変わったルールは全番組と照合し直す)
+CREATE TABLE IF NOT EXISTS rule_match (
+    rule_id     INTEGER PRIMARY KEY,
+    signature   TEXT NOT NULL,            -- 照合条件 (keyword, channel, ...) の JSON
+    matched_at  TEXT
+);
+
+-- 照合の進捗 (programme_watermark: 照合済みの番組の updated_at の最大値)
+CREATE TABLE IF NOT EXISTS match_state (
+    name        TEXT PRIMARY KEY,
+    value       TEXT
+);
 
 -- 録画ログ
 CREATE TABLE IF NOT EXISTS log (
@@ -73,4 +144,51 @@ CREATE TABLE IF NOT EXISTS log (
 
 CREATE INDEX IF NOT EXISTS idx_log_schedule ON log(schedule_id);
 CREATE INDEX IF NOT EXISTS idx_log_timestamp ON log(timestamp);
+
+-- 録画後トランスコードのジョブキュー (bin/transcode-worker.py が処理)
+CREATE TABLE IF NOT EXISTS transcode_job (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    path        TEXT NOT NULL UNIQUE,     -- 録画ファイル (RECORD_DIR からの相対パス)
+    status      TEXT DEFAULT 'queued',    -- queued / running / done / failed
+    output      TEXT,                     -- 変換済みファイル (RECORD_DIR からの相対パス)
+    error       TEXT,
+    created_at  TEXT DEFAULT (datetime('now','localtime')),
+    started_at  TEXT,
+    finished_at TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_transcode_job_status ON transcode_job(status);
+
+-- 録画ファイルの索引 (RECORD_DIR の走査結果。Web UI が差分照合して更新)
+CREATE TABLE IF NOT EXISTS recording (
+    path        TEXT PRIMARY KEY,         -- RECORD_DIR からの相対パス ("シリーズ/ファイル.ts")
+    series      TEXT NOT NULL,            -- シリーズ (ディレクトリ名)
+    name        TEXT NOT NULL,            -- ファイル名
+    size        INTEGER NOT NULL,
+    mtime       REAL NOT NULL,
+    has_nicojk  INTEGER DEFAULT 0,        -- 実況コメント (.nicojk) の有無
+    transcoded  TEXT,                     -- 変換済み MP4 の相対パス (なければ NULL)
+    checked_at  REAL NOT NULL             -- 最後に stat した時刻 (epoch)
+);
+
+CREATE INDEX IF NOT EXISTS idx_recording_series ON recording(series, mtime);
+CREATE INDEX IF NOT EXISTS idx_recording_mtime ON recording(mtime);
+
+-- 録画ファイルのメタデータキャッシュ ((path, size, mtime) が一致する間だけ有効)
+CREATE TABLE IF NOT EXISTS recording_meta (
+    path        TEXT PRIMARY KEY,         -- RECORD_DIR からの相対パス
+    size        INTEGER NOT NULL,
+    mtime       REAL NOT NULL,
+    duration    REAL NOT NULL,            -- 再生時間 (秒)
+    start_time  REAL,                     -- 録画開始時刻 (epoch, TDT から推定)
+    end_time    REAL,                     -- 録画終了時刻 (epoch, 末尾の TDT/TOT から推定)
+    tdt_epoch   INTEGER,                  -- 最初の TDT/TOT の時刻
+    tdt_offset  INTEGER                   -- 最初の TDT/TOT のバイト位置
+);
+
+-- シリーズディレクトリの照合状態 (mtime が変わったディレクトリだけ読み直す)
+CREATE TABLE IF NOT EXISTS recording_dir (
+    name        TEXT PRIMARY KEY,
+    mtime_ns    INTEGER NOT NULL
+);
 -- [AUTOREC_END]
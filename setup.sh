@@ -20,8 +20,7 @@ check_cmd() {
 echo ""
 echo "--- 依存コマンド確認 ---"
 check_cmd sqlite3 "必須: DBアクセス" || exit 1
-check_cmd jq "EPG解析に使用" || true
-check_cmd xmlstarlet "EPG XML解析に使用 (jqがない場合)" || true
+check_cmd python3 "必須: EPG 取り込み・Web UI" || exit 1
 check_cmd recpt1 "録画デバイス制御" || true
 check_cmd epgdump "EPGデータ変換" || true
 check_cmd curl "通知送信に使用" || true
@@ -92,7 +91,8 @@ echo ""
 echo "次のステップ:"
 echo "  1. conf/autorec.conf を環境に合わせて編集"
 echo "  2. conf/channels.conf のチャンネル設定を確認"
-echo "  3. crontab に cron.txt の内容を登録:"
+echo "  3. crontab に cron.txt の内容を登録し、録画スケジューラを起動:"
 echo "     crontab cron.txt"
+echo "     nohup python3 $AUTOREC_DIR/bin/recorder.py >> $AUTOREC_DIR/log/recorder.log 2>&1 &"
 echo "  4. Web UI を起動:"
 echo "     python3 $AUTOREC_DIR/web/server.py"
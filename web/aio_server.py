@@ -0,0 +1,591 @@
+"""asyncio 版 HTTP サーバー (WEB_SERVER=asyncio または server.py --asyncio)
+
+ThreadingHTTPServer は接続 1 本ごとにスレッドを使うので、ライブ視聴・録画再生の
+ストリームや録画のダウンロードがつながっている間はスレッドが塞がる。
+こちらは接続をコルーチンで扱い、送信は StreamWriter.drain() で相手の受信に合わせて待つ。
+- API: api.handle_request をワーカースレッドで実行 (DB・ffprobe などが同期処理のため)
+- 静的ファイル・API の gzip / ETag は httpcache (スレッド版と共通)
+- 録画のダウンロード・HLS セグメント: loop.sendfile (Range 対応)
+- ffmpeg の出力: パイプが読めるようになるまで待つ (スレッドを使わない)
+- ライブ配信: Subscriber.waker で配信スレッドから起こしてもらう
+- トランスコード枠・セグメントの変換待ちなど、ストリーム側の待ちのある同期処理は
+  API とは別のスレッドプールで実行 (視聴者が待っていても API のスレッドは塞がない)
+"""
+import asyncio
+import functools
+import http.client
+import io
+import mimetypes
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlparse, parse_qs, unquote, quote
+
+import api
+import hls
+import httpcache
+import live
+import transcode
+
+WORKERS = 16              # API を実行するスレッド数
+STREAM_WORKERS = 64       # ストリーム側の待ち (トランスコード枠・セグメント生成・選局) のスレッド数
+HEADER_LIMIT = 65536      # リクエストヘッダの上限
+KEEPALIVE_TIMEOUT = 60    # 次のリクエストを待つ秒数
+PIPE_READ_CHUNK = 65536
+
+
+class _HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message or HTTPStatus(status).phrase
+
+
+class _Request:
+    def __init__(self, method, target, version, headers, body, client):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.client = client
+        self.parsed = urlparse(target)
+        self.params = parse_qs(self.parsed.query)
+
+
+def _parse_range(header, size):
+    """Range ヘッダ → (start, end)。無ければ None、範囲外なら 416"""
+    if not header or not header.startswith("bytes="):
+        return None
+    try:
+        byte_range = header[6:].split(",")[0].strip()
+        if byte_range.startswith("-"):
+            start, end = max(0, size - int(byte_range[1:])), size - 1
+        elif byte_range.endswith("-"):
+            start, end = int(byte_range[:-1]), size - 1
+        else:
+            first, last = byte_range.split("-")
+            start, end = int(first), int(last)
+    except (ValueError, IndexError):
+        raise _HTTPError(416, "Range Not Satisfiable")
+    if start > end or start >= size:
+        raise _HTTPError(416, "Range Not Satisfiable")
+    return start, min(end, size - 1)
+
+
+def _record_path(rel_path):
+    """RECORD_DIR 配下の録画ファイル (パストラバーサル・存在を確認)"""
+    file_path = os.path.realpath(os.path.join(api.RECORD_DIR, rel_path))
+    record_dir_real = os.path.realpath(api.RECORD_DIR)
+    if not file_path.startswith(record_dir_real + os.sep) and file_path != record_dir_real:
+        raise _HTTPError(403, "Forbidden")
+    if not os.path.isfile(file_path):
+        raise _HTTPError(404, "Not Found")
+    return file_path
+
+
+def _reap(proc):
+    """ffmpeg を止めて回収 (ワーカースレッドで呼ぶ)"""
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+class _Connection:
+    """クライアント接続 1 本 (keep-alive で複数のリクエストを順に処理する)"""
+
+    def __init__(self, app, reader, writer):
+        self.app = app
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        peer = writer.get_extra_info("peername")
+        self.client = peer[0] if peer else "-"
+        self.request = None
+        self.keep_alive = False
+        self.head_only = False
+
+    async def serve(self):
+        try:
+            while True:
+                request = await self._read_request()
+                if request is None:
+                    break
+                if not await self._dispatch(request):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _read_request(self):
+        try:
+            head = await asyncio.wait_for(
+                self.reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            await self._send_error(431, "Request Header Fields Too Large", close=True)
+            return None
+        line, _, rest = head.partition(b"\r\n")
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            self.request = _Request("-", "-", "-", {}, b"", self.client)
+            await self._send_error(400, "Bad request line", close=True)
+            return None
+        headers = http.client.parse_headers(io.BytesIO(rest))
+        body = b""
+        try:
+            length = int(headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.request = _Request(method, target, version, headers, b"", self.client)
+            await self._send_error(400, "Bad Content-Length", close=True)
+            return None
+        if length > 0:
+            body = await self.reader.readexactly(length)
+        return _Request(method, target, version, headers, body, self.client)
+
+    def _keep_alive(self, request):
+        connection = (request.headers.get("Connection") or "").lower()
+        if request.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    async def _dispatch(self, request):
+        """リクエストを処理し、接続を続けるなら True"""
+        self.request = request
+        self.keep_alive = self._keep_alive(request)
+        self.head_only = request.method == "HEAD"
+        path = request.parsed.path
+        try:
+            if self.head_only and not path.startswith(("/api/", "/recordings/", "/live/")):
+                await self._serve_static(request)
+            elif request.method == "GET":
+                if path.startswith("/api/"):
+                    await self._handle_api(request)
+                elif path == "/recordings/transcode":
+                    await self._serve_recording_transcode(request)
+                elif path == "/recordings/hls/playlist.m3u8":
+                    await self._serve_hls_playlist(request)
+                elif path.startswith("/recordings/hls/"):
+                    await self._serve_hls_segment(request)
+                elif path.startswith("/recordings/"):
+                    await self._serve_recording(request)
+                elif path == "/live/stream":
+                    await self._serve_live_stream(request)
+                else:
+                    await self._serve_static(request)
+            elif request.method in ("POST", "PUT", "DELETE") and path.startswith("/api/"):
+                await self._handle_api(request)
+            elif request.method == "OPTIONS":
+                await self._send(204, {
+                    "Access-Control-Allow-Origin": "*",
+                    "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
+                    "Access-Control-Allow-Headers": "Content-Type",
+                })
+            elif request.method in ("POST", "PUT", "DELETE"):
+                raise _HTTPError(404)
+            else:
+                raise _HTTPError(501, f"Unsupported method ({request.method})")
+        except _HTTPError as e:
+            await self._send_error(e.status, e.message)
+        return self.keep_alive
+
+    # --- 送信 ---
+
+    def _log(self, status):
+        sys.stderr.write('[web] %s - "%s %s %s" %s -\n' % (
+            self.client, self.request.method, self.request.target, self.request.version, status))
+
+    async def _send_head(self, status, headers):
+        self._log(status)
+        if not self.keep_alive:
+            headers = dict(headers, Connection="close")
+        lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+                 "Date: " + time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await self.writer.drain()
+
+    async def _send(self, status, headers, body=b""):
+        if status != 304 and status != 204:
+            headers = dict(headers, **{"Content-Length": len(body)})
+        await self._send_head(status, headers)
+        if body and not self.head_only:
+            self.writer.write(body)
+            await self.writer.drain()
+
+    async def _send_error(self, status, message, close=False):
+        if close:
+            self.keep_alive = False
+        if self.request is None:
+            self.request = _Request("-", "-", "-", {}, b"", self.client)
+        body = f"{status} {message}\n".encode("utf-8")
+        await self._send(status, {"Content-Type": "text/plain; charset=utf-8"}, body)
+
+    async def _send_stream_head(self, headers=None):
+        """長さの決まらないストリーム (接続終了で完了)"""
+        self.keep_alive = False
+        await self._send_head(200, dict({
+            "Content-Type": "video/mp2t",
+            "Access-Control-Allow-Origin": "*",
+            "Cache-Control": "no-cache, no-store",
+        }, **(headers or {})))
+
+    async def _sendfile(self, path, offset=0, count=None):
+        with open(path, "rb") as f:
+            await self.loop.sendfile(self.writer.transport, f, offset, count)
+
+    async def _read_pipe(self, fd):
+        """パイプが読めるようになるまで待って読む (終わりなら空 bytes)"""
+        ready = self.loop.create_future()
+        self.loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            self.loop.remove_reader(fd)
+        return os.read(fd, PIPE_READ_CHUNK)
+
+    def _run(self, func, *args, **kwargs):
+        return self.loop.run_in_executor(self.app.executor, functools.partial(func, *args, **kwargs))
+
+    def _wait(self, func, *args, **kwargs):
+        """ストリーム側の待ちのある同期処理を API とは別のスレッドプールで実行"""
+        return self.loop.run_in_executor(
+            self.app.stream_executor, functools.partial(func, *args, **kwargs))
+
+    # --- API・静的ファイル ---
+
+    def _call_api(self, request):
+        """api.handle_request を実行し、GET の 200 は gzip / ETag を決める (ワーカースレッド)"""
+        headers = {}
+        try:
+            result = api.handle_request(
+                request.method, request.parsed.path, request.params, request.body)
+            status, content_type, body = result[:3]
+            if len(result) > 3:
+                headers = dict(result[3])
+        except Exception as e:
+            import json
+            status, content_type = 500, "application/json"
+            body = json.dumps({"error": str(e)}).encode("utf-8")
+        headers["Access-Control-Allow-Origin"] = "*"
+        if request.method == "GET" and status == 200:
+            headers.setdefault("Cache-Control", "no-cache")
+            not_modified, body, negotiated = httpcache.negotiate(
+                request.headers, content_type, body, headers.pop("ETag", None))
+            headers.update(negotiated)
+            if not_modified:
+                return 304, headers, b""
+        headers["Content-Type"] = content_type
+        return status, headers, body
+
+    async def _handle_api(self, request):
+        status, headers, body = await self._run(self._call_api, request)
+        await self._send(status, headers, body)
+
+    async def _serve_static(self, request):
+        path = "/index.html" if request.parsed.path == "/" else unquote(request.parsed.path)
+        static = httpcache.static_file(self.app.static_dir, path)
+        headers = {"Cache-Control": "no-cache, must-revalidate"}
+        if static is not None:
+            not_modified, body, negotiated = httpcache.negotiate(
+                request.headers, static.content_type, static.body, static.etag, static.gzipped)
+            headers.update(negotiated)
+            if not_modified:
+                await self._send(304, headers)
+            else:
+                headers["Content-Type"] = static.content_type
+                await self._send(200, headers, body)
+            return
+        # キャッシュしない大きなファイルはそのまま送る
+        file_path = os.path.realpath(os.path.join(self.app.static_dir, path.lstrip("/")))
+        if (not file_path.startswith(os.path.realpath(self.app.static_dir) + os.sep)
+                or not os.path.isfile(file_path)):
+            raise _HTTPError(404, "File not found")
+        size = os.path.getsize(file_path)
+        headers.update({"Content-Type": mimetypes.guess_type(file_path)[0] or "application/octet-stream",
+                        "Content-Length": size})
+        await self._send_head(200, headers)
+        if not self.head_only:
+            await self._sendfile(file_path, 0, size)
+
+    # --- 録画 ---
+
+    def _quality_name(self, params):
+        quality = params.get("quality", [self.app.default_quality])[0]
+        return quality if quality in self.app.quality_presets else self.app.default_quality
+
+    def _quality_args(self, params):
+        preset = self.app.quality_presets[self._quality_name(params)]
+        return preset["video"] + preset["audio"]
+
+    def _client_key(self, params):
+        return f"{self.client}/{params.get('client', [''])[0]}"
+
+    async def _serve_recording(self, request):
+        """録画ファイル配信 (Range リクエスト対応)"""
+        file_path = _record_path(unquote(request.parsed.path[len("/recordings/"):]))
+        size = os.path.getsize(file_path)
+        byte_range = _parse_range(request.headers.get("Range"), size)
+        headers = {}
+        if byte_range is None:
+            status, (start, end) = 200, (0, size - 1)
+        else:
+            status, (start, end) = 206, byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        if file_path.endswith(".nicojk"):
+            content_type = "application/x-ndjson"
+        elif file_path.endswith(".mp4"):
+            content_type = "video/mp4"
+        else:
+            content_type = "video/mp2t"
+        headers.update({
+            "Content-Type": content_type,
+            "Content-Length": end - start + 1,
+            "Accept-Ranges": "bytes",
+            "Access-Control-Allow-Origin": "*",
+        })
+        if request.params.get("download", [""])[0] == "1":
+            name = quote(os.path.basename(file_path))
+            headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{name}"
+        await self._send_head(status, headers)
+        if end >= start:
+            await self._sendfile(file_path, start, end - start + 1)
+
+    async def _serve_recording_transcode(self, request):
+        """録画ファイルをトランスコードして配信 (MPEG-2 → H.264 for MSE)"""
+        params = request.params
+        rel_path = params.get("path", [""])[0]
+        if not rel_path:
+            raise _HTTPError(400, "path parameter is required")
+        file_path = _record_path(rel_path)
+        ss = params.get("ss", [""])[0]
+        try:
+            ss = float(ss or 0)
+        except ValueError:
+            raise _HTTPError(400, "Invalid ss parameter")
+
+        if hls.enabled():
+            await self._serve_segmented_transcode(file_path, ss, params)
+            return
+
+        input_args, src = await self._wait(api.recording_input, file_path, ss)
+        cmd = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-analyzeduration", "1000000", "-probesize", "2000000",
+        ] + input_args + self._quality_args(params) + [
+            "-f", "mpegts", "-mpegts_flags", "+resend_headers", "pipe:1",
+        ]
+        ticket = await self._wait(
+            transcode.scheduler.acquire, transcode.VOD, self._quality_name(params),
+            client=self._client_key(params), label=os.path.basename(file_path),
+        )
+        if ticket is None:
+            if src is not None:
+                src.close()
+            raise _HTTPError(503, "Transcode queue is full")
+        try:
+            ffmpeg = subprocess.Popen(
+                cmd, stdin=src or subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            ticket.release()
+            raise _HTTPError(503, "ffmpeg not found (playback requires ffmpeg for transcoding)")
+        finally:
+            if src is not None:
+                src.close()
+        ticket.attach(ffmpeg)
+        try:
+            await self._send_stream_head()
+            fd = ffmpeg.stdout.fileno()
+            while True:
+                data = await self._read_pipe(fd)
+                if not data:
+                    break
+                self.writer.write(data)
+                await self.writer.drain()
+        finally:
+            await self._wait(_reap, ffmpeg)
+            ticket.release()
+
+    def _segment_store(self, file_path, params):
+        """録画と画質に対応するセグメントキャッシュ (ワーカースレッド)"""
+        try:
+            return hls.get_cache().store(
+                file_path, self._quality_name(params), self._quality_args(params))
+        except FileNotFoundError:
+            raise _HTTPError(503, "ffprobe not found (playback requires ffmpeg for transcoding)")
+        except (OSError, KeyError, ValueError, subprocess.TimeoutExpired):
+            raise _HTTPError(500, "Could not determine duration")
+
+    async def _serve_segmented_transcode(self, file_path, ss, params):
+        """セグメントキャッシュを ss を含むセグメントから順に連結して配信"""
+        store = await self._wait(self._segment_store, file_path, params)
+        index = int(ss // hls.SEGMENT_SECONDS)
+        client = self._client_key(params)
+        path = await self._wait(store.get_segment, index, client=client)
+        if path is None:
+            raise _HTTPError(503, "Segment transcode failed")
+        await self._send_stream_head({"X-Segment-Start": str(index * hls.SEGMENT_SECONDS)})
+        while path is not None:
+            await self._sendfile(path)
+            index += 1
+            path = await self._wait(store.get_segment, index, client=client)
+
+    async def _serve_hls_playlist(self, request):
+        """GET /recordings/hls/playlist.m3u8?path=...&quality=... - VOD プレイリスト"""
+        if not hls.enabled():
+            raise _HTTPError(404, "HLS cache is disabled")
+        params = request.params
+        rel_path = params.get("path", [""])[0]
+        if not rel_path:
+            raise _HTTPError(400, "path parameter is required")
+        store = await self._wait(self._segment_store, _record_path(rel_path), params)
+        client = quote(params.get("client", [""])[0])
+        body = store.playlist(
+            lambda i: f"/recordings/hls/{store.key}/{store.quality}/{i}.ts?client={client}"
+        ).encode("utf-8")
+        await self._send(200, {"Content-Type": "application/vnd.apple.mpegurl",
+                               "Access-Control-Allow-Origin": "*"}, body)
+
+    async def _serve_hls_segment(self, request):
+        """GET /recordings/hls/<key>/<quality>/<index>.ts - セグメント配信"""
+        parts = request.parsed.path[len("/recordings/hls/"):].split("/")
+        if len(parts) != 3 or not parts[2].endswith(".ts"):
+            raise _HTTPError(404, "Not Found")
+        key, quality, name = parts
+        try:
+            index = int(name[:-3])
+        except ValueError:
+            raise _HTTPError(404, "Not Found")
+        if quality not in self.app.quality_presets or not key.isalnum():
+            raise _HTTPError(404, "Not Found")
+        preset = self.app.quality_presets[quality]
+        store = hls.get_cache().lookup(key, quality, preset["video"] + preset["audio"])
+        if store is None:
+            raise _HTTPError(404, "Not Found")
+        path = await self._wait(store.get_segment, index,
+                               client=self._client_key(request.params))
+        if path is None:
+            raise _HTTPError(404, "Segment not available")
+        size = os.path.getsize(path)
+        await self._send_head(200, {
+            "Content-Type": "video/mp2t",
+            "Content-Length": size,
+            "Access-Control-Allow-Origin": "*",
+            "Cache-Control": "max-age=86400",
+        })
+        await self._sendfile(path, 0, size)
+
+    # --- ライブ ---
+
+    async def _serve_live_stream(self, request):
+        """ライブTV ストリーム配信 (recpt1 → ffmpeg → HTTP, 同一チャンネル・画質は共有)"""
+        params = request.params
+        ch = params.get("ch", [""])[0]
+        if not ch:
+            raise _HTTPError(400, "ch parameter is required")
+        valid_channels = api._get_valid_channels()
+        if ch not in valid_channels:
+            raise _HTTPError(400, f"Invalid channel: {ch}")
+        quality = self._quality_name(params)
+
+        rewind = params.get("rewind", [""])[0]
+        if rewind:
+            try:
+                rewind = float(rewind)
+            except ValueError:
+                raise _HTTPError(400, "Invalid rewind parameter")
+            if rewind > 0:
+                await self._serve_timeshift_stream(ch, rewind, quality, params)
+                return
+
+        try:
+            session, sub = await self._wait(
+                live.hub.subscribe, ch, valid_channels[ch], quality,
+                self._quality_args(params), self.client)
+        except live.LiveStreamError as e:
+            raise _HTTPError(e.status, e.message)
+
+        wake = asyncio.Event()
+        sub.waker = lambda: self.loop.call_soon_threadsafe(wake.set)
+        try:
+            await self._send_stream_head()
+            while True:
+                wake.clear()  # pop より先に消す (その後の push で必ず起きる)
+                data = sub.pop(0)
+                if data is None:
+                    break
+                if data:
+                    self.writer.write(data)
+                    await self.writer.drain()
+                else:
+                    await wake.wait()
+        finally:
+            sub.waker = None
+            if sub.dropped:
+                sys.stderr.write(f"[web] {self.client} - live client dropped (buffer overflow): ch={ch}\n")
+            await self._wait(live.hub.unsubscribe, session, sub)
+
+    async def _serve_timeshift_stream(self, ch, rewind, quality, params):
+        """タイムシフト再生 (受信中チャンネルのバッファを rewind 秒前から配信)"""
+        try:
+            session, player = await self._wait(
+                live.hub.open_timeshift, ch, rewind, quality,
+                self._quality_args(params), self.client)
+        except live.LiveStreamError as e:
+            raise _HTTPError(e.status, e.message)
+        try:
+            await self._send_stream_head()
+            fd = player.fileno()
+            while True:
+                data = await self._read_pipe(fd)
+                if not data:
+                    break
+                self.writer.write(data)
+                await self.writer.drain()
+        finally:
+            await self._wait(live.hub.close_timeshift, session, player)
+
+
+class App:
+    def __init__(self, static_dir, quality_presets, default_quality):
+        self.static_dir = static_dir
+        self.quality_presets = quality_presets
+        self.default_quality = default_quality
+        self.executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="web")
+        self.stream_executor = ThreadPoolExecutor(max_workers=STREAM_WORKERS,
+                                                  thread_name_prefix="stream")
+
+    async def _on_connect(self, reader, writer):
+        await _Connection(self, reader, writer).serve()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self._on_connect, host, port, limit=HEADER_LIMIT)
+        async with server:
+            await server.serve_forever()
+
+
+def run(port, static_dir, quality_presets, default_quality, host="0.0.0.0"):
+    """asyncio 版サーバーを起動 (Ctrl-C で止まるまで戻らない)"""
+    app = App(static_dir, quality_presets, default_quality)
+    try:
+        asyncio.run(app.serve(host, port))
+    finally:
+        app.executor.shutdown(wait=False)
+        app.stream_executor.shutdown(wait=False)
@@ -1,20 +1,52 @@
 """REST API ハンドラ for autorec Web UI"""
+import contextlib
+import functools
+import hashlib
 import json
 import os
+import signal
 import sqlite3
 import subprocess
 import sys
 import threading
+import time
+import weakref
 from datetime import datetime, timedelta
-from urllib.parse import parse_qs
+from urllib.parse import parse_qs, quote
+
+import tsindex
 
 AUTOREC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 EPG_DB = os.path.join(AUTOREC_DIR, "db", "epg.sqlite")
 AUTOREC_DB = os.path.join(AUTOREC_DIR, "db", "autorec.sqlite")
 RECORD_DIR = "/mnt/data"
-
-MAX_LIVE_STREAMS = 2
-_live_streams = {}   # {stream_id: {"channel", "channel_name", "pid", "started_at"}}
+TIMESHIFT_DIR = os.path.join(AUTOREC_DIR, "timeshift")
+TIMESHIFT_SIZE_MB = 2048  # チャンネルごとのタイムシフトバッファ (0 で無効)
+HLS_CACHE_DIR = ""        # 空なら RECORD_DIR/.hls
+HLS_CACHE_MB = 10240      # 録画再生用セグメントキャッシュの上限 (0 で無効)
+HLS_SEGMENT_SECONDS = 6
+TRANSCODE_CONCURRENCY = 1   # 録画後トランスコードの同時実行数 (0 で無効)
+TRANSCODE_NICE = 10
+TRANSCODE_PRESET = "medium"
+TRANSCODE_CRF = 23
+TRANSCODE_CPU_BUDGET = 0.0  # リアルタイム変換に使う CPU (コア数, 0 なら全コア)
+TRANSCODE_QUEUE_TIMEOUT = 30  # 録画再生の変換が予算待ちで諦めるまでの秒数
+
+START_OFFSET = 1           # 番組開始の何秒前に録画を始めるか (record.sh と同じ設定)
+END_OFFSET = 0             # 番組終了の何秒後に録画を止めるか
+RECORD_PREWARM_SECONDS = 3  # さらにこの秒数早く recpt1 を起動してチューナーを選局させておく
+RECORDER_PID_FILE = os.path.join(AUTOREC_DIR, "log", "recorder.pid")
+
+TUNERS_GR = 2         # 地上波チューナー数 (EPG 取得の並列数・録画予定の確保に使う)
+TUNERS_SAT = 2        # BS/CS チューナー数
+EPG_SAT_SCAN_SECONDS = 120  # BS/CS の EPG 受信秒数 (全サービス分を 1 トランスポンダで受ける)
+
+DB_MMAP_MB = 256      # SQLite をメモリマップで読む上限 (0 で無効)
+DB_CACHE_MB = 16      # 接続ごとのページキャッシュ
+READ_POOL_SIZE = 8    # 使い終わった読み出し専用接続を残しておく本数 (DB ごと)
+
+MAX_LIVE_STREAMS = 2  # チューナー数 (同一チャンネルの視聴者は 1 チューナーを共有)
+_live_streams = {}   # {stream_id: {"channel", "channel_name", "pid", "started_at", "subscribers"}}
 _live_lock = threading.Lock()
 
 # conf から DB パスを読み込み (あれば上書き)
@@ -34,28 +66,179 @@ if os.path.exists(_conf_path):
                 AUTOREC_DB = val
             elif key.strip() == "RECORD_DIR" and val:
                 RECORD_DIR = val
+            elif key.strip() == "TIMESHIFT_DIR" and val:
+                TIMESHIFT_DIR = val
+            elif key.strip() == "TIMESHIFT_SIZE_MB" and val:
+                try:
+                    TIMESHIFT_SIZE_MB = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "HLS_CACHE_DIR" and val:
+                HLS_CACHE_DIR = val
+            elif key.strip() == "HLS_CACHE_MB" and val:
+                try:
+                    HLS_CACHE_MB = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "TRANSCODE_CONCURRENCY" and val:
+                try:
+                    TRANSCODE_CONCURRENCY = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "TRANSCODE_NICE" and val:
+                try:
+                    TRANSCODE_NICE = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "TRANSCODE_PRESET" and val:
+                TRANSCODE_PRESET = val
+            elif key.strip() == "TRANSCODE_CRF" and val:
+                try:
+                    TRANSCODE_CRF = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "TRANSCODE_CPU_BUDGET" and val:
+                try:
+                    TRANSCODE_CPU_BUDGET = float(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "TRANSCODE_QUEUE_TIMEOUT" and val:
+                try:
+                    TRANSCODE_QUEUE_TIMEOUT = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "START_OFFSET" and val:
+                try:
+                    START_OFFSET = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "END_OFFSET" and val:
+                try:
+                    END_OFFSET = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "RECORD_PREWARM_SECONDS" and val:
+                try:
+                    RECORD_PREWARM_SECONDS = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "TUNERS_GR" and val:
+                try:
+                    TUNERS_GR = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "TUNERS_SAT" and val:
+                try:
+                    TUNERS_SAT = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "EPG_SAT_SCAN_SECONDS" and val:
+                try:
+                    EPG_SAT_SCAN_SECONDS = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "DB_MMAP_MB" and val:
+                try:
+                    DB_MMAP_MB = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "DB_CACHE_MB" and val:
+                try:
+                    DB_CACHE_MB = int(val)
+                except ValueError:
+                    pass
+            elif key.strip() == "READ_POOL_SIZE" and val:
+                try:
+                    READ_POOL_SIZE = int(val)
+                except ValueError:
+                    pass
 
 
 _connections = {}
 _conn_lock = threading.Lock()
 
+# 読み出しはスレッドごとの読み出し専用接続、書き込みは DB ごとに 1 本の共有接続を
+# ロックで順番に使う (WAL なので読み出しは書き込み中も待たされない)
+STATEMENT_CACHE = 256  # 接続ごとに使い回すプリペアドステートメントの数
+_write_locks = {}       # db_path → RLock
+_idle_readers = {}      # db_path → [使い終わった読み出し専用接続]
+_reader_local = threading.local()
+_pool_stats = {"read_opened": 0, "read_reused": 0, "read_leases": 0,
+               "writes": 0, "write_waits": 0, "write_wait_seconds": 0.0}
+
+
+def _tune(conn):
+    """メモリマップ・ページキャッシュの大きさを設定"""
+    conn.execute(f"PRAGMA mmap_size={max(0, DB_MMAP_MB) * 1024 * 1024}")
+    conn.execute(f"PRAGMA cache_size={-max(0, DB_CACHE_MB) * 1024}")  # 負の値は KiB 単位
+
 
 def _init_connection(db_path):
     """新しい SQLite 接続を作成し初期設定を実行"""
-    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn = sqlite3.connect(db_path, check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL")
     conn.execute("PRAGMA busy_timeout=5000")
+    _tune(conn)
     if db_path == EPG_DB:
         conn.execute(
             "CREATE INDEX IF NOT EXISTS idx_programme_start_channel "
             "ON programme(start_time, channel)"
         )
+        # 既存 DB にも索引・全文検索を作成 (全文検索は作成時に既存の番組から作る)
+        fts = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'programme_fts'"
+        ).fetchone()
+        if fts is not None and "content" not in fts["sql"]:
+            # 番組名・説明の複製を持つ以前の全文検索表 → 外部コンテンツ表に作り直す
+            conn.executescript(
+                "DROP TRIGGER IF EXISTS programme_fts_before_insert;"
+                "DROP TRIGGER IF EXISTS programme_fts_insert;"
+                "DROP TRIGGER IF EXISTS programme_fts_update;"
+                "DROP TRIGGER IF EXISTS programme_fts_delete;"
+                "DROP TABLE programme_fts;"
+            )
+            fts = None
+        conn.executescript(_read_schema_section("EPG"))
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(programme)")}
+        if "content_hash" not in columns:
+            conn.execute("ALTER TABLE programme ADD COLUMN content_hash TEXT")
+        if fts is None:
+            conn.execute("INSERT INTO programme_fts (programme_fts) VALUES ('rebuild')")
+            conn.commit()
+    elif db_path == AUTOREC_DB:
+        # 既存 DB にも後から追加したテーブルを作成 (schema.sql は IF NOT EXISTS のみ)
+        conn.executescript(_read_schema_section("AUTOREC"))
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(recording_meta)")}
+        if "end_time" not in columns:
+            conn.execute("ALTER TABLE recording_meta ADD COLUMN end_time REAL")
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(schedule)")}
+        if "tuner" not in columns:
+            conn.execute("ALTER TABLE schedule ADD COLUMN tuner INTEGER")
     return conn
 
 
+def _read_schema_section(name):
+    """db/schema.sql から [<name>_START] 〜 [<name>_END] の SQL を取り出す"""
+    lines = []
+    inside = False
+    with open(os.path.join(AUTOREC_DIR, "db", "schema.sql"), encoding="utf-8") as f:
+        for line in f:
+            if line.startswith(f"-- [{name}_START]"):
+                inside = True
+            elif line.startswith(f"-- [{name}_END]"):
+                break
+            elif inside:
+                lines.append(line)
+    return "".join(lines)
+
+
 def _get_db(db_path):
-    """SQLite 接続を取得 (モジュールレベルで共有)"""
+    """SQLite 接続を取得 (モジュールレベルで共有, 書き込み用)
+
+    複数のスレッドから書き込むときは writing() で順番に使う。
+    """
     conn = _connections.get(db_path)
     if conn is not None:
         return conn
@@ -65,7 +248,101 @@ def _get_db(db_path):
             return conn
         conn = _init_connection(db_path)
         _connections[db_path] = conn
+        _write_locks[db_path] = threading.RLock()
+        return conn
+
+
+@contextlib.contextmanager
+def writing(db_path):
+    """書き込み用の共有接続をロックして渡す (抜けるときに commit, 例外なら rollback)"""
+    conn = _get_db(db_path)
+    lock = _write_locks[db_path]
+    waited = 0.0
+    if not lock.acquire(blocking=False):
+        started = time.monotonic()
+        lock.acquire()
+        waited = time.monotonic() - started
+    try:
+        with _conn_lock:
+            _pool_stats["writes"] += 1
+            if waited:
+                _pool_stats["write_waits"] += 1
+                _pool_stats["write_wait_seconds"] += waited
+        with conn:
+            yield conn
+    finally:
+        lock.release()
+
+
+def _open_reader(db_path):
+    _get_db(db_path)  # スキーマの作成・WAL への切り替えを済ませておく
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(db_path))}?mode=ro", uri=True,
+                           check_same_thread=False, cached_statements=STATEMENT_CACHE)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only=1")
+    conn.execute("PRAGMA busy_timeout=5000")
+    _tune(conn)
+    return conn
+
+
+def _return_reader(db_path, conn):
+    """スレッドの終了時に読み出し専用接続を戻す (READ_POOL_SIZE を超える分は閉じる)"""
+    with _conn_lock:
+        idle = _idle_readers.setdefault(db_path, [])
+        if len(idle) < READ_POOL_SIZE:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+def _read_db(db_path):
+    """このスレッド専用の読み出し専用接続を取得
+
+    スレッドが終わるまで同じ接続を使い、終わったら次のスレッドが使い回す。
+    """
+    leased = getattr(_reader_local, "connections", None)
+    if leased is None:
+        leased = _reader_local.connections = {}
+    conn = leased.get(db_path)
+    if conn is not None:
         return conn
+    with _conn_lock:
+        idle = _idle_readers.get(db_path)
+        conn = idle.pop() if idle else None
+        _pool_stats["read_leases"] += 1
+        _pool_stats["read_reused" if conn is not None else "read_opened"] += 1
+    if conn is None:
+        conn = _open_reader(db_path)
+    leased[db_path] = conn
+    weakref.finalize(threading.current_thread(), _return_reader, db_path, conn)
+    return conn
+
+
+def notify_recorder():
+    """常駐中の録画スケジューラ (bin/recorder.py) に録画予定の変更を知らせる
+
+    常駐していなければ False (次に起動したときに読み直すので録画予定は失われない)。
+    """
+    try:
+        with open(RECORDER_PID_FILE) as f:
+            pid = int(f.read().strip())
+        # 異常終了で残った PID ファイルの番号が別のプロセスに使われていたら送らない
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            if b"recorder.py" not in f.read():
+                return False
+        os.kill(pid, signal.SIGHUP)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def resolve_schedules():
+    """録画予定の重なりをチューナー数で解決し、録画スケジューラに知らせる"""
+    import schedule_conflict  # schedule_conflict が api を import するため遅延 import
+    with writing(AUTOREC_DB):
+        result = schedule_conflict.resolve()
+    notify_recorder()
+    return result
 
 
 def _json_response(data, status=200):
@@ -120,7 +397,7 @@ def get_programmes(params):
 
     where = "WHERE " + " AND ".join(conditions) if conditions else ""
 
-    conn = _get_db(EPG_DB)
+    conn = _read_db(EPG_DB)
     rows = conn.execute(
         f"SELECT event_id, channel, title, description, start_time, end_time, category FROM programme {where} ORDER BY start_time, channel LIMIT ? OFFSET ?",
         args + [limit, offset],
@@ -134,8 +411,137 @@ def get_programmes(params):
     })
 
 
+# 番組表から作るレスポンスのキャッシュ: (種類, 番組表の世代) → (ETag, JSON)
+EPG_CACHE_ENTRIES = 32
+_epg_cache = {}
+_epg_cache_lock = threading.Lock()
+
+
+def broadcast_date(dt):
+    """日時 → 放送日 ("YYYY-MM-DD", 4:00 起点)"""
+    return (dt - timedelta(hours=4)).strftime("%Y-%m-%d")
+
+
+def epg_generation(conn=None):
+    """番組表の世代 (取り込みで番組が変わるたびに増える)"""
+    conn = conn or _read_db(EPG_DB)
+    row = conn.execute("SELECT generation FROM epg_generation WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+
+def _cached_epg_response(key, build):
+    """番組表の世代が変わるまで build(conn, 世代) の JSON (bytes) を使い回す (ETag 付き)"""
+    conn = _read_db(EPG_DB)
+    generation = epg_generation(conn)
+    with _epg_cache_lock:
+        cached = _epg_cache.get((key, generation))
+    if cached is None:
+        body = build(conn, generation)
+        cached = (f'"{hashlib.sha1(body).hexdigest()[:20]}"', body)
+        with _epg_cache_lock:
+            for stale in [k for k in _epg_cache if k[1] != generation]:
+                del _epg_cache[stale]
+            while len(_epg_cache) >= EPG_CACHE_ENTRIES:
+                del _epg_cache[next(iter(_epg_cache))]
+            _epg_cache[(key, generation)] = cached
+    etag, body = cached
+    return 200, "application/json", body, {"ETag": etag, "Cache-Control": "no-cache"}
+
+
+def _build_programme_grid(conn, date, generation):
+    """放送日 1 日分の番組表グリッドの JSON"""
+    day_start = datetime.strptime(date, "%Y-%m-%d") + timedelta(hours=4)
+    day_end = day_start + timedelta(days=1)
+    # 日をまたいで放送中の番組も含める (1 日より長い番組は無い前提で開始時刻の索引を使う)
+    rows = conn.execute(
+        "SELECT event_id, channel, title, start_time, end_time, category FROM programme "
+        "WHERE start_time >= ? AND start_time < ? AND end_time > ? ORDER BY start_time, channel",
+        ((day_start - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S"),
+         day_end.strftime("%Y-%m-%d %H:%M:%S"), day_start.strftime("%Y-%m-%d %H:%M:%S")),
+    ).fetchall()
+    latest = conn.execute("SELECT MAX(start_time) FROM programme").fetchone()[0]
+
+    channels = {}
+    categories = {}
+    columns = {"channel": [], "event_id": [], "start": [], "duration": [], "title": [], "category": []}
+    base = day_start.timestamp()
+    for r in rows:
+        try:
+            start = datetime.fromisoformat(r["start_time"]).timestamp()
+            end = datetime.fromisoformat(r["end_time"]).timestamp()
+        except ValueError:
+            continue
+        columns["channel"].append(channels.setdefault(r["channel"], len(channels)))
+        columns["event_id"].append(r["event_id"])
+        columns["start"].append(int(start - base))
+        columns["duration"].append(int(end - start))
+        columns["title"].append(r["title"])
+        columns["category"].append(
+            categories.setdefault(r["category"], len(categories)) if r["category"] else -1)
+
+    return json.dumps({
+        "date": date,
+        "generation": generation,
+        "base": day_start.strftime("%Y-%m-%d %H:%M:%S"),
+        "last_date": broadcast_date(datetime.fromisoformat(latest)) if latest else None,
+        "channels": list(channels),
+        "categories": list(categories),
+        "programmes": columns,
+    }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def get_programme_grid(params):
+    """GET /api/programmes/grid - 番組表グリッド (放送日 1 日分)
+
+    番組は列ごとの配列 (チャンネル・ジャンルは番号、開始は base からの秒数) で返す。
+    説明は含めない (/api/programmes/detail で 1 件ずつ取る)。
+    番組表の世代が変わるまでは同じ JSON をキャッシュから返す (ETag 付き)。
+    """
+    date = params.get("date", [""])[0] or broadcast_date(datetime.now())
+    try:
+        datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        return _error("Invalid date")
+
+    return _cached_epg_response(
+        ("grid", date), lambda conn, generation: _build_programme_grid(conn, date, generation))
+
+
+# API で返す番組の列 (content_hash などの取り込み用の列は返さない)
+_PROGRAMME_COLUMNS = ("event_id", "channel", "title", "description", "start_time", "end_time",
+                      "category", "extra", "updated_at")
+
+
+def get_programme_detail(params):
+    """GET /api/programmes/detail - 番組 1 件 (説明を含む)"""
+    channel = params.get("channel", [""])[0]
+    try:
+        event_id = int(params.get("event_id", [""])[0])
+    except ValueError:
+        return _error("event_id is required")
+    row = _read_db(EPG_DB).execute(
+        f"SELECT {', '.join(_PROGRAMME_COLUMNS)} FROM programme "
+        "WHERE event_id = ? AND channel = ?",
+        (event_id, channel),
+    ).fetchone()
+    if not row:
+        return _error("Programme not found", 404)
+    return _json_response({"programme": dict(row)})
+
+
+def fts_phrase(keyword):
+    """キーワードを全文検索 (trigram) のフレーズに変換。3 文字未満なら None (索引で引けない)"""
+    if not keyword or len(keyword) < 3:
+        return None
+    return '"' + keyword.replace('"', '""') + '"'
+
+
 def search_programmes(params):
-    """GET /api/programmes/search - 番組表検索"""
+    """GET /api/programmes/search - 番組表検索
+
+    keyword は番組名・説明の部分一致 (3 文字以上は全文検索索引を使う)。
+    sort=desc|asc (放送日時) | rank (関連度順, 全文検索時のみ)
+    """
     keyword = params.get("keyword", [""])[0]
     category = params.get("category", [""])[0]
     channel = params.get("channel", [""])[0]
@@ -146,35 +552,48 @@ def search_programmes(params):
 
     conditions = []
     args = []
-
-    if keyword:
-        conditions.append("(title LIKE ? OR description LIKE ?)")
+    source = "programme p"
+
+    match = fts_phrase(keyword)
+    if match:
+        # 全文検索索引で絞り込む (3 文字未満は trigram で引けないので LIKE)
+        # CROSS JOIN で索引側を外側のループに固定する (番組側から引くと 1 行ごとに MATCH が走る)
+        source = "programme_fts CROSS JOIN programme p ON p.rowid = programme_fts.rowid"
+        conditions.append("programme_fts MATCH ?")
+        args.append(match)
+    elif keyword:
+        conditions.append("(p.title LIKE ? OR p.description LIKE ?)")
         args.extend([f"%{keyword}%", f"%{keyword}%"])
     if category:
-        conditions.append("category LIKE ?")
+        conditions.append("p.category LIKE ?")
         args.append(f"%{category}%")
     if channel:
-        conditions.append("channel = ?")
+        conditions.append("p.channel = ?")
         args.append(channel)
     if date_from:
-        conditions.append("start_time >= ?")
+        conditions.append("p.start_time >= ?")
         args.append(date_from)
     if date_to:
-        conditions.append("start_time <= ?")
+        conditions.append("p.start_time <= ?")
         args.append(date_to)
 
     where = "WHERE " + " AND ".join(conditions) if conditions else ""
 
     sort = params.get("sort", [""])[0]
-    order = "ASC" if sort == "asc" else "DESC"
+    if sort == "rank" and match:
+        # 関連度順 (番組名での一致を説明文より重く見る)
+        order_by = "bm25(programme_fts, 10.0, 1.0), p.start_time DESC"
+    else:
+        order_by = "p.start_time " + ("ASC" if sort == "asc" else "DESC")
 
-    conn = _get_db(EPG_DB)
+    conn = _read_db(EPG_DB)
     rows = conn.execute(
-        f"SELECT * FROM programme {where} ORDER BY start_time {order} LIMIT ? OFFSET ?",
+        f"SELECT {', '.join('p.' + c for c in _PROGRAMME_COLUMNS)} FROM {source} {where} "
+        f"ORDER BY {order_by} LIMIT ? OFFSET ?",
         args + [limit, offset],
     ).fetchall()
     total = conn.execute(
-        f"SELECT COUNT(*) FROM programme {where}", args
+        f"SELECT COUNT(*) FROM {source} {where}", args
     ).fetchone()[0]
     return _json_response({
         "programmes": [dict(r) for r in rows],
@@ -185,8 +604,11 @@ def search_programmes(params):
 
 
 def get_programme_stats(_params):
-    """GET /api/programmes/stats - 番組統計"""
-    conn = _get_db(EPG_DB)
+    """GET /api/programmes/stats - 番組統計 (番組表の世代ごとにキャッシュ)"""
+    return _cached_epg_response("stats", _build_programme_stats)
+
+
+def _build_programme_stats(conn, _generation):
     total = conn.execute("SELECT COUNT(*) FROM programme").fetchone()[0]
     by_channel = conn.execute(
         "SELECT channel, COUNT(*) as count FROM programme GROUP BY channel ORDER BY count DESC"
@@ -199,25 +621,28 @@ def get_programme_stats(_params):
         "by_channel": [dict(r) for r in by_channel],
         "earliest": date_range["earliest"],
         "latest": date_range["latest"],
-    })
+    })[2]
 
 
 def get_categories(_params):
-    """GET /api/categories - ジャンル一覧"""
-    conn = _get_db(EPG_DB)
+    """GET /api/categories - ジャンル一覧 (番組表の世代ごとにキャッシュ)"""
+    return _cached_epg_response("categories", _build_categories)
+
+
+def _build_categories(conn, _generation):
     rows = conn.execute(
         "SELECT DISTINCT value FROM programme, json_each(programme.category) "
         "WHERE category IS NOT NULL ORDER BY value"
     ).fetchall()
     categories = [r[0] for r in rows if not r[0].isascii()]
-    return _json_response({"categories": categories})
+    return _json_response({"categories": categories})[2]
 
 
 # --- 録画ルール API ---
 
 def get_rules(_params):
     """GET /api/rules - 録画ルール一覧"""
-    conn = _get_db(AUTOREC_DB)
+    conn = _read_db(AUTOREC_DB)
     rows = conn.execute("SELECT * FROM rule ORDER BY priority DESC, id").fetchall()
     return _json_response({"rules": [dict(r) for r in rows]})
 
@@ -230,31 +655,30 @@ def create_rule(body):
     if not data.get("name"):
         return _error("name is required")
 
-    conn = _get_db(AUTOREC_DB)
-    cursor = conn.execute(
-        """INSERT INTO rule (name, keyword, channel, category, time_from, time_to, weekdays, enabled, priority)
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (
-            data["name"],
-            data.get("keyword"),
-            data.get("channel"),
-            data.get("category"),
-            data.get("time_from"),
-            data.get("time_to"),
-            data.get("weekdays"),
-            data.get("enabled", 1),
-            data.get("priority", 0),
-        ),
-    )
-    conn.commit()
+    with writing(AUTOREC_DB) as conn:
+        cursor = conn.execute(
+            """INSERT INTO rule (name, keyword, channel, category, time_from, time_to, weekdays, enabled, priority)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                data["name"],
+                data.get("keyword"),
+                data.get("channel"),
+                data.get("category"),
+                data.get("time_from"),
+                data.get("time_to"),
+                data.get("weekdays"),
+                data.get("enabled", 1),
+                data.get("priority", 0),
+            ),
+        )
 
-    # crontab 再生成 (非同期)
+    # ルール照合 (非同期, 終わると録画スケジューラに通知される)
     script = os.path.join(AUTOREC_DIR, "bin", "schedule-update.sh")
     if os.path.exists(script):
         subprocess.Popen(["bash", script], cwd=AUTOREC_DIR)
 
     rule_id = cursor.lastrowid
-    row = conn.execute("SELECT * FROM rule WHERE id = ?", (rule_id,)).fetchone()
+    row = _read_db(AUTOREC_DB).execute("SELECT * FROM rule WHERE id = ?", (rule_id,)).fetchone()
     return _json_response({"rule": dict(row)}, 201)
 
 
@@ -264,11 +688,6 @@ def update_rule(rule_id, body):
     if not data:
         return _error("Invalid JSON body")
 
-    conn = _get_db(AUTOREC_DB)
-    existing = conn.execute("SELECT * FROM rule WHERE id = ?", (rule_id,)).fetchone()
-    if not existing:
-        return _error("Rule not found", 404)
-
     fields = ["name", "keyword", "channel", "category", "time_from", "time_to", "weekdays", "enabled", "priority"]
     updates = []
     args = []
@@ -277,27 +696,36 @@ def update_rule(rule_id, body):
             updates.append(f"{f} = ?")
             args.append(data[f])
 
-    if not updates:
-        return _error("No fields to update")
+    with writing(AUTOREC_DB) as conn:
+        existing = conn.execute("SELECT * FROM rule WHERE id = ?", (rule_id,)).fetchone()
+        if not existing:
+            return _error("Rule not found", 404)
+        if not updates:
+            return _error("No fields to update")
 
-    args.append(rule_id)
-    conn.execute(f"UPDATE rule SET {', '.join(updates)} WHERE id = ?", args)
+        args.append(rule_id)
+        conn.execute(f"UPDATE rule SET {', '.join(updates)} WHERE id = ?", args)
 
-    # ルール無効化時は紐付く予定も取り消し
-    cancelled = 0
-    if data.get("enabled") == 0:
-        cancelled = conn.execute(
-            "DELETE FROM schedule WHERE rule_id = ? AND status = 'scheduled'", (rule_id,)
-        ).rowcount
+        # 次回の照合で全番組と照合し直す
+        conn.execute("DELETE FROM rule_match WHERE rule_id = ?", (rule_id,))
 
-    conn.commit()
+        # ルール無効化時は紐付く予定も取り消し
+        cancelled = 0
+        if data.get("enabled") == 0:
+            cancelled = conn.execute(
+                "DELETE FROM schedule WHERE rule_id = ? AND status IN ('scheduled', 'conflict')",
+                (rule_id,)
+            ).rowcount
+
+    if cancelled:
+        resolve_schedules()  # 空いた枠に conflict の予定を戻す
 
-    # crontab 再生成 (非同期)
+    # ルール照合 (非同期, 終わると録画スケジューラに通知される)
     script = os.path.join(AUTOREC_DIR, "bin", "schedule-update.sh")
     if os.path.exists(script):
         subprocess.Popen(["bash", script], cwd=AUTOREC_DIR)
 
-    row = conn.execute("SELECT * FROM rule WHERE id = ?", (rule_id,)).fetchone()
+    row = _read_db(AUTOREC_DB).execute("SELECT * FROM rule WHERE id = ?", (rule_id,)).fetchone()
     result = {"rule": dict(row)}
     if cancelled:
         result["cancelled_schedules"] = cancelled
@@ -306,15 +734,18 @@ def update_rule(rule_id, body):
 
 def delete_rule(rule_id):
     """DELETE /api/rules/:id - ルール削除 (紐付く予定も取り消し)"""
-    conn = _get_db(AUTOREC_DB)
-    existing = conn.execute("SELECT * FROM rule WHERE id = ?", (rule_id,)).fetchone()
-    if not existing:
-        return _error("Rule not found", 404)
-    cancelled = conn.execute(
-        "DELETE FROM schedule WHERE rule_id = ? AND status = 'scheduled'", (rule_id,)
-    ).rowcount
-    conn.execute("DELETE FROM rule WHERE id = ?", (rule_id,))
-    conn.commit()
+    with writing(AUTOREC_DB) as conn:
+        existing = conn.execute("SELECT * FROM rule WHERE id = ?", (rule_id,)).fetchone()
+        if not existing:
+            return _error("Rule not found", 404)
+        cancelled = conn.execute(
+            "DELETE FROM schedule WHERE rule_id = ? AND status IN ('scheduled', 'conflict')",
+            (rule_id,)
+        ).rowcount
+        conn.execute("DELETE FROM rule WHERE id = ?", (rule_id,))
+        conn.execute("DELETE FROM rule_match WHERE rule_id = ?", (rule_id,))
+    if cancelled:
+        resolve_schedules()  # 空いた枠に conflict の予定を戻す
     return _json_response({"deleted": rule_id, "cancelled_schedules": cancelled})
 
 
@@ -334,7 +765,7 @@ def get_schedules(params):
 
     where = "WHERE " + " AND ".join(conditions) if conditions else ""
 
-    conn = _get_db(AUTOREC_DB)
+    conn = _read_db(AUTOREC_DB)
     rows = conn.execute(
         f"""SELECT s.*, r.name as rule_name
             FROM schedule s
@@ -347,14 +778,47 @@ def get_schedules(params):
     total = conn.execute(
         f"SELECT COUNT(*) FROM schedule s {where}", args
     ).fetchone()[0]
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conflicts = conn.execute(
+        "SELECT COUNT(*) FROM schedule WHERE status = 'conflict' AND end_time > ?", (now,)
+    ).fetchone()[0]
+    schedules = [dict(r) for r in rows]
+    if any(s["status"] == "conflict" for s in schedules):
+        _add_conflict_with(conn, schedules)
     return _json_response({
-        "schedules": [dict(r) for r in rows],
+        "schedules": schedules,
         "total": total,
+        "conflicts": conflicts,
         "limit": limit,
         "offset": offset,
     })
 
 
+def _add_conflict_with(conn, schedules):
+    """conflict の予定に、同じ系統のチューナーを塞いでいる予定の id (conflict_with) を付ける"""
+    import epg_update  # epg_update が api を import するため遅延 import
+    numbers = {name: number for number, name in _get_valid_channels().items()}
+    # 録画の前後 (START_OFFSET + RECORD_PREWARM_SECONDS 前から END_OFFSET 後まで) も重なりに数える
+    margin = timedelta(seconds=START_OFFSET + RECORD_PREWARM_SECONDS + END_OFFSET)
+    for s in schedules:
+        if s["status"] != "conflict":
+            continue
+        try:
+            until = (datetime.fromisoformat(s["end_time"]) + margin).strftime("%Y-%m-%d %H:%M:%S")
+            since = (datetime.fromisoformat(s["start_time"]) - margin).strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            continue
+        group = epg_update.schedule_group(s["channel"], numbers)
+        s["conflict_with"] = [
+            r["id"] for r in conn.execute(
+                "SELECT id, channel FROM schedule WHERE status IN ('scheduled', 'recording') "
+                "AND start_time < ? AND end_time > ? ORDER BY start_time",
+                (until, since),
+            )
+            if epg_update.schedule_group(r["channel"], numbers) == group
+        ]
+
+
 def create_schedule(body):
     """POST /api/schedules - 番組表から直接録画予定を追加"""
     data = _parse_json_body(body)
@@ -365,28 +829,31 @@ def create_schedule(body):
         if not data.get(field):
             return _error(f"{field} is required")
 
-    conn = _get_db(AUTOREC_DB)
-    dup = conn.execute(
-        "SELECT id FROM schedule WHERE event_id = ? AND channel = ? AND status IN ('scheduled','recording','done')",
-        (data["event_id"], data["channel"]),
-    ).fetchone()
-    if dup:
-        return _error("この番組は既に録画予定に登録されています", 409)
-
-    cursor = conn.execute(
-        """INSERT INTO schedule (event_id, channel, title, start_time, end_time, rule_id, status)
-           VALUES (?, ?, ?, ?, ?, NULL, 'scheduled')""",
-        (data["event_id"], data["channel"], data["title"], data["start_time"], data["end_time"]),
-    )
-    conn.commit()
+    with writing(AUTOREC_DB) as conn:
+        dup = conn.execute(
+            "SELECT id FROM schedule WHERE event_id = ? AND channel = ? "
+            "AND status IN ('scheduled','conflict','recording','done')",
+            (data["event_id"], data["channel"]),
+        ).fetchone()
+        if dup:
+            return _error("この番組は既に録画予定に登録されています", 409)
+
+        cursor = conn.execute(
+            """INSERT INTO schedule (event_id, channel, title, start_time, end_time, rule_id, status)
+               VALUES (?, ?, ?, ?, ?, NULL, 'scheduled')""",
+            (data["event_id"], data["channel"], data["title"], data["start_time"], data["end_time"]),
+        )
     schedule_id = cursor.lastrowid
+    resolve_schedules()  # チューナーが足りなければ優先度の低い予定が conflict になる
 
-    # crontab 再生成 (非同期)
+    # ルール照合 (非同期, 終わると録画スケジューラに通知される)
     script = os.path.join(AUTOREC_DIR, "bin", "schedule-update.sh")
     if os.path.exists(script):
         subprocess.Popen(["bash", script], cwd=AUTOREC_DIR)
 
-    row = conn.execute("SELECT * FROM schedule WHERE id = ?", (schedule_id,)).fetchone()
+    row = _read_db(AUTOREC_DB).execute(
+        "SELECT * FROM schedule WHERE id = ?", (schedule_id,)
+    ).fetchone()
     return _json_response({"schedule": dict(row)}, 201)
 
 
@@ -410,7 +877,7 @@ def get_logs(params):
 
     where = "WHERE " + " AND ".join(conditions) if conditions else ""
 
-    conn = _get_db(AUTOREC_DB)
+    conn = _read_db(AUTOREC_DB)
     rows = conn.execute(
         f"""SELECT l.*, s.title as schedule_title, s.channel as schedule_channel
             FROM log l
@@ -465,8 +932,12 @@ def _get_valid_channels():
     return result
 
 
-def register_live_stream(channel_num, channel_name, pid, rec_ref=None):
-    """登録成功時 stream_id を返す。上限超過時は None"""
+def register_live_stream(channel_num, channel_name, pid, rec_ref=None, relay_stats=None):
+    """チューナーを登録。成功時 stream_id を返す。上限超過時は None
+
+    上限は起動中の recpt1 (= 使用チューナー) 数に対して適用し、
+    同じチューナーを共有する視聴者は画質を問わず add_live_subscriber() で別途数える。
+    """
     with _live_lock:
         if len(_live_streams) >= MAX_LIVE_STREAMS:
             return None
@@ -476,7 +947,9 @@ def register_live_stream(channel_num, channel_name, pid, rec_ref=None):
             "channel_name": channel_name,
             "pid": pid,
             "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "subscribers": {},
             "_rec_ref": rec_ref,
+            "_relay_stats": relay_stats,
         }
         return stream_id
 
@@ -487,16 +960,57 @@ def unregister_live_stream(stream_id):
         _live_streams.pop(stream_id, None)
 
 
+_live_subscriber_seq = 0
+
+
+def add_live_subscriber(stream_id, client, quality=None, rewind=None):
+    """視聴者を登録し subscriber_id を返す。ストリームが無ければ None
+
+    rewind はタイムシフト再生の視聴者の場合の巻き戻し秒数。
+    """
+    global _live_subscriber_seq
+    with _live_lock:
+        info = _live_streams.get(stream_id)
+        if info is None:
+            return None
+        _live_subscriber_seq += 1
+        sub_id = _live_subscriber_seq
+        info["subscribers"][sub_id] = {
+            "client": client,
+            "quality": quality,
+            "rewind": rewind,
+            "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        return sub_id
+
+
+def remove_live_subscriber(stream_id, sub_id):
+    """視聴者の登録解除"""
+    with _live_lock:
+        info = _live_streams.get(stream_id)
+        if info is not None:
+            info["subscribers"].pop(sub_id, None)
+
+
 def get_live_status(_params):
-    """GET /api/live/status"""
+    """GET /api/live/status - 使用チューナーと視聴者数"""
     with _live_lock:
         streams = []
+        total_subscribers = 0
         for sid, info in _live_streams.items():
             s = {"stream_id": sid}
             for k, v in info.items():
-                if k == "_rec_ref":
+                if k in ("_rec_ref", "_relay_stats", "subscribers"):
                     continue
                 s[k] = v
+            subscribers = [
+                {"subscriber_id": sub_id, **sub}
+                for sub_id, sub in info["subscribers"].items()
+            ]
+            s["subscribers"] = subscribers
+            s["encoders"] = sorted({sub["quality"] for sub in subscribers if sub["quality"]})
+            s["subscriber_count"] = len(subscribers)
+            total_subscribers += len(subscribers)
             rec_ref = info.get("_rec_ref")
             if rec_ref:
                 s["recording"] = rec_ref.get("file") is not None
@@ -504,10 +1018,16 @@ def get_live_status(_params):
             else:
                 s["recording"] = False
                 s["recording_path"] = None
+            timeshift = rec_ref.get("timeshift") if rec_ref else None
+            s["timeshift"] = timeshift.info() if timeshift else None
+            relay_stats = info.get("_relay_stats")
+            s["relay"] = dict(relay_stats) if relay_stats else None
             streams.append(s)
     return _json_response({
         "active_streams": len(streams),
         "max_streams": MAX_LIVE_STREAMS,
+        "tuners": {"active": len(streams), "max": MAX_LIVE_STREAMS},
+        "subscribers": total_subscribers,
         "streams": streams,
     })
 
@@ -518,7 +1038,7 @@ def get_now_playing(params):
     if not channel:
         return _error("channel parameter is required")
 
-    conn = _get_db(EPG_DB)
+    conn = _read_db(EPG_DB)
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     row = conn.execute(
         "SELECT event_id, channel, title, start_time, end_time, category FROM programme "
@@ -534,7 +1054,7 @@ def get_now_playing(params):
 
 def get_now_playing_all(_params):
     """GET /api/live/now-all - 全チャンネルの放送中番組"""
-    conn = _get_db(EPG_DB)
+    conn = _read_db(EPG_DB)
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     rows = conn.execute(
         "SELECT event_id, channel, title, description, start_time, end_time, category FROM programme "
@@ -595,6 +1115,16 @@ def start_live_recording(body):
     if rec_ref.get("file") is not None:
         return _error("既に録画中です", 409)
 
+    # タイムシフトバッファに残っている分から録画 (秒数, 任意)
+    rewind = data.get("rewind") or 0
+    if not isinstance(rewind, (int, float)) or rewind < 0:
+        return _error("rewind must be a non-negative number of seconds")
+    if rewind:
+        timeshift = rec_ref.get("timeshift")
+        if timeshift is None:
+            return _error("タイムシフトバッファが無効です", 409)
+        rewind = min(rewind, timeshift.seconds_available())
+
     # 保存先ディレクトリ作成
     output_dir = os.path.join(RECORD_DIR, "ライブ録画")
     os.makedirs(output_dir, exist_ok=True)
@@ -606,10 +1136,14 @@ def start_live_recording(body):
 
     try:
         rec_ref["path"] = output_path
+        if rewind:
+            # relay スレッドがファイルを見つけた時点でバッファ分を先に書き出す
+            rec_ref["rewind"] = rewind
         rec_ref["file"] = open(output_path, "wb")
     except Exception as e:
         rec_ref["file"] = None
         rec_ref["path"] = None
+        rec_ref.pop("rewind", None)
         return _error(f"ファイルの作成に失敗しました: {e}", 500)
 
     # 実況コメント保存 (対応チャンネルのみ)
@@ -629,7 +1163,7 @@ def start_live_recording(body):
     rec_ref["jikkyo_proc"] = jikkyo_proc
 
     rel_path = f"ライブ録画/{filename}"
-    return _json_response({"status": "recording", "path": rel_path})
+    return _json_response({"status": "recording", "path": rel_path, "rewind": rewind})
 
 
 def stop_live_recording(body):
@@ -675,6 +1209,9 @@ def stop_live_recording(body):
 
     rel_path = None
     if saved_path:
+        update_recording(saved_path)
+        # 再生時に待たないようメタデータを先に計算しておく
+        threading.Thread(target=_warm_recording_meta, args=(saved_path,), daemon=True).start()
         try:
             rel_path = os.path.relpath(saved_path, RECORD_DIR)
         except ValueError:
@@ -683,197 +1220,395 @@ def stop_live_recording(body):
     return _json_response({"status": "stopped", "path": rel_path})
 
 
-def _extract_ts_start_time(filepath):
-    """MPEG-TS ファイルの先頭付近から TDT を読み取り、(unix_epoch, tdt_byte_offset) を返す
+def _probe_duration(file_path):
+    """ffprobe で再生時間 (秒) を取得。失敗時は例外"""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+         "-of", "json", file_path],
+        capture_output=True, text=True, timeout=10,
+    )
+    data = json.loads(result.stdout)
+    return float(data["format"]["duration"])
+
+
+def _compute_recording_meta(file_path):
+    """TS を直接解析してメタデータを求める (解析できなければ ffprobe)。失敗時は例外"""
+    meta = tsindex.probe(file_path)
+    if meta is not None:
+        return meta
+    duration = _probe_duration(file_path)
+    meta = {"duration": duration, "start_time": None, "end_time": None,
+            "tdt_epoch": None, "tdt_offset": None}
+    # TDT から録画開始時刻を取得 (TDT 位置分を補正)
+    try:
+        tdt_result = tsindex.first_tdt(file_path)
+        if tdt_result:
+            tdt_epoch, tdt_byte_offset = tdt_result
+            # TDT はファイル先頭ではなく数秒後にある。
+            # シーク索引があればキーフレーム位置から、なければバイト比で時間に換算して差し引く
+            index = tsindex.load_seek_index(file_path)
+            file_size = os.path.getsize(file_path)
+            if index is not None and len(index):
+                tdt_time_offset = index.time_at(tdt_byte_offset)
+            elif file_size > 0 and duration > 0:
+                tdt_time_offset = (tdt_byte_offset / file_size) * duration
+            else:
+                tdt_time_offset = 0
+            meta.update(
+                start_time=tdt_epoch - tdt_time_offset,
+                end_time=tdt_epoch - tdt_time_offset + duration,
+                tdt_epoch=tdt_epoch, tdt_offset=tdt_byte_offset,
+            )
+    except (OSError, ValueError):
+        pass
+    return meta
+
+
+def get_recording_meta(file_path):
+    """録画ファイルのメタデータ (キャッシュがなければ計算して保存)。失敗時は例外"""
+    st = os.stat(file_path)
+    rel_path = os.path.relpath(file_path, os.path.realpath(RECORD_DIR))
+    row = _read_db(AUTOREC_DB).execute(
+        "SELECT duration, start_time, end_time, tdt_epoch, tdt_offset FROM recording_meta "
+        "WHERE path = ? AND size = ? AND mtime = ?",
+        (rel_path, st.st_size, st.st_mtime),
+    ).fetchone()
+    if row is not None:
+        return dict(row)
+    meta = _compute_recording_meta(file_path)
+    with writing(AUTOREC_DB) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO recording_meta "
+            "(path, size, mtime, duration, start_time, end_time, tdt_epoch, tdt_offset) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (rel_path, st.st_size, st.st_mtime, meta["duration"], meta["start_time"],
+             meta["end_time"], meta["tdt_epoch"], meta["tdt_offset"]),
+        )
+    return meta
 
-    tdt_byte_offset はファイル先頭から TDT パケットまでのバイト数。
-    ファイルサイズと再生時間から TDT の時間位置を補正するために使う。
-    """
-    TS_PACKET_SIZE = 188
-    TDT_PID = 0x0014
-    MAX_READ = 10 * 1024 * 1024  # 先頭 10MB のみスキャン
-
-    with open(filepath, 'rb') as f:
-        buf = f.read(MAX_READ)
-
-    buf_len = len(buf)
-
-    # sync byte (0x47) を確実に見つける: 3 連続パケットの sync を確認
-    start = -1
-    for i in range(min(buf_len - TS_PACKET_SIZE * 3, TS_PACKET_SIZE)):
-        if (buf[i] == 0x47
-                and buf[i + TS_PACKET_SIZE] == 0x47
-                and buf[i + TS_PACKET_SIZE * 2] == 0x47):
-            start = i
-            break
-    if start < 0:
+
+def get_seek_index(file_path):
+    """録画のシーク索引 (なければ作成)。録画中のファイルや TS として読めなければ None"""
+    index = tsindex.load_seek_index(file_path)
+    if index is not None:
+        return index
+    try:
+        if time.time() - os.path.getmtime(file_path) < RECORDING_SETTLE_SECONDS:
+            return None  # 録画中は索引がすぐ古くなるので作らない
+        return tsindex.build_seek_index(file_path)
+    except (OSError, ValueError):
         return None
 
-    pos = start
-    while pos + TS_PACKET_SIZE <= buf_len:
-        if buf[pos] != 0x47:
-            pos += 1
-            continue
 
-        pid = ((buf[pos + 1] & 0x1F) << 8) | buf[pos + 2]
-        if pid != TDT_PID:
-            pos += TS_PACKET_SIZE
-            continue
+def recording_input(file_path, seconds):
+    """録画を seconds 秒目から読む ffmpeg の入力指定 → (引数, stdin に渡すファイル or None)
 
-        # adaptation field スキップ
-        afc = (buf[pos + 3] >> 4) & 0x03
-        if not (afc & 0x01):  # payload なし
-            pos += TS_PACKET_SIZE
-            continue
-        payload_start = pos + 4
-        if afc in (2, 3):  # adaptation field あり
-            af_len = buf[pos + 4]
-            payload_start = pos + 5 + af_len
-        if payload_start >= pos + TS_PACKET_SIZE:
-            pos += TS_PACKET_SIZE
-            continue
+    シーク索引があれば直前のキーフレームのバイト位置から stdin で読ませ、
+    端数だけ -ss で捨てる (長時間の録画でも先頭から探さない)。
+    stdin 用のファイルは呼び出し側が Popen の後に閉じる。
+    """
+    index = get_seek_index(file_path) if seconds > 0 else None
+    found = index.lookup(seconds) if index is not None else None
+    if found is None:
+        args = ["-ss", str(seconds)] if seconds > 0 else []
+        return args + ["-i", file_path], None
+    offset, start = found
+    src = open(file_path, "rb")
+    src.seek(offset)
+    args = []
+    if seconds - start > 0.001:
+        args += ["-ss", f"{seconds - start:.3f}"]
+    return args + ["-f", "mpegts", "-i", "pipe:0"], src
 
-        # PUSI (payload_unit_start_indicator) チェック
-        pusi = (buf[pos + 1] >> 6) & 0x01
-        if pusi:
-            pointer = buf[payload_start]
-            section = payload_start + 1 + pointer
-        else:
-            section = payload_start
 
-        if section + 8 > pos + TS_PACKET_SIZE:
-            pos += TS_PACKET_SIZE
-            continue
+def _indexed_recording_meta(rel_path):
+    """録画一覧の索引と (size, mtime) が一致するキャッシュを返す (ファイルには触れない)"""
+    rel_path = os.path.normpath(rel_path)
+    if rel_path.startswith("..") or os.path.isabs(rel_path):
+        return None
+    conn = _read_db(AUTOREC_DB)
+    row = conn.execute(
+        "SELECT m.duration, m.start_time, m.end_time, m.tdt_epoch, m.tdt_offset "
+        "FROM recording_meta m JOIN recording r "
+        "ON r.path = m.path AND r.size = m.size AND r.mtime = m.mtime "
+        "WHERE m.path = ?",
+        (rel_path,),
+    ).fetchone()
+    return dict(row) if row is not None else None
 
-        table_id = buf[section]
-        if table_id not in (0x70, 0x73):  # TDT or TOT
-            pos += TS_PACKET_SIZE
-            continue
 
-        # UTC/JST time: 5 bytes (2 MJD + 3 BCD)
-        t = section + 3
-        mjd = (buf[t] << 8) | buf[t + 1]
-        hour = (buf[t + 2] >> 4) * 10 + (buf[t + 2] & 0x0F)
-        minute = (buf[t + 3] >> 4) * 10 + (buf[t + 3] & 0x0F)
-        second = (buf[t + 4] >> 4) * 10 + (buf[t + 4] & 0x0F)
+def _recording_meta_response(meta):
+    resp = {"duration": meta["duration"]}
+    # トランスコード配信のシーク単位 (セグメントキャッシュ有効時)
+    resp["segment_duration"] = HLS_SEGMENT_SECONDS if HLS_CACHE_MB > 0 else None
+    if meta["start_time"] is not None:
+        resp["start_time"] = meta["start_time"]
+    if meta["end_time"] is not None:
+        resp["end_time"] = meta["end_time"]
+    return resp
 
-        # MJD → Unix days (MJD of Unix epoch = 40587)
-        unix_days = mjd - 40587
-        # ARIB 規格では TDT は JST (UTC+9) なので 9時間引く
-        unix_epoch = unix_days * 86400 + hour * 3600 + minute * 60 + second - 9 * 3600
 
-        return unix_epoch, pos - start
+def _lookup_recording_meta(rel_path):
+    """相対パスのメタデータ → (status, レスポンス dict)"""
+    meta = _indexed_recording_meta(rel_path)
+    if meta is not None:
+        return 200, _recording_meta_response(meta)
 
-    return None
+    file_path = os.path.realpath(os.path.join(RECORD_DIR, rel_path))
+    record_dir_real = os.path.realpath(RECORD_DIR)
+    if not file_path.startswith(record_dir_real + os.sep) and file_path != record_dir_real:
+        return 403, {"error": "Forbidden"}
+
+    if not os.path.isfile(file_path):
+        return 404, {"error": "Not found"}
+
+    try:
+        return 200, _recording_meta_response(get_recording_meta(file_path))
+    except (OSError, KeyError, ValueError, json.JSONDecodeError,
+            subprocess.TimeoutExpired):
+        return 500, {"error": "Could not determine duration"}
 
 
 def get_recording_duration(params):
-    """GET /api/recordings/duration?path=<path> - ffprobe で再生時間を取得"""
+    """GET /api/recordings/duration?path=<path> - 再生時間と録画開始時刻 (キャッシュ済みなら即答)"""
     rel_path = params.get("path", [""])[0]
     if not rel_path:
         return _error("path parameter is required")
+    status, resp = _lookup_recording_meta(rel_path)
+    return _json_response(resp, status)
 
-    file_path = os.path.realpath(os.path.join(RECORD_DIR, rel_path))
-    record_dir_real = os.path.realpath(RECORD_DIR)
-    if not file_path.startswith(record_dir_real + os.sep) and file_path != record_dir_real:
-        return _error("Forbidden", 403)
 
-    if not os.path.isfile(file_path):
-        return _error("Not found", 404)
+def get_recordings_meta(params):
+    """GET /api/recordings/meta?path=<path>&path=<path>... - 複数ファイルのメタデータを一括取得"""
+    paths = params.get("path", [])
+    if not paths:
+        return _error("path parameter is required")
+    result = {}
+    for rel_path in paths:
+        _status, result[rel_path] = _lookup_recording_meta(rel_path)
+    return _json_response({"recordings": result})
+
+
+def get_transcode_status(_params):
+    """GET /api/transcode/status - リアルタイム変換の実行中ジョブと待ち行列"""
+    import transcode  # transcode が api を import するため遅延 import
+    return _json_response(transcode.scheduler.status())
+
+
+# --- 録画済みファイル API ---
+
+RECORDINGS_RESCAN_INTERVAL = 30  # 録画ディレクトリを照合し直す間隔 (秒)
+RECORDING_SETTLE_SECONDS = 60    # 照合時にこれより最近まで更新されていたファイルは次回も stat する
+_recordings_lock = threading.Lock()
+_recordings_checked = None
+
+
+def _recording_row(series, name, st, names, now):
+    """recording テーブルの 1 行分 (names はディレクトリ内のファイル名集合)"""
+    base_name = name.rsplit('.', 1)[0]
+    mp4_name = base_name + '.mp4'
+    return (
+        f"{series}/{name}", series, name, st.st_size, st.st_mtime,
+        int(base_name + '.nicojk' in names),
+        f"{series}/{mp4_name}" if mp4_name in names else None,
+        now,
+    )
+
 
+def _scan_series_dir(series, dir_path, now):
+    """シリーズディレクトリ 1 つ分を読み直す → recording テーブルの行のリスト"""
+    rows = []
     try:
-        result = subprocess.run(
-            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
-             "-of", "json", file_path],
-            capture_output=True, text=True, timeout=10,
+        with os.scandir(dir_path) as entries:
+            files = [e for e in entries if e.is_file(follow_symlinks=False)]
+    except OSError:
+        files = []
+    names = {e.name for e in files}
+    for f in files:
+        if not f.name.endswith(".ts"):
+            continue
+        try:
+            rows.append(_recording_row(series, f.name, f.stat(), names, now))
+        except OSError:
+            continue
+    return rows
+
+
+def update_recording(file_path):
+    """録画ファイル 1 つを索引に反映 (ライブ録画停止時など)"""
+    series_dir, name = os.path.split(file_path)
+    series = os.path.basename(series_dir)
+    try:
+        st = os.stat(file_path)
+        names = set(os.listdir(series_dir))
+    except OSError:
+        return
+    with writing(AUTOREC_DB) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO recording "
+            "(path, series, name, size, mtime, has_nicojk, transcoded, checked_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            _recording_row(series, name, st, names, time.time()),
         )
-        data = json.loads(result.stdout)
-        duration = float(data["format"]["duration"])
-        resp = {"duration": duration}
 
-        # TDT から録画開始時刻を取得 (TDT 位置分を補正)
-        try:
-            tdt_result = _extract_ts_start_time(file_path)
-            if tdt_result:
-                tdt_epoch, tdt_byte_offset = tdt_result
-                # TDT はファイル先頭ではなく数秒後にある。
-                # バイト位置から時間オフセットを推定して差し引く
-                file_size = os.path.getsize(file_path)
-                if file_size > 0 and duration > 0:
-                    tdt_time_offset = (tdt_byte_offset / file_size) * duration
-                else:
-                    tdt_time_offset = 0
-                resp["start_time"] = tdt_epoch - tdt_time_offset
-        except Exception:
-            pass
 
-        return _json_response(resp)
-    except (FileNotFoundError, KeyError, ValueError, json.JSONDecodeError,
-            subprocess.TimeoutExpired):
-        return _error("Could not determine duration", 500)
+def _warm_recording_meta(file_path):
+    try:
+        get_recording_meta(file_path)
+    except Exception:
+        pass
 
 
-# --- 録画済みファイル API ---
+def _reconcile_recordings(force=False):
+    """RECORD_DIR と recording テーブルの差分照合
 
-def get_recordings(_params):
-    """GET /api/recordings - 録画済みファイル一覧"""
-    series = []
-    if not os.path.isdir(RECORD_DIR):
-        return _json_response({"series": []})
+    mtime が変わったシリーズディレクトリだけを読み直し (ファイルの追加・削除・
+    .nicojk / .mp4 の生成はディレクトリの mtime に現れる)、
+    前回の照合時にまだ書き込み中だったファイルは個別に stat し直す。
+    """
+    global _recordings_checked
+    with _recordings_lock:
+        if not force and _recordings_checked is not None and \
+                time.monotonic() - _recordings_checked < RECORDINGS_RESCAN_INTERVAL:
+            return
+        # ディレクトリの走査・stat は書き込みのロックを取らずに行い、DB への反映だけまとめて書く
+        conn = _read_db(AUTOREC_DB)
+        now = time.time()
+        known = {row["name"]: row["mtime_ns"] for row in conn.execute("SELECT name, mtime_ns FROM recording_dir")}
+        seen = set()
+        rescanned = {}  # シリーズ → (mtime_ns, recording の行)
+        try:
+            with os.scandir(RECORD_DIR) as entries:
+                for entry in entries:
+                    if not entry.is_dir(follow_symlinks=False) or entry.name.startswith("."):
+                        continue
+                    try:
+                        # 走査前の mtime を記録 (走査中の変更は次回拾う)
+                        mtime_ns = entry.stat().st_mtime_ns
+                    except OSError:
+                        continue
+                    seen.add(entry.name)
+                    if known.get(entry.name) == mtime_ns:
+                        continue
+                    rescanned[entry.name] = (mtime_ns, _scan_series_dir(entry.name, entry.path, now))
+        except OSError:
+            pass
+        removed = set(known) - seen
+
+        growing = conn.execute(
+            "SELECT path, series FROM recording WHERE mtime >= checked_at - ? AND checked_at < ?",
+            (RECORDING_SETTLE_SECONDS, now),
+        ).fetchall()
+        gone = []
+        grown = []
+        for row in growing:
+            if row["series"] in rescanned or row["series"] in removed:
+                continue
+            try:
+                st = os.stat(os.path.join(RECORD_DIR, row["path"]))
+            except FileNotFoundError:
+                gone.append((row["path"],))
+                continue
+            except OSError:
+                continue
+            grown.append((st.st_size, st.st_mtime, now, row["path"]))
+
+        if rescanned or removed or gone or grown:
+            with writing(AUTOREC_DB) as conn:
+                for series, (mtime_ns, rows) in rescanned.items():
+                    conn.execute("DELETE FROM recording WHERE series = ?", (series,))
+                    conn.executemany(
+                        "INSERT INTO recording (path, series, name, size, mtime, has_nicojk, "
+                        "transcoded, checked_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        rows,
+                    )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO recording_dir (name, mtime_ns) VALUES (?, ?)",
+                        (series, mtime_ns),
+                    )
+                for name in removed:
+                    conn.execute("DELETE FROM recording WHERE series = ?", (name,))
+                    conn.execute("DELETE FROM recording_dir WHERE name = ?", (name,))
+                conn.executemany("DELETE FROM recording WHERE path = ?", gone)
+                conn.executemany(
+                    "UPDATE recording SET size = ?, mtime = ?, checked_at = ? WHERE path = ?",
+                    grown,
+                )
+        _recordings_checked = time.monotonic()
+
+
+_RECORDINGS_SORT = {"mtime": "max_mtime", "name": "series", "size": "total_size"}
+
+
+def get_recordings(params):
+    """GET /api/recordings - 録画済みファイル一覧 (シリーズ単位)
+
+    sort=mtime|name|size, order=desc|asc, q=シリーズ名・ファイル名の部分一致,
+    limit/offset はシリーズ数単位。refresh=1 で即座にディレクトリを照合する。
+    """
+    _reconcile_recordings(force=params.get("refresh", [""])[0] == "1")
 
+    sort = _RECORDINGS_SORT.get(params.get("sort", ["mtime"])[0], "max_mtime")
+    order = "ASC" if params.get("order", [""])[0] == "asc" else "DESC"
+    if sort == "series" and not params.get("order"):
+        order = "ASC"
     try:
-        with os.scandir(RECORD_DIR) as entries:
-            for entry in entries:
-                if not entry.is_dir(follow_symlinks=False):
-                    continue
-                files = []
-                total_size = 0
-                max_mtime = 0.0
-                try:
-                    with os.scandir(entry.path) as sub_entries:
-                        for f in sub_entries:
-                            if not f.is_file(follow_symlinks=False):
-                                continue
-                            if not f.name.endswith(".ts"):
-                                continue
-                            try:
-                                stat = f.stat()
-                                mtime = stat.st_mtime
-                                if mtime > max_mtime:
-                                    max_mtime = mtime
-                                nicojk_path = os.path.join(entry.path, f.name.rsplit('.', 1)[0] + '.nicojk')
-                                files.append({
-                                    "name": f.name,
-                                    "size": stat.st_size,
-                                    "mtime": datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S"),
-                                    "mtime_ts": mtime,
-                                    "path": f"{entry.name}/{f.name}",
-                                    "has_nicojk": os.path.isfile(nicojk_path),
-                                })
-                                total_size += stat.st_size
-                            except OSError:
-                                continue
-                except OSError:
-                    continue
-                if files:
-                    files.sort(key=lambda f: f["mtime_ts"], reverse=True)
-                    for f in files:
-                        del f["mtime_ts"]
-                    series.append({
-                        "name": entry.name,
-                        "file_count": len(files),
-                        "total_size": total_size,
-                        "max_mtime": max_mtime,
-                        "files": files,
-                    })
-    except OSError:
-        return _json_response({"series": []})
+        limit = int(params.get("limit", ["-1"])[0])
+        offset = int(params.get("offset", ["0"])[0])
+    except ValueError:
+        return _error("limit and offset must be integers")
+
+    where = ""
+    args = []
+    query = params.get("q", [""])[0]
+    if query:
+        where = "WHERE series LIKE ? OR name LIKE ?"
+        args = [f"%{query}%", f"%{query}%"]
 
-    series.sort(key=lambda s: s["max_mtime"], reverse=True)
-    for s in series:
-        del s["max_mtime"]
+    conn = _read_db(AUTOREC_DB)
+    total = conn.execute(
+        f"SELECT COUNT(DISTINCT series) FROM recording {where}", args
+    ).fetchone()[0]
+    series_rows = conn.execute(
+        f"""SELECT series, COUNT(*) AS file_count, SUM(size) AS total_size, MAX(mtime) AS max_mtime
+            FROM recording {where}
+            GROUP BY series ORDER BY {sort} {order}, series LIMIT ? OFFSET ?""",
+        args + [limit, offset],
+    ).fetchall()
 
-    return _json_response({"series": series})
+    series = []
+    by_name = {}
+    for row in series_rows:
+        entry = {
+            "name": row["series"],
+            "file_count": row["file_count"],
+            "total_size": row["total_size"],
+            "files": [],
+        }
+        series.append(entry)
+        by_name[row["series"]] = entry
+    if by_name:
+        placeholders = ",".join("?" * len(by_name))
+        file_where = f"series IN ({placeholders})"
+        file_args = list(by_name)
+        if query:
+            # シリーズ名が一致しないシリーズは一致したファイルだけ返す
+            file_where += " AND (series LIKE ? OR name LIKE ?)"
+            file_args += args
+        for row in conn.execute(
+            f"SELECT * FROM recording WHERE {file_where} ORDER BY mtime DESC", file_args
+        ):
+            by_name[row["series"]]["files"].append({
+                "name": row["name"],
+                "size": row["size"],
+                "mtime": datetime.fromtimestamp(row["mtime"]).strftime("%Y-%m-%d %H:%M:%S"),
+                "path": row["path"],
+                "has_nicojk": bool(row["has_nicojk"]),
+                # 録画後トランスコード済みなら直接再生できる MP4
+                "transcoded": row["transcoded"],
+            })
+
+    return _json_response({"series": series, "total": total})
 
 
 # --- NX-Jikkyo プロキシ ---
@@ -940,71 +1675,212 @@ def get_jikkyo_force(_params):
     return _json_response(result)
 
 
+# --- サーバー API ---
+
+def get_route_stats(_params):
+    """GET /api/server/routes - ルートごとの件数・処理時間"""
+    with _stats_lock:
+        routes = [route.stats() for route in _routes]
+    routes.sort(key=lambda r: r["total_ms"], reverse=True)
+    return _json_response({"routes": routes})
+
+
+def get_db_stats(_params):
+    """GET /api/server/db - SQLite 接続プールの統計"""
+    with _conn_lock:
+        stats = dict(_pool_stats)
+        stats["idle_readers"] = {os.path.basename(path): len(idle)
+                                 for path, idle in _idle_readers.items()}
+    stats["write_wait_seconds"] = round(stats["write_wait_seconds"], 3)
+    return _json_response(stats)
+
+
 # --- ルーティング ---
+#
+# (メソッド, パスのテンプレート, ハンドラ, ハンドラに渡すもの) の表を import 時にコンパイルする。
+# パス引数 ({name} / {name:int}) はハンドラの先頭の引数になり、その後に
+# "params" ならクエリ、"body" ならリクエストボディ、None なら何も渡さない。
+# 固定のパスは dict、パス引数のあるものはメソッドごとの木で引く。
 
-def handle_request(method, path, params, body=b""):
-    """API リクエストのルーティング"""
+ROUTES = [
     # 番組表
-    if method == "GET" and path == "/api/programmes":
-        return get_programmes(params)
-    if method == "GET" and path == "/api/programmes/search":
-        return search_programmes(params)
-    if method == "GET" and path == "/api/programmes/stats":
-        return get_programme_stats(params)
-    if method == "GET" and path == "/api/categories":
-        return get_categories(params)
-
+    ("GET", "/api/programmes", get_programmes, "params"),
+    ("GET", "/api/programmes/grid", get_programme_grid, "params"),
+    ("GET", "/api/programmes/detail", get_programme_detail, "params"),
+    ("GET", "/api/programmes/search", search_programmes, "params"),
+    ("GET", "/api/programmes/stats", get_programme_stats, "params"),
+    ("GET", "/api/categories", get_categories, "params"),
     # ルール
-    if method == "GET" and path == "/api/rules":
-        return get_rules(params)
-    if method == "POST" and path == "/api/rules":
-        return create_rule(body)
-    if method == "PUT" and path.startswith("/api/rules/"):
-        rule_id = int(path.split("/")[-1])
-        return update_rule(rule_id, body)
-    if method == "DELETE" and path.startswith("/api/rules/"):
-        rule_id = int(path.split("/")[-1])
-        return delete_rule(rule_id)
-
+    ("GET", "/api/rules", get_rules, "params"),
+    ("POST", "/api/rules", create_rule, "body"),
+    ("PUT", "/api/rules/{rule_id:int}", update_rule, "body"),
+    ("DELETE", "/api/rules/{rule_id:int}", delete_rule, None),
     # スケジュール
-    if method == "GET" and path == "/api/schedules":
-        return get_schedules(params)
-    if method == "POST" and path == "/api/schedules":
-        return create_schedule(body)
-
+    ("GET", "/api/schedules", get_schedules, "params"),
+    ("POST", "/api/schedules", create_schedule, "body"),
     # ログ
-    if method == "GET" and path == "/api/logs":
-        return get_logs(params)
-
+    ("GET", "/api/logs", get_logs, "params"),
     # チャンネル
-    if method == "GET" and path == "/api/channels":
-        return get_channels(params)
-
+    ("GET", "/api/channels", get_channels, "params"),
     # ライブ視聴
-    if method == "GET" and path == "/api/live/status":
-        return get_live_status(params)
-    if method == "GET" and path == "/api/live/now":
-        return get_now_playing(params)
-    if method == "GET" and path == "/api/live/now-all":
-        return get_now_playing_all(params)
-
+    ("GET", "/api/live/status", get_live_status, "params"),
+    ("GET", "/api/live/now", get_now_playing, "params"),
+    ("GET", "/api/live/now-all", get_now_playing_all, "params"),
     # ライブ録画
-    if method == "POST" and path == "/api/live/record/start":
-        return start_live_recording(body)
-    if method == "POST" and path == "/api/live/record/stop":
-        return stop_live_recording(body)
-
+    ("POST", "/api/live/record/start", start_live_recording, "body"),
+    ("POST", "/api/live/record/stop", stop_live_recording, "body"),
     # 録画済みファイル
-    if method == "GET" and path == "/api/recordings":
-        return get_recordings(params)
-    if method == "GET" and path == "/api/recordings/duration":
-        return get_recording_duration(params)
-
+    ("GET", "/api/recordings", get_recordings, "params"),
+    ("GET", "/api/recordings/duration", get_recording_duration, "params"),
+    ("GET", "/api/recordings/meta", get_recordings_meta, "params"),
+    ("GET", "/api/transcode/status", get_transcode_status, "params"),
     # NX-Jikkyo プロキシ
-    if method == "GET" and path == "/api/jikkyo/force":
-        return get_jikkyo_force(params)
-    if method == "GET" and path.startswith("/api/jikkyo/channels/"):
-        jk_id = path.split("/")[-1]
-        return proxy_jikkyo_channel(jk_id)
+    ("GET", "/api/jikkyo/force", get_jikkyo_force, "params"),
+    ("GET", "/api/jikkyo/channels/{jk_id}", proxy_jikkyo_channel, None),
+    # サーバー
+    ("GET", "/api/server/routes", get_route_stats, "params"),
+    ("GET", "/api/server/db", get_db_stats, "params"),
+]
+
+_CONVERTERS = {"str": str, "int": int}
+
+
+class _Route:
+    """ルート 1 つとその処理時間の集計"""
+
+    def __init__(self, method, template, handler, takes):
+        self.method = method
+        self.template = template
+        self.handler = handler
+        self.takes = takes
+        self.count = 0
+        self.errors = 0       # 例外・5xx の件数
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def stats(self):
+        return {
+            "method": self.method,
+            "path": self.template,
+            "count": self.count,
+            "errors": self.errors,
+            "total_ms": round(self.total_seconds * 1000, 1),
+            "avg_ms": round(self.total_seconds * 1000 / self.count, 2) if self.count else None,
+            "max_ms": round(self.max_seconds * 1000, 1),
+        }
+
+
+class _Node:
+    """パス引数のあるルートの木 (セグメントごと。固定のセグメントを先に試す)"""
+
+    def __init__(self):
+        self.children = {}
+        self.param = None  # (引数名, 変換関数, _Node)
+        self.route = None
+
+
+_static_routes = {}  # (メソッド, パス) → _Route
+_param_routes = {}   # メソッド → _Node
+_routes = []
+_stats_lock = threading.Lock()
+_middleware = []
+
+
+def _compile_routes(routes):
+    for method, template, handler, takes in routes:
+        route = _Route(method, template, handler, takes)
+        _routes.append(route)
+        if "{" not in template:
+            _static_routes[(method, template)] = route
+            continue
+        node = _param_routes.setdefault(method, _Node())
+        for segment in template.strip("/").split("/"):
+            if segment.startswith("{") and segment.endswith("}"):
+                name, _, kind = segment[1:-1].partition(":")
+                if node.param is None:
+                    node.param = (name, _CONVERTERS[kind or "str"], _Node())
+                node = node.param[2]
+            else:
+                node = node.children.setdefault(segment, _Node())
+        node.route = route
+
+
+def _match(node, segments, args):
+    """木をたどって (ルート, パス引数) を返す。一致しなければ None"""
+    if not segments:
+        return (node.route, args) if node.route is not None else None
+    head, rest = segments[0], segments[1:]
+    child = node.children.get(head)
+    if child is not None:
+        found = _match(child, rest, args)
+        if found is not None:
+            return found
+    if node.param is not None and head:
+        _name, convert, child = node.param
+        try:
+            value = convert(head)
+        except ValueError:
+            return None
+        return _match(child, rest, args + [value])
+    return None
 
-    return _error("Not found", 404)
+
+def _lookup(method, path):
+    route = _static_routes.get((method, path))
+    if route is not None:
+        return route, []
+    root = _param_routes.get(method)
+    if root is None:
+        return None
+    return _match(root, path.strip("/").split("/"), [])
+
+
+def add_middleware(middleware):
+    """全ルート共通の処理を追加する
+
+    middleware(route, call) は call() (次の middleware またはハンドラ) を呼んで
+    レスポンスを返す。後から追加したものほど内側 (ハンドラ寄り) になる。
+    """
+    _middleware.append(middleware)
+
+
+def _timed(route, call):
+    """ルートごとの件数・処理時間を数える (いちばん外側の middleware)"""
+    started = time.perf_counter()
+    failed = True
+    try:
+        result = call()
+        failed = result[0] >= 500
+        return result
+    finally:
+        elapsed = time.perf_counter() - started
+        with _stats_lock:
+            route.count += 1
+            route.total_seconds += elapsed
+            route.max_seconds = max(route.max_seconds, elapsed)
+            if failed:
+                route.errors += 1
+
+
+add_middleware(_timed)
+_compile_routes(ROUTES)
+
+
+def handle_request(method, path, params, body=b""):
+    """API リクエストのルーティング
+
+    → (status, content_type, body) または追加のレスポンスヘッダを付けた
+    (status, content_type, body, {ヘッダ: 値})
+    """
+    found = _lookup(method, path)
+    if found is None:
+        return _error("Not found", 404)
+    route, args = found
+    if route.takes == "params":
+        args.append(params)
+    elif route.takes == "body":
+        args.append(body)
+    call = functools.partial(route.handler, *args)
+    for middleware in reversed(_middleware):
+        call = functools.partial(middleware, route, call)
+    return call()
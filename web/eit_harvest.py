@@ -0,0 +1,434 @@
+"""視聴中・録画中の TS から番組表を拾う (EIT p/f・schedule)
+
+ライブ視聴のタイムシフトバッファや録画中のファイルを後ろから追いかけ、
+EIT のセクションから番組 (event) を取り出して programme に反映する。
+EPG 受信用のチューナーを使わずに、長時間の録画中でも番組表を新しく保てる。
+
+- 対象は自ストリームの番組表 (p/f 0x4E, schedule 0x50〜0x5F) のうち
+  PAT の先頭サービス (channels.conf のチャンネル) の分だけ
+- 番組名・説明の文字列は ARIB STD-B24 の 8 単位符号をここで復号する
+- 既にある番組は開始・終了時刻が変わったときだけ更新する (番組名などは
+  epgdump で取り込んだものを正とする)。無い番組は追加する
+"""
+import threading
+import time
+
+import api
+import eit_scan
+import epg_ingest
+import tsindex
+
+PAT_PID = 0x0000
+EIT_PF_ACTUAL = 0x4E
+FLUSH_INTERVAL = 60.0   # DB へ書き込む間隔 (秒)
+FOLLOW_INTERVAL = 2.0   # 録画ファイルの追記を見に行く間隔 (秒)
+READ_SIZE = tsindex.TS_PACKET_SIZE * 4096
+
+GENRES = (
+    "ニュース／報道", "スポーツ", "情報／ワイドショー", "ドラマ", "音楽", "バラエティ",
+    "映画", "アニメ／特撮", "ドキュメンタリー／教養", "劇場／公演", "趣味／教育", "福祉",
+    None, None, None, "その他",
+)
+
+# --- ARIB STD-B24 8 単位符号 ---
+
+_KANJI = 0x42
+_ALNUM = 0x4A
+_HIRAGANA = 0x30
+_KATAKANA = 0x31
+_P_ALNUM = 0x36
+_P_HIRAGANA = 0x37
+_P_KATAKANA = 0x38
+_JIS_KANJI1 = 0x39
+_JIS_KANJI2 = 0x3A
+_SYMBOL = 0x3B
+_JIS_KATAKANA = 0x49
+_DRCS = 0x100      # 1 バイトの外字 (表示できないので読み飛ばす)
+_DRCS_TWO = 0x101  # 2 バイトの外字
+_TWO_BYTE = {_KANJI, _JIS_KANJI1, _JIS_KANJI2, _SYMBOL}
+
+_KANA_TAIL = "ゝゞー。「」、・"  # 平仮名・片仮名集合の 0x77〜0x7E
+_KATA_TAIL = "ヽヾー。「」、・"
+
+# 追加記号 (90 区 48 点〜) のうち番組名によく出るもの
+_SYMBOLS = {
+    0x7A50: "【HV】", 0x7A51: "【SD】", 0x7A52: "【Ｐ】", 0x7A53: "【Ｗ】", 0x7A54: "【MV】",
+    0x7A55: "【手】", 0x7A56: "【字】", 0x7A57: "【双】", 0x7A58: "【デ】", 0x7A59: "【Ｓ】",
+    0x7A5A: "【二】", 0x7A5B: "【多】", 0x7A5C: "【解】", 0x7A5D: "【SS】", 0x7A5E: "【Ｂ】",
+    0x7A5F: "【Ｎ】", 0x7A60: "■", 0x7A61: "●", 0x7A62: "【天】", 0x7A63: "【交】",
+    0x7A64: "【映】", 0x7A65: "【無】", 0x7A66: "【料】", 0x7A67: "【鍵】", 0x7A68: "【前】",
+    0x7A69: "【後】", 0x7A6A: "【再】", 0x7A6B: "【新】", 0x7A6C: "【初】", 0x7A6D: "【終】",
+    0x7A6E: "【生】", 0x7A6F: "【販】", 0x7A70: "【声】", 0x7A71: "【吹】", 0x7A72: "【PPV】",
+}
+
+# C0/C1 制御符号のうちパラメータを伴うもの → 読み飛ばすバイト数
+_CONTROL_PARAMS = {
+    0x16: 1,  # PAPF
+    0x1C: 2,  # APS
+    0x8B: 1,  # SZX
+    0x90: 1,  # COL (0x20 が続けばもう 1 バイト)
+    0x91: 1,  # FLC
+    0x92: 1,  # CDC (0x20 が続けばもう 1 バイト)
+    0x93: 1,  # POL
+    0x94: 1,  # WMM
+    0x95: 1,  # MACRO
+    0x97: 1,  # HLC
+    0x98: 1,  # RPC
+    0x9D: 2,  # TIME
+}
+
+
+def _char(charset, c1, c2, small):
+    """符号集合 charset の文字 (GL に揃えた c1, c2) → 文字列"""
+    if charset in (_ALNUM, _P_ALNUM):
+        return chr(c1) if small else chr(c1 + 0xFEE0)
+    if charset in (_HIRAGANA, _P_HIRAGANA):
+        return chr(0x3041 + c1 - 0x21) if c1 < 0x74 else (
+            _KANA_TAIL[c1 - 0x77] if c1 >= 0x77 else "")
+    if charset in (_KATAKANA, _P_KATAKANA):
+        return chr(0x30A1 + c1 - 0x21) if c1 < 0x77 else _KATA_TAIL[c1 - 0x77]
+    if charset == _JIS_KATAKANA:
+        return chr(0xFF61 + c1 - 0x21)
+    if charset in _TWO_BYTE:
+        code = (c1 << 8) | c2
+        if code in _SYMBOLS:
+            return _SYMBOLS[code]
+        if charset == _SYMBOL or c1 >= 0x75:  # 追加記号・外字の区
+            return "〓"
+        raw = bytes((c1 | 0x80, c2 | 0x80))
+        if charset == _JIS_KANJI2:
+            raw = b"\x8f" + raw
+        return raw.decode("euc_jis_2004", errors="replace")
+    return ""
+
+
+def decode_arib(data):
+    """ARIB STD-B24 の 8 単位符号 (EIT の番組名・説明) → str"""
+    g = [_KANJI, _ALNUM, _HIRAGANA, _KATAKANA]
+    gl, gr = 0, 2
+    single = None  # SS2/SS3 で 1 文字だけ呼び出す集合
+    small = False  # MSZ (中型) の間は英数を半角にする
+    out = []
+    i = 0
+    n = len(data)
+    while i < n:
+        b = data[i]
+        if b == 0x1B:  # ESC: 符号の指示・呼び出し
+            i += 1
+            if i >= n:
+                break
+            b = data[i]
+            if b == 0x6E:
+                gl = 2
+            elif b == 0x6F:
+                gl = 3
+            elif b == 0x7E:
+                gr = 1
+            elif b == 0x7D:
+                gr = 2
+            elif b == 0x7C:
+                gr = 3
+            elif 0x28 <= b <= 0x2B:  # 1 バイト集合を G0〜G3 へ
+                slot = b - 0x28
+                i += 1
+                if i < n and data[i] == 0x20:  # DRCS
+                    i += 1
+                    g[slot] = _DRCS
+                elif i < n:
+                    g[slot] = data[i]
+            elif b == 0x24:  # 2 バイト集合
+                i += 1
+                if i < n and 0x29 <= data[i] <= 0x2B:
+                    slot = data[i] - 0x28
+                    i += 1
+                elif i < n and data[i] == 0x28:
+                    slot = 0
+                    i += 1
+                else:
+                    slot = 0
+                if i < n and data[i] == 0x20:  # DRCS
+                    i += 1
+                    g[slot] = _DRCS_TWO
+                elif i < n:
+                    g[slot] = data[i]
+            i += 1
+            continue
+        if b == 0x0E:  # LS1
+            gl = 1
+        elif b == 0x0F:  # LS0
+            gl = 0
+        elif b == 0x19:  # SS2
+            single = 2
+        elif b == 0x1D:  # SS3
+            single = 3
+        elif b == 0x0D:
+            out.append("\n")
+        elif b == 0x20:
+            out.append(" " if small else "　")
+        elif b == 0x89:  # MSZ
+            small = True
+        elif b == 0x8A:  # NSZ
+            small = False
+        elif b in _CONTROL_PARAMS:
+            skip = _CONTROL_PARAMS[b]
+            if b in (0x90, 0x92) and i + 1 < n and data[i + 1] == 0x20:
+                skip += 1
+            i += skip
+        elif b == 0x9B:  # CSI: 終端文字 (0x40〜0x7E) まで読み飛ばす
+            i += 1
+            while i < n and not 0x40 <= data[i] <= 0x7E:
+                i += 1
+        elif 0x21 <= b <= 0x7E or 0xA1 <= b <= 0xFE:
+            slot = single if single is not None else (gl if b < 0x80 else gr)
+            single = None
+            charset = g[slot]
+            c1 = b & 0x7F
+            if charset in _TWO_BYTE or charset == _DRCS_TWO:
+                c2 = data[i + 1] & 0x7F if i + 1 < n else 0x21
+                i += 1
+                out.append(_char(charset, c1, c2, small))
+            else:
+                out.append(_char(charset, c1, 0, small))
+        i += 1
+    return "".join(out)
+
+
+# --- EIT ---
+
+def parse_events(section):
+    """EIT セクション → (table_id, service_id, [番組の dict, ...])
+
+    番組の dict は epg_ingest._programme と同じ引数名のキー (channel を除く) を持つ。
+    開始時刻・長さが未定 (0xFF...) の番組は含めない。
+    """
+    table_id = section[0]
+    sid = (section[3] << 8) | section[4]
+    events = []
+    pos = 14
+    end = len(section) - 4
+    while pos + 12 <= end:
+        event_id = (section[pos] << 8) | section[pos + 1]
+        undefined = section[pos + 2:pos + 7] == b"\xff" * 5 or \
+            section[pos + 7:pos + 10] == b"\xff" * 3
+        start = tsindex.arib_time(section, pos + 2)
+        duration = tsindex.bcd_seconds(section, pos + 7)
+        loop_end = pos + 12 + (((section[pos + 10] & 0x0F) << 8) | section[pos + 11])
+        title = description = None
+        genres = []
+        items = []
+        ext_text = b""
+        p = pos + 12
+        while p + 2 <= min(loop_end, end):
+            tag, length = section[p], section[p + 1]
+            body = section[p + 2:p + 2 + length]
+            if tag == 0x4D and len(body) >= 4:  # 短形式イベント
+                name_len = body[3]
+                title = decode_arib(body[4:4 + name_len])
+                text_len = body[4 + name_len] if 4 + name_len < len(body) else 0
+                description = decode_arib(body[5 + name_len:5 + name_len + text_len])
+            elif tag == 0x4E and len(body) >= 5:  # 拡張形式イベント (複数記述子にまたがる)
+                q = 5
+                items_end = min(5 + body[4], len(body))  # length_of_items が記述子を超えていれば切り詰める
+                while q < items_end:
+                    desc_len = body[q]
+                    if q + 2 + desc_len > items_end:
+                        break
+                    desc = body[q + 1:q + 1 + desc_len]
+                    item_len = body[q + 1 + desc_len]
+                    item = body[q + 2 + desc_len:q + 2 + desc_len + item_len]
+                    if desc or not items:
+                        items.append([desc, item])
+                    else:
+                        items[-1][1] += item  # 項目名が空 → 前の項目の続き
+                    q += 2 + desc_len + item_len
+                if items_end < len(body):
+                    ext_text += body[items_end + 1:items_end + 1 + body[items_end]]
+            elif tag == 0x54:  # コンテント (ジャンル)
+                for k in range(0, len(body) - 1, 2):
+                    name = GENRES[body[k] >> 4]
+                    if name and name not in genres:
+                        genres.append(name)
+            p += 2 + length
+        if title and not undefined:
+            extra = {}
+            if items:
+                extra["extdetail"] = [{"item_description": decode_arib(d), "item": decode_arib(v)}
+                                      for d, v in items]
+            if ext_text:
+                extra["exttext"] = decode_arib(ext_text)
+            events.append({
+                "event_id": event_id, "title": title, "description": description,
+                "start": start, "end": start + duration, "category": genres, "extra": extra,
+            })
+        pos = loop_end
+    return table_id, sid, events
+
+
+class EITHarvester:
+    """TS を順に読み、1 チャンネル分の番組をためて flush() で programme に反映する"""
+
+    def __init__(self, channel_name):
+        self.channel_name = channel_name
+        self.pat = eit_scan.SectionReader()
+        self.eit = eit_scan.SectionReader()
+        self.service_id = None   # PAT の先頭サービス
+        self.events = {}         # (service_id, event_id) → (table_id, 番組)
+        self.dirty = set()       # 前回の flush 以降に変わった (service_id, event_id)
+        self._seen = {}          # (table_id, service_id, section_number) → CRC
+        self._pending = b""
+
+    def feed(self, data):
+        """TS の断片 (パケット境界でなくてよい) を読む"""
+        buf = self._pending + data
+        first = tsindex.find_sync(buf)
+        if first < 0:
+            self._pending = buf[-tsindex.TS_PACKET_SIZE * 3:]
+            return
+        end = len(buf) - (len(buf) - first) % tsindex.TS_PACKET_SIZE
+        # PID ごとに iter_packets で絞り込む (PAT はサービスが分かるまで)
+        if self.service_id is None:
+            for pos in tsindex.iter_packets(buf, PAT_PID, first, end):
+                for section in self.pat.feed(buf, pos):
+                    self._add_pat(section)
+        for pos in tsindex.iter_packets(buf, eit_scan.EIT_PID, first, end):
+            for section in self.eit.feed(buf, pos):
+                self._add_eit(section)
+        self._pending = buf[end:]
+
+    def _add_pat(self, section):
+        if section[0] != 0x00 or eit_scan.crc32_mpeg(section) != 0:
+            return
+        programs = [(section[i] << 8) | section[i + 1] for i in range(8, len(section) - 4, 4)]
+        programs = [p for p in programs if p != 0]  # 0 は NIT
+        if programs:
+            self.service_id = min(programs)
+
+    def _add_eit(self, section):
+        table_id = section[0]
+        if not (table_id == EIT_PF_ACTUAL or 0x50 <= table_id <= 0x5F) or len(section) < 18:
+            return
+        key = (table_id, (section[3] << 8) | section[4], section[6])
+        crc = section[-4:]
+        if self._seen.get(key) == crc:  # 同じセクションの再送
+            return
+        if eit_scan.crc32_mpeg(section) != 0:
+            return
+        self._seen[key] = crc
+        _table_id, sid, events = parse_events(section)
+        for event in events:
+            event_key = (sid, event["event_id"])
+            current = self.events.get(event_key)
+            # p/f (現在・次の番組) の時刻の方が新しいので schedule で上書きしない
+            if current is not None and current[0] == EIT_PF_ACTUAL and table_id != EIT_PF_ACTUAL:
+                if current[1]["start"] == event["start"] and current[1]["end"] == event["end"]:
+                    continue
+                event = dict(event, start=current[1]["start"], end=current[1]["end"])
+            if current is None or current[1] != event:
+                self.events[event_key] = (table_id, event)
+                self.dirty.add(event_key)
+
+    def flush(self, conn=None):
+        """ためた番組を programme に反映 → {"inserted", "updated"}"""
+        sid = self.service_id
+        if sid is None and self.events:
+            sid = min(s for s, _e in self.events)
+        keys = [k for k in self.dirty if k[0] == sid]
+        self.dirty.difference_update(keys)
+        programmes = []
+        for key in keys:
+            e = self.events[key][1]
+            programmes.append(epg_ingest._programme(
+                e["event_id"], self.channel_name, e["title"], e["description"],
+                e["start"], e["end"], e["category"], e["extra"]))
+        return merge(programmes, conn)
+
+
+def merge(programmes, conn=None):
+    """番組を programme に反映 (既存の番組は時刻だけ更新) → {"inserted", "updated"}
+
+    conn を省略すると共有の書き込み用接続を api.writing() で順番に使う。
+    """
+    if not programmes:
+        return {"inserted": 0, "updated": 0}
+    if conn is None:
+        with api.writing(api.EPG_DB) as conn:
+            return merge(programmes, conn)
+    for prog in programmes:
+        prog["content_hash"] = epg_ingest.content_hash(prog)
+    with conn:
+        # 時刻が変わった既存の番組 (次に epgdump で取り込むときは内容を比べ直す)
+        updated = conn.executemany(
+            "UPDATE programme SET start_time = :start_time, end_time = :end_time, "
+            "content_hash = NULL, updated_at = datetime('now','localtime') "
+            "WHERE event_id = :event_id AND channel = :channel "
+            "AND (start_time != :start_time OR end_time != :end_time)",
+            programmes,
+        ).rowcount
+        inserted = conn.executemany(
+            "INSERT INTO programme (event_id, channel, title, description, start_time, "
+            "end_time, category, extra, content_hash) "
+            "SELECT :event_id, :channel, :title, :description, :start_time, :end_time, "
+            ":category, :extra, :content_hash "
+            "WHERE NOT EXISTS (SELECT 1 FROM programme "
+            "WHERE event_id = :event_id AND channel = :channel)",
+            programmes,
+        ).rowcount
+        if inserted or updated:
+            epg_ingest.bump_generation(conn)
+    return {"inserted": inserted, "updated": updated}
+
+
+def harvest_timeshift(ring, channel_name, stop_event):
+    """タイムシフトバッファを追いかけて番組表を拾う (ライブ視聴のセッションごとのスレッド)
+
+    relay スレッドとは別に動くので受信は止めない。追い越されたら最古位置から読み直す。
+    """
+    harvester = EITHarvester(channel_name)
+    offset = ring.oldest()
+    last_flush = time.monotonic()
+    try:
+        while not stop_event.is_set() and not ring.closed:
+            offset, data = ring.read_at(offset, READ_SIZE)
+            if data:
+                harvester.feed(data)
+            if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                harvester.flush()
+                last_flush = time.monotonic()
+        harvester.flush()
+    except Exception as e:  # 番組表の取り込みに失敗しても視聴は続ける
+        print(f"[eit-harvest] ch={channel_name}: {e}")
+
+
+def start_timeshift_harvest(ring, channel_name, stop_event):
+    thread = threading.Thread(
+        target=harvest_timeshift, args=(ring, channel_name, stop_event), daemon=True)
+    thread.start()
+    return thread
+
+
+def follow_file(path, channel_name, stop_event, conn=None):
+    """録画中のファイルを追いかけて番組表を拾う (stop_event が立ったら残りを読んで終わる)"""
+    harvester = EITHarvester(channel_name)
+    last_flush = time.monotonic()
+    total = {"inserted": 0, "updated": 0}
+
+    def flush():
+        for k, v in harvester.flush(conn).items():
+            total[k] += v
+
+    with open(path, "rb") as f:
+        while True:
+            stopping = stop_event.is_set()
+            while True:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                harvester.feed(data)
+            if stopping:
+                break
+            if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                flush()
+                last_flush = time.monotonic()
+            stop_event.wait(FOLLOW_INTERVAL)
+    flush()
+    return total
@@ -0,0 +1,231 @@
+"""EPG 受信の打ち切り判定 (EIT のセクションを受信しながら数える)
+
+recpt1 の出力をファイルに書き出しつつ EIT (PID 0x12) のセクションを組み立て、
+- 番組表 (schedule) の全サブテーブルが最後のセクションまで揃った
+  (segment_last_section_number で飛ばされる番号は数えない) → その時点で受信を打ち切る
+- 前回取り込んだときと全サブテーブルの version_number が同じ
+  → 番組表は変わっていないので、取り込みもせずに打ち切る
+受信時間 (epg-scan.sh の秒数) はあくまで上限になる。
+
+受信の記録 (秒数・結果・version) は番組表 DB の epg_scan に残す。
+version は揃った (complete) 受信を取り込めたときだけ記録する。
+"""
+import json
+import time
+
+import api
+import tsindex
+
+EIT_PID = 0x0012
+SCHEDULE_ACTUAL = 0x50  # 自ストリームの番組表 (0x50〜0x5F)
+SCHEDULE_OTHER = 0x60   # 他ストリームの番組表 (0x60〜0x6F, BS/CS の全サービス分)
+SETTLE_SECONDS = 5      # 新しいサブテーブルがこの秒数現れなければ揃ったとみなす
+READ_SIZE = tsindex.TS_PACKET_SIZE * 1024
+
+RESULT_COMPLETE = "complete"
+RESULT_UNCHANGED = "unchanged"
+RESULT_TIMEOUT = "timeout"
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        c = i << 24
+        for _ in range(8):
+            c = (c << 1) ^ 0x04C11DB7 if c & 0x80000000 else c << 1
+        table.append(c & 0xFFFFFFFF)
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+
+def crc32_mpeg(data):
+    """MPEG-2 の CRC32 (CRC を含めたセクション全体なら 0 になる)"""
+    crc = 0xFFFFFFFF
+    for b in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC_TABLE[(crc >> 24) ^ b]
+    return crc
+
+
+class SectionReader:
+    """1 PID 分のパケットから PSI/SI セクションを組み立てる"""
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.started = False  # セクションの途中から読み始めたときは次の先頭まで捨てる
+        self.cc = None
+
+    def feed(self, buf, pos):
+        """パケット 1 つを読み、組み上がったセクション (bytes) のリストを返す"""
+        if buf[pos + 1] & 0x80:  # transport_error_indicator
+            self.started = False
+            return []
+        p = tsindex.payload_offset(buf, pos)
+        if p is None:
+            return []
+        cc = buf[pos + 3] & 0x0F
+        if self.cc is not None and cc != (self.cc + 1) & 0x0F:
+            if cc == self.cc:
+                return []  # 重送
+            self.started = False  # 取りこぼし → 組み立て中のセクションは捨てる
+        self.cc = cc
+        payload = buf[p:pos + tsindex.TS_PACKET_SIZE]
+        sections = []
+        if buf[pos + 1] & 0x40:  # payload_unit_start_indicator → pointer_field
+            pointer = payload[0]
+            if self.started:
+                self.buf += payload[1:1 + pointer]
+                sections += self._drain()
+            self.buf = bytearray(payload[1 + pointer:])
+            self.started = True
+        elif self.started:
+            self.buf += payload
+        else:
+            return []
+        return sections + self._drain()
+
+    def _drain(self):
+        sections = []
+        while len(self.buf) >= 3:
+            if self.buf[0] == 0xFF:  # stuffing → このパケットの残りは空
+                self.buf.clear()
+                break
+            length = (((self.buf[1] & 0x0F) << 8) | self.buf[2]) + 3
+            if len(self.buf) < length:
+                break
+            sections.append(bytes(self.buf[:length]))
+            del self.buf[:length]
+        return sections
+
+
+class EITTracker:
+    """番組表 (EIT schedule) のサブテーブルごとに受信済みのセクションを数える"""
+
+    def __init__(self, other=False):
+        self.families = (SCHEDULE_ACTUAL, SCHEDULE_OTHER) if other else (SCHEDULE_ACTUAL,)
+        self.subtables = {}   # (onid, tsid, sid, table_id) → {"version", "last", "segments", "received"}
+        self.last_table = {}  # (onid, tsid, sid, 基本/拡張の先頭 table_id) → last_table_id
+
+    def add(self, section):
+        """セクションを 1 つ取り込む。新しいサブテーブル (または version) なら True"""
+        if len(section) < 18 or not (section[1] & 0x80):
+            return False
+        table_id = section[0]
+        family = table_id & 0xF0
+        if family not in self.families or crc32_mpeg(section) != 0:
+            return False
+        if not (section[5] & 0x01):  # current_next_indicator
+            return False
+        sid = (section[3] << 8) | section[4]
+        version = (section[5] >> 1) & 0x1F
+        number = section[6]
+        last = section[7]
+        tsid = (section[8] << 8) | section[9]
+        onid = (section[10] << 8) | section[11]
+        segment_last = section[12]
+        # 基本 (0x50〜0x57) と拡張 (0x58〜0x5F) は last_table_id を別々に持つ
+        self.last_table[(onid, tsid, sid, table_id & 0xF8)] = section[13]
+
+        key = (onid, tsid, sid, table_id)
+        sub = self.subtables.get(key)
+        new = sub is None or sub["version"] != version
+        if new:
+            sub = {"version": version, "last": last, "segments": {}, "received": set()}
+            self.subtables[key] = sub
+        sub["segments"][number // 8] = segment_last
+        sub["received"].add(number)
+        return new
+
+    def complete(self):
+        """見つかったサービスの番組表が last_table_id まで全部揃っているか"""
+        if not self.last_table:
+            return False
+        for (onid, tsid, sid, first_table), last_table in self.last_table.items():
+            for table_id in range(first_table, last_table + 1):
+                sub = self.subtables.get((onid, tsid, sid, table_id))
+                if sub is None:
+                    return False
+                for segment in range(sub["last"] // 8 + 1):
+                    segment_last = sub["segments"].get(segment)
+                    if segment_last is None:
+                        return False
+                    for number in range(segment * 8, min(segment_last, sub["last"]) + 1):
+                        if number not in sub["received"]:
+                            return False
+        return True
+
+    def versions(self):
+        """{サブテーブル: version} (JSON に保存できる形。last_table_id も含める)"""
+        result = {"%d.%d.%d.%02x" % key: sub["version"] for key, sub in self.subtables.items()}
+        for (onid, tsid, sid, first_table), last_table in self.last_table.items():
+            result["%d.%d.%d.%02x-last" % (onid, tsid, sid, first_table)] = last_table
+        return result
+
+    def unchanged(self, previous):
+        """前回の versions() のサブテーブルがすべて同じ version で届き、増えてもいないか"""
+        if not previous:
+            return False
+        return self.versions() == previous
+
+
+def capture(src, dst, limit, previous=None, other=False):
+    """src (recpt1 の出力) を dst に書き出しながら EIT を数える
+
+    → (結果, EITTracker, 受信バイト数)。結果は RESULT_COMPLETE / RESULT_UNCHANGED /
+    RESULT_TIMEOUT (limit 秒経過か src の終わり)。
+    """
+    tracker = EITTracker(other)
+    reader = SectionReader()
+    started = time.monotonic()
+    last_new = started
+    total = 0
+    pending = b""
+    read = getattr(src, "read1", src.read)
+    while time.monotonic() - started < limit:
+        data = read(READ_SIZE)
+        if not data:
+            break
+        dst.write(data)
+        total += len(data)
+        buf = pending + data
+        first = tsindex.find_sync(buf)
+        if first < 0:
+            pending = buf[-tsindex.TS_PACKET_SIZE * 3:]
+            continue
+        end = len(buf) - (len(buf) - first) % tsindex.TS_PACKET_SIZE
+        for pos in tsindex.iter_packets(buf, EIT_PID, first, end):
+            for section in reader.feed(buf, pos):
+                if tracker.add(section):
+                    last_new = time.monotonic()
+        pending = buf[end:]
+
+        if tracker.unchanged(previous):
+            return RESULT_UNCHANGED, tracker, total
+        if tracker.complete() and time.monotonic() - last_new >= SETTLE_SECONDS:
+            return RESULT_COMPLETE, tracker, total
+    return RESULT_TIMEOUT, tracker, total
+
+
+def previous_versions(channel, multiplex=False, conn=None):
+    """前回揃った受信を取り込んだときの versions (無ければ None)"""
+    conn = conn or api._get_db(api.EPG_DB)
+    row = conn.execute(
+        "SELECT versions FROM epg_scan WHERE channel = ? AND multiplex = ? "
+        "AND versions IS NOT NULL ORDER BY id DESC LIMIT 1",
+        (channel, 1 if multiplex else 0),
+    ).fetchone()
+    return json.loads(row["versions"]) if row else None
+
+
+def record(channel, multiplex, result, seconds, size, versions=None, conn=None):
+    """受信の記録を残す (versions は揃った受信を取り込めたときだけ渡す)"""
+    conn = conn or api._get_db(api.EPG_DB)
+    with conn:
+        conn.execute(
+            "INSERT INTO epg_scan (channel, multiplex, result, seconds, bytes, versions) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (channel, 1 if multiplex else 0, result, round(seconds, 2), size,
+             json.dumps(versions, sort_keys=True) if versions is not None else None),
+        )
+
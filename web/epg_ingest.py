@@ -0,0 +1,206 @@
+"""epgdump の出力 (JSON / XML) を番組表 DB に取り込む
+
+- JSON は epgdump の版によって形が違うため、番組の配列・{"programs": [...]}・
+  チャンネルごとの {"programs": [...]} の配列のいずれも受け付ける
+- XML は iterparse で <programme> ごとに読み、読み終えた要素は捨てる
+- 日時はここで "YYYY-MM-DD HH:MM:SS" (ローカル時刻) に揃える
+- BS/CS は 1 つのトランスポンダに全サービスの EPG が載るので、services を渡すと
+  サービス名から channels.conf の表示名を引いて振り分ける (載っていないサービスは捨てる)
+- 内容 (番組名・説明・日時・ジャンル・詳細) のハッシュが変わらない番組は書き込まない
+  (updated_at が進まないので、スケジュール照合の差分にも出てこない)
+"""
+import hashlib
+import json
+import unicodedata
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+import api
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def normalize_time(value):
+    """epgdump の日時 → "YYYY-MM-DD HH:MM:SS" (ローカル時刻)。解釈できなければそのまま文字列で返す
+
+    対応形式: "YYYYMMDDHHMMSS +0900" (XMLTV), ISO 8601, epoch (秒 / ミリ秒)
+    """
+    if value is None or value == "":
+        return ""
+    if isinstance(value, (int, float)):
+        seconds = value / 1000 if value > 1e11 else value
+        return datetime.fromtimestamp(seconds).strftime(TIME_FORMAT)
+    text = str(value).strip()
+    for fmt in ("%Y%m%d%H%M%S %z", "%Y%m%d%H%M%S"):
+        try:
+            dt = datetime.strptime(text, fmt)
+            break
+        except ValueError:
+            continue
+    else:
+        try:
+            dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
+        except ValueError:
+            return text
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt.strftime(TIME_FORMAT)
+
+
+def _category_names(value):
+    """ジャンル (文字列 / {"large": {"ja_JP": ..}} などの入れ子) → 名前のリスト"""
+    names = []
+    if isinstance(value, str):
+        if value:
+            names.append(value)
+    elif isinstance(value, dict):
+        for v in value.values():
+            names += _category_names(v)
+    elif isinstance(value, list):
+        for v in value:
+            names += _category_names(v)
+    return names
+
+
+def _programme(event_id, channel, title, description, start, end, category, extra):
+    return {
+        "event_id": int(event_id or 0),
+        "channel": channel,
+        "title": title,
+        "description": description or "",
+        "start_time": normalize_time(start),
+        "end_time": normalize_time(end),
+        "category": json.dumps(_category_names(category), ensure_ascii=False),
+        "extra": json.dumps(extra or {}, ensure_ascii=False) if extra is not None else None,
+    }
+
+
+def service_key(name):
+    """サービス名の照合用キー (全角・半角、空白、大文字小文字の違いを無視)"""
+    return "".join(unicodedata.normalize("NFKC", name or "").split()).lower()
+
+
+def service_map(channels):
+    """{チャンネル番号: 表示名} → service_key(表示名) から表示名を引く dict"""
+    return {service_key(name): name for name in channels.values()}
+
+
+def _json_programmes(data):
+    """JSON のどの形でも (番組の dict, 番組自身の channel を使うか, サービス名) を順に返す"""
+    if isinstance(data, dict):
+        items = data.get("programs") or data.get("programme") or []
+        for item in items:
+            yield item, False, None
+        return
+    for item in data or []:
+        if isinstance(item, dict) and ("programs" in item or "programme" in item):
+            for prog in item.get("programs") or item.get("programme") or []:
+                yield prog, False, item.get("name")
+        else:
+            yield item, True, None
+
+
+def parse_json(path, channel_name, services=None):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    for prog, flat, service in _json_programmes(data):
+        if not isinstance(prog, dict) or not prog.get("title"):
+            continue
+        if services is not None:
+            channel_name = services.get(service_key(service))
+            if channel_name is None:
+                continue
+            flat = False
+        extra = prog.get("extra")
+        if extra is None:
+            # 詳細情報 (拡張形式イベント・映像・音声など) をまとめて残す
+            extra = {k: prog[k] for k in ("extdetail", "video", "audio", "attachinfo", "freeCA")
+                     if k in prog}
+        yield _programme(
+            prog.get("event_id", prog.get("eventId")),
+            (prog.get("channel") if flat else None) or channel_name,
+            prog["title"],
+            prog.get("description", prog.get("desc", prog.get("detail"))),
+            prog.get("start", prog.get("startTime")),
+            prog.get("end", prog.get("endTime")),
+            prog.get("category", prog.get("categories")),
+            extra,
+        )
+
+
+def parse_xml(path, channel_name, services=None):
+    """XMLTV 形式を <programme> 単位で読む"""
+    channel_names = {}  # <channel id> → 表示名 (<programme> より先に出てくる)
+    for _event, elem in ET.iterparse(path):
+        if elem.tag == "channel" and services is not None:
+            name = services.get(service_key(elem.findtext("display-name")))
+            if name is not None:
+                channel_names[elem.get("id")] = name
+            continue
+        if elem.tag != "programme":
+            continue
+        name = channel_name
+        if services is not None:
+            name = channel_names.get(elem.get("channel"))
+        title = " ".join((elem.findtext("title") or "").split())
+        if title and name:
+            yield _programme(
+                elem.get("event_id"),
+                name,
+                title,
+                " ".join((elem.findtext("desc") or "").split()),
+                elem.get("start"),
+                elem.get("stop"),
+                [c.text for c in elem.findall("category") if c.text],
+                None,
+            )
+        elem.clear()
+
+
+def content_hash(prog):
+    raw = json.dumps([prog["title"], prog["description"], prog["start_time"],
+                      prog["end_time"], prog["category"], prog["extra"]], ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def bump_generation(conn):
+    """番組表の世代を進める (番組が変わった取り込みのトランザクション内で呼ぶ)"""
+    conn.execute("UPDATE epg_generation SET generation = generation + 1 WHERE id = 1")
+
+
+def ingest(programmes, conn=None):
+    """番組を 1 トランザクションで登録する → {"inserted", "updated", "unchanged"}
+
+    INSERT OR REPLACE は使わない (全文検索索引のトリガーと updated_at を
+    内容が変わったときだけ動かすため、UPDATE と存在しない行の INSERT に分ける)。
+    """
+    conn = conn or api._get_db(api.EPG_DB)
+    rows = []
+    for prog in programmes:
+        prog["content_hash"] = content_hash(prog)
+        rows.append(prog)
+    if not rows:
+        return {"inserted": 0, "updated": 0, "unchanged": 0}
+    with conn:
+        updated = conn.executemany(
+            "UPDATE programme SET title = :title, description = :description, "
+            "start_time = :start_time, end_time = :end_time, category = :category, "
+            "extra = :extra, content_hash = :content_hash, "
+            "updated_at = datetime('now','localtime') "
+            "WHERE event_id = :event_id AND channel = :channel "
+            "AND content_hash IS NOT :content_hash",
+            rows,
+        ).rowcount
+        inserted = conn.executemany(
+            "INSERT INTO programme (event_id, channel, title, description, start_time, "
+            "end_time, category, extra, content_hash) "
+            "SELECT :event_id, :channel, :title, :description, :start_time, :end_time, "
+            ":category, :extra, :content_hash "
+            "WHERE NOT EXISTS (SELECT 1 FROM programme "
+            "WHERE event_id = :event_id AND channel = :channel)",
+            rows,
+        ).rowcount
+        if inserted or updated:
+            bump_generation(conn)
+    return {"inserted": inserted, "updated": updated,
+            "unchanged": len(rows) - inserted - updated}
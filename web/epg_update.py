@@ -0,0 +1,176 @@
+"""EPG 一括更新 (チューナー数まで並行して受信する)
+
+- 地上波は 1 チャンネルずつ受信する (EIT はそのチャンネルの分しか載らない)
+- BS / CS は 1 トランスポンダに全サービスの EPG が載るので、それぞれ 1 チャンネルだけ
+  epg-scan.sh --multiplex で受信し、番組が 1 件も無いチャンネルだけ個別に受信し直す
+- 同時に使うチューナーは TUNERS_GR / TUNERS_SAT から
+  ・ほかの recpt1 (録画・ライブ視聴)
+  ・受信中に開始する録画予定 (受信を始めるたびにその受信秒数の分を数え直す)
+  の分を引いた数まで。空かないチャンネルは今回は見送る
+"""
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import api
+
+TUNER_GROUP = {"GR": "GR", "BS": "SAT", "CS": "SAT"}
+RESERVE_MARGIN = 60  # 受信終了から録画開始までに空けておく秒数
+POLL_INTERVAL = 1.0
+
+# recpt1 の値を取るオプション (最初の位置引数 = チャンネル番号を探すときに読み飛ばす)
+_RECPT1_VALUE_OPTIONS = {"--round", "--addr", "--port", "--http", "--device",
+                         "--lnb", "--sid", "--tsid"}
+
+
+def channel_band(number):
+    """チャンネル番号 → "GR" / "BS" / "CS" (channels.conf の番号が BS〜 / CS〜 なら衛星)"""
+    prefix = str(number)[:2].upper()
+    return prefix if prefix in ("BS", "CS") else "GR"
+
+
+def tuner_count(group):
+    return api.TUNERS_SAT if group == "SAT" else api.TUNERS_GR
+
+
+def schedule_group(channel, numbers):
+    """録画予定の channel (表示名。番号がそのまま入っていることもある) → "GR" / "SAT"
+
+    numbers は {表示名: チャンネル番号} (channels.conf を逆にしたもの)。
+    """
+    return TUNER_GROUP[channel_band(numbers.get(channel, channel))]
+
+
+def _recpt1_channel(args):
+    """recpt1 のコマンドライン → チャンネル番号 (見つからなければ None)"""
+    skip = False
+    for arg in args[1:]:
+        if skip:
+            skip = False
+        elif arg in _RECPT1_VALUE_OPTIONS:
+            skip = True
+        elif not arg.startswith("-"):
+            return arg
+    return None
+
+
+def _running_recpt1(exclude_parents=()):
+    """起動中の recpt1 → {"GR": 本数, "SAT": 本数}
+
+    exclude_parents を親に持つもの (自分が起動した epg-scan.sh の受信) は数えない。
+    """
+    counts = {"GR": 0, "SAT": 0}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                args = [a.decode("utf-8", "replace") for a in f.read().split(b"\0") if a]
+            if not args or os.path.basename(args[0]) != "recpt1":
+                continue
+            with open(f"/proc/{pid}/status") as f:
+                ppid = next((int(line.split()[1]) for line in f if line.startswith("PPid:")), 0)
+        except (OSError, ValueError):
+            continue  # 終了済み
+        if ppid in exclude_parents:
+            continue
+        channel = _recpt1_channel(args)
+        if channel is not None:
+            counts[TUNER_GROUP[channel_band(channel)]] += 1
+    return counts
+
+
+def _reserved(channels, seconds):
+    """これから seconds 秒 (+ 余裕) 以内に始まる録画予定 → {"GR": 件数, "SAT": 件数}"""
+    numbers = {name: number for number, name in channels.items()}
+    now = datetime.now()
+    until = (now + timedelta(seconds=seconds + RESERVE_MARGIN)).strftime("%Y-%m-%d %H:%M:%S")
+    counts = {"GR": 0, "SAT": 0}
+    conn = api._get_db(api.AUTOREC_DB)
+    for row in conn.execute(
+        "SELECT channel FROM schedule WHERE status = 'scheduled' "
+        "AND start_time <= ? AND end_time > ?",
+        (until, now.strftime("%Y-%m-%d %H:%M:%S")),
+    ):
+        counts[schedule_group(row["channel"], numbers)] += 1
+    return counts
+
+
+def _has_programmes(channel_name):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return api._get_db(api.EPG_DB).execute(
+        "SELECT 1 FROM programme WHERE channel = ? AND end_time > ? LIMIT 1",
+        (channel_name, now),
+    ).fetchone() is not None
+
+
+def _log(message, error=False):
+    print(f"[epg-update] {message}", file=sys.stderr if error else sys.stdout, flush=True)
+
+
+def run(scan_seconds=30):
+    """全チャンネルの EPG を受信する → {"success", "failed", "skipped"} (チャンネル番号のリスト)"""
+    channels = api._get_valid_channels()
+    scan = os.path.join(api.AUTOREC_DIR, "bin", "epg-scan.sh")
+
+    # 待ち行列: (チャンネル番号, 受信秒数, multiplex か)
+    queues = {"GR": [], "SAT": []}
+    multiplex = {}  # 帯域 → 代表チャンネル
+    for number in channels:
+        band = channel_band(number)
+        if band == "GR":
+            queues["GR"].append((number, scan_seconds, False))
+        elif band not in multiplex:
+            multiplex[band] = number
+            queues["SAT"].append((number, api.EPG_SAT_SCAN_SECONDS, True))
+
+    running = {}  # pid → (Popen, グループ, チャンネル番号, multiplex か)
+    result = {"success": [], "failed": [], "skipped": []}
+    while any(queues.values()) or running:
+        # 終わった受信を回収
+        for pid, (proc, group, number, is_multiplex) in list(running.items()):
+            if proc.poll() is None:
+                continue
+            del running[pid]
+            if proc.returncode == 0:
+                result["success"].append(number)
+            else:
+                _log(f"失敗: ch={number} ({channels[number]})", error=True)
+                result["failed"].append(number)
+            if is_multiplex:
+                # トランスポンダに載っていなかったチャンネル (失敗時は全チャンネル) は個別に受信する
+                band = channel_band(number)
+                for other in channels:
+                    if (other != number and channel_band(other) == band
+                            and not _has_programmes(channels[other])):
+                        queues["SAT"].append((other, scan_seconds, False))
+
+        others = _running_recpt1(exclude_parents=set(running))
+        for group, queue in queues.items():
+            ours = sum(1 for r in running.values() if r[1] == group)
+            while queue:
+                # 受信が終わるまでに始まる録画の分のチューナーは空けておく
+                number, seconds, is_multiplex = queue[0]
+                free = (tuner_count(group) - ours - others[group]
+                        - _reserved(channels, seconds)[group])
+                if free <= 0:
+                    if ours == 0:
+                        # 自分の受信が無いのに空かない → 待っても空く見込みが無いので見送る
+                        for number, _seconds, _multiplex in queue:
+                            _log(f"チューナーが空いていないため見送り: ch={number} ({channels[number]})",
+                                 error=True)
+                            result["skipped"].append(number)
+                        queue.clear()
+                    break
+                queue.pop(0)
+                args = [scan, number, str(seconds)] + (["--multiplex"] if is_multiplex else [])
+                _log(f"受信開始: ch={number} ({channels[number]}) {seconds}秒"
+                     + (" (全サービス)" if is_multiplex else ""))
+                proc = subprocess.Popen(args)
+                running[proc.pid] = (proc, group, number, is_multiplex)
+                ours += 1
+        if running:
+            time.sleep(POLL_INTERVAL)
+    return result
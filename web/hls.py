@@ -0,0 +1,411 @@
+"""録画ファイルの HLS セグメンター (セグメントキャッシュ付き)
+
+録画を HLS_SEGMENT_SECONDS 秒ごとの MPEG-TS セグメントにトランスコードして
+キャッシュディレクトリに保存し、以降のシーク・他の視聴者はキャッシュから配信する。
+キャッシュは (録画パス, サイズ, mtime) と画質ごとにディレクトリを分け、
+合計サイズが HLS_CACHE_MB を超えたら最終アクセスの古いセグメントから削除する。
+
+セグメントの生成は 1 本の ffmpeg (segment muxer) で指定番号から連続して行い、
+完成したものから一時ディレクトリ → キャッシュへ rename する
+(キャッシュに存在するファイル = 完成済みセグメント)。
+"""
+import hashlib
+import math
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+import api
+import transcode
+
+SEGMENT_SECONDS = api.HLS_SEGMENT_SECONDS
+READ_AHEAD = 10        # 最後に要求された番号より何セグメント先まで生成するか
+JOB_IDLE_TIMEOUT = 60  # 要求が途絶えたジョブを止めるまでの秒数
+SEGMENT_WAIT = 30      # セグメント完成を待つ最大秒数
+
+
+def enabled():
+    return api.HLS_CACHE_MB > 0
+
+
+def cache_dir():
+    return api.HLS_CACHE_DIR or os.path.join(api.RECORD_DIR, ".hls")
+
+
+def _cache_key(file_path):
+    st = os.stat(file_path)
+    raw = f"{file_path}\0{st.st_size}\0{st.st_mtime_ns}".encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()[:16]
+
+
+class SegmentJob:
+    """start 番目から連続してセグメントを生成する ffmpeg 1 本"""
+
+    def __init__(self, store, start, client=None):
+        self.store = store
+        self.start = start
+        self.client = client
+        self.ticket = None
+        self.next_index = start  # 次に完成するセグメント番号
+        self.last_requested = start  # このジョブの範囲で要求された最も先のセグメント番号
+        self.work_dir = os.path.join(store.dir, f".job{start}")
+        self.proc = None
+        self.paused = False
+        self.stopping = False
+        self.finished = False
+        self.last_used = time.monotonic()
+        self._thread = None
+
+    def launch(self, timeout):
+        """CPU 予算の枠を待ってから ffmpeg を起動。起動できなければ False"""
+        self.ticket = transcode.scheduler.acquire(
+            transcode.VOD, self.store.quality, client=self.client,
+            label=f"{os.path.basename(self.store.source)} #{self.start}",
+            on_cancel=self._on_cancel, timeout=timeout,
+        )
+        if self.ticket is None:
+            self._finish()
+            return False
+        try:
+            self._spawn()
+        except OSError:
+            self.ticket.release()
+            self._finish()
+            return False
+        self.ticket.attach(self.proc)
+        return True
+
+    def _on_cancel(self):
+        # kill で閉じられる最後のセグメントを採用しない
+        self.stopping = True
+
+    def _spawn(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        os.makedirs(self.work_dir)
+        seg = SEGMENT_SECONDS
+        cmd = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-analyzeduration", "1000000", "-probesize", "2000000",
+        ]
+        input_args, src = api.recording_input(self.store.source, self.start * seg)
+        cmd += input_args + self.store.quality_args + [
+            "-force_key_frames", f"expr:gte(t,n_forced*{seg})",
+            "-f", "segment", "-segment_time", str(seg),
+            "-segment_format", "mpegts",
+            "-segment_start_number", str(self.start),
+            "-segment_list", os.path.join(self.work_dir, "list.csv"),
+            "-segment_list_type", "csv",
+            "-output_ts_offset", str(self.start * seg),
+            "-reset_timestamps", "0",
+            os.path.join(self.work_dir, "%d.ts"),
+        ]
+        try:
+            self.proc = subprocess.Popen(
+                cmd, stdin=src or subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        finally:
+            if src is not None:
+                src.close()
+        self._thread = threading.Thread(target=self._monitor, daemon=True)
+        self._thread.start()
+
+    def _collect(self):
+        """segment_list に載った (= 書き終わった) セグメントをキャッシュへ移す"""
+        if self.stopping:
+            # 中断時に閉じられた最後のセグメントは途中までなので採用しない
+            return
+        list_path = os.path.join(self.work_dir, "list.csv")
+        try:
+            with open(list_path) as f:
+                names = [line.split(",", 1)[0] for line in f if line.strip()]
+        except OSError:
+            return
+        for name in names:
+            try:
+                index = int(name.rsplit(".", 1)[0])
+            except ValueError:
+                continue
+            if index < self.next_index:
+                continue
+            src = os.path.join(self.work_dir, name)
+            try:
+                size = os.path.getsize(src)
+                os.rename(src, self.store.segment_path(index))
+            except OSError:
+                continue
+            self.next_index = index + 1
+            self.store.cache.added(size)
+            self.store.notify()
+
+    def _monitor(self):
+        while True:
+            try:
+                self.proc.wait(timeout=0.2)
+                exited = True
+            except subprocess.TimeoutExpired:
+                exited = False
+            self._collect()
+            if exited:
+                break
+            if self.store.has_segment(self.next_index) or \
+                    time.monotonic() - self.last_used > JOB_IDLE_TIMEOUT:
+                # 次は既にキャッシュ済み / 誰も見ていない → 停止
+                self.stop()
+                continue
+            # 視聴位置より READ_AHEAD 以上先行したら一時停止 (停止中は CPU 予算を返す)
+            ahead = self.next_index - self.last_requested
+            if not self.paused and ahead > READ_AHEAD:
+                self._signal(signal.SIGSTOP)
+                self.ticket.suspend()
+                self.paused = True
+            elif self.paused and ahead <= READ_AHEAD // 2 and self.ticket.resume():
+                self._signal(signal.SIGCONT)
+                self.paused = False
+        self.ticket.release()
+        self._finish()
+
+    def _finish(self):
+        self.finished = True
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        self.store.job_finished(self)
+
+    def _signal(self, sig):
+        try:
+            self.proc.send_signal(sig)
+        except OSError:
+            pass
+
+    def covers(self, index):
+        """index をこのジョブの続きとして待てば生成されるか"""
+        return not self.finished and self.next_index <= index <= self.next_index + READ_AHEAD
+
+    def stop(self):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.stopping = True
+        self._signal(signal.SIGCONT)
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class SegmentStore:
+    """1 録画 × 1 画質分のセグメント群"""
+
+    def __init__(self, cache, key, source, quality, quality_args, duration):
+        self.cache = cache
+        self.key = key
+        self.source = source
+        self.quality = quality
+        self.quality_args = quality_args
+        self.duration = duration
+        self.segment_count = max(1, math.ceil(duration / SEGMENT_SECONDS))
+        self.dir = os.path.join(cache.root, key, quality)
+        self._jobs = []
+        self._cond = threading.Condition()
+        os.makedirs(self.dir, exist_ok=True)
+
+    def segment_path(self, index):
+        return os.path.join(self.dir, f"{index}.ts")
+
+    def has_segment(self, index):
+        return os.path.isfile(self.segment_path(index))
+
+    def notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def job_finished(self, job):
+        with self._cond:
+            if job in self._jobs:
+                self._jobs.remove(job)
+            self._cond.notify_all()
+
+    def get_segment(self, index, timeout=SEGMENT_WAIT, client=None):
+        """完成済みセグメントのパスを返す (未生成なら生成を待つ)。失敗時 None
+
+        client は新しいジョブを起動する場合の要求元 (同じ要求元の古いジョブは止まる)。
+        """
+        if index < 0 or index >= self.segment_count:
+            return None
+        deadline = time.monotonic() + timeout
+        launched = None
+        job = None
+        with self._cond:
+            while True:
+                self._requested(index)
+                path = self.segment_path(index)
+                if os.path.isfile(path):
+                    self.cache.touch(path)
+                    return path
+                if launched is not None and launched.finished and not launched.stopping:
+                    # 自分で起動したジョブが index を出さずに終了 → 生成失敗
+                    return None
+                if job is not None and job.client == client and job.ticket is not None \
+                        and job.ticket.superseded:
+                    # 同じ要求元が別の位置へシークした → この要求は不要
+                    return None
+                job = next((j for j in self._jobs if j.covers(index)), None)
+                remaining = deadline - time.monotonic()
+                if job is None:
+                    job = SegmentJob(self, index, client)
+                    self._jobs.append(job)
+                    launched = job
+                    # 予算待ちの間も他の要求を止めないようロックを外す
+                    self._cond.release()
+                    try:
+                        job.launch(max(remaining, 0))
+                    finally:
+                        self._cond.acquire()
+                    continue
+                job.last_used = time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(min(remaining, 1.0))
+
+    def _requested(self, index):
+        """index を生成した (これから生成する) ジョブの視聴位置を進める
+
+        ジョブは自分の範囲の視聴者のうち最も先にいる位置から READ_AHEAD 先までで止まる
+        (別の位置を見ている視聴者の要求では止めない)。
+        """
+        for job in self._jobs:
+            if job.start <= index <= job.next_index + READ_AHEAD:
+                job.last_requested = max(job.last_requested, index)
+
+    def playlist(self, segment_url):
+        """VOD 形式の m3u8 を返す。segment_url(index) でセグメント URL を生成"""
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{SEGMENT_SECONDS}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+        ]
+        for i in range(self.segment_count):
+            length = min(SEGMENT_SECONDS, self.duration - i * SEGMENT_SECONDS)
+            lines.append(f"#EXTINF:{max(length, 0.001):.3f},")
+            lines.append(segment_url(i))
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+
+class SegmentCache:
+    """キャッシュディレクトリ全体 (SegmentStore の管理と LRU 削除)"""
+
+    def __init__(self):
+        self.root = cache_dir()
+        self._stores = {}
+        self._lock = threading.Lock()
+        self._total = None  # 現在のキャッシュ合計サイズ (初回に走査)
+        self._evicting = False
+
+    def store(self, file_path, quality, quality_args):
+        """録画ファイルと画質に対応する SegmentStore を返す"""
+        key = _cache_key(file_path)
+        with self._lock:
+            store = self._stores.get((key, quality))
+            if store is not None:
+                return store
+        duration = api.get_recording_meta(file_path)["duration"]
+        with self._lock:
+            store = self._stores.get((key, quality))
+            if store is None:
+                store = SegmentStore(self, key, file_path, quality, quality_args, duration)
+                self._stores[(key, quality)] = store
+                with open(os.path.join(self.root, key, "source"), "w") as f:
+                    f.write(file_path)
+            return store
+
+    def lookup(self, key, quality, quality_args):
+        """キャッシュキーから SegmentStore を引く (再起動後は source ファイルから復元)"""
+        with self._lock:
+            store = self._stores.get((key, quality))
+        if store is not None:
+            return store
+        try:
+            with open(os.path.join(self.root, key, "source")) as f:
+                file_path = f.read()
+        except (OSError, ValueError):
+            return None
+        if not os.path.isfile(file_path) or _cache_key(file_path) != key:
+            return None
+        return self.store(file_path, quality, quality_args)
+
+    def touch(self, path):
+        """LRU 用に最終アクセス時刻として mtime を更新"""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def added(self, size):
+        with self._lock:
+            if self._total is None:
+                self._total = self._scan()[1]
+            else:
+                self._total += size
+            over = self._total > api.HLS_CACHE_MB * 1024 * 1024 and not self._evicting
+            if over:
+                self._evicting = True
+        if over:
+            threading.Thread(target=self._evict, daemon=True).start()
+
+    def _scan(self):
+        """(セグメント一覧 [(mtime, size, path)], 合計サイズ)"""
+        segments = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # 生成中ジョブの作業ディレクトリは対象外
+            dirnames[:] = [d for d in dirnames if not d.startswith(".job")]
+            for name in filenames:
+                if not name.endswith(".ts"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                segments.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return segments, total
+
+    def _evict(self):
+        """上限の 9 割まで古いセグメントから削除"""
+        try:
+            segments, total = self._scan()
+            limit = api.HLS_CACHE_MB * 1024 * 1024 * 0.9
+            segments.sort()
+            for _mtime, size, path in segments:
+                if total <= limit:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                except OSError:
+                    pass
+            with self._lock:
+                self._total = total
+        finally:
+            with self._lock:
+                self._evicting = False
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SegmentCache()
+        return _cache
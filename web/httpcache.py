@@ -0,0 +1,142 @@
+"""HTTP レスポンスの gzip 圧縮・ETag (API と静的ファイルで共通)
+
+- gzip は Accept-Encoding で受け付けるクライアントに、GZIP_MIN_SIZE 以上の
+  テキスト系レスポンスだけ返す (zlib の gzip 形式)
+- ETag は内容のハッシュ (API ハンドラが番組表の世代などから付けた ETag があればそれ)。
+  gzip したものは別の表現なので ETag の末尾に -gzip を付ける
+- 静的ファイルはメモリにキャッシュし、gzip も一度だけ作る (更新時刻・サイズが変われば読み直す)
+"""
+import hashlib
+import mimetypes
+import os
+import threading
+import zlib
+
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+STATIC_CACHE_MAX_FILE = 4 * 1024 * 1024  # これより大きい静的ファイルはキャッシュしない
+GZIP_CACHE_ENTRIES = 64                  # ETag 付き API レスポンスの圧縮済みを保持する件数
+
+_COMPRESSIBLE = ("text/", "application/json", "application/javascript",
+                 "application/x-ndjson", "image/svg+xml")
+
+_gzip_cache = {}    # ETag → 圧縮済みの本体
+_static_cache = {}  # ファイルパス → StaticFile
+_lock = threading.Lock()
+
+
+def compressible(content_type, size):
+    return size >= GZIP_MIN_SIZE and (content_type or "").startswith(_COMPRESSIBLE)
+
+
+def accepts_gzip(accept_encoding):
+    """Accept-Encoding に gzip (または *) が q=0 以外で含まれるか"""
+    for part in (accept_encoding or "").split(","):
+        name, _, options = part.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        for option in options.split(";"):
+            key, _, value = option.strip().partition("=")
+            if key == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def gzip_bytes(body):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31 = gzip 形式
+    return compressor.compress(body) + compressor.flush()
+
+
+def etag_of(body):
+    return f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+
+
+def gzip_etag(etag):
+    return etag[:-1] + '-gzip"'
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match (カンマ区切り・弱い比較) に etag またはその gzip 版が含まれるか"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    variants = (etag, gzip_etag(etag))
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag in variants:
+            return True
+    return False
+
+
+def negotiate(request_headers, content_type, body, etag=None, gzipped=None):
+    """送る本体とヘッダを決める → (304 なら True, 本体, {ヘッダ: 値})
+
+    etag が無ければ本体のハッシュから作る。gzipped は圧縮済みの本体があれば渡す
+    (ETag があれば圧縮結果は GZIP_CACHE_ENTRIES 件まで使い回す)。
+    """
+    headers = {}
+    etag = etag or etag_of(body)
+    use_gzip = False
+    if compressible(content_type, len(body)):
+        headers["Vary"] = "Accept-Encoding"
+        use_gzip = accepts_gzip(request_headers.get("Accept-Encoding"))
+    headers["ETag"] = gzip_etag(etag) if use_gzip else etag
+    if etag_matches(request_headers.get("If-None-Match"), etag):
+        return True, b"", headers
+    if use_gzip:
+        if gzipped is None:
+            with _lock:
+                gzipped = _gzip_cache.get(etag)
+            if gzipped is None:
+                gzipped = gzip_bytes(body)
+                with _lock:
+                    while len(_gzip_cache) >= GZIP_CACHE_ENTRIES:
+                        del _gzip_cache[next(iter(_gzip_cache))]
+                    _gzip_cache[etag] = gzipped
+        headers["Content-Encoding"] = "gzip"
+        body = gzipped
+    return False, body, headers
+
+
+class StaticFile:
+    """メモリにキャッシュした静的ファイル"""
+
+    def __init__(self, path, stat):
+        with open(path, "rb") as f:
+            self.body = f.read()
+        self.key = (stat.st_mtime_ns, stat.st_size)
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.etag = etag_of(self.body)
+        self.gzipped = (gzip_bytes(self.body)
+                        if compressible(self.content_type, len(self.body)) else None)
+
+
+def static_file(root, url_path):
+    """URL のパス → StaticFile (無い・root の外・大きすぎるときは None)"""
+    path = os.path.realpath(os.path.join(root, url_path.lstrip("/")))
+    if not path.startswith(os.path.realpath(root) + os.sep):
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isfile(path) or stat.st_size > STATIC_CACHE_MAX_FILE:
+        return None
+    with _lock:
+        cached = _static_cache.get(path)
+    if cached is not None and cached.key == (stat.st_mtime_ns, stat.st_size):
+        return cached
+    try:
+        cached = StaticFile(path, stat)
+    except OSError:
+        return None
+    with _lock:
+        _static_cache[path] = cached
+    return cached
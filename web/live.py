@@ -0,0 +1,791 @@
+"""ライブ視聴のチューナー共有
+
+1 チャンネルにつき 1 本の recpt1 (= 1 チューナー) を起動し、その TS を
+画質プリセットごとの ffmpeg エンコーダへ分配する。エンコーダは最初の視聴者で
+起動し、最後の視聴者が抜けたら停止する。ffmpeg の出力はクライアントごとの
+有界バッファに配り、追いつけないクライアントはパイプラインを止めずに切断する。
+受信 TS はタイムシフトバッファにも常に書き込み、巻き戻し再生・遡り録画に使う。
+タイムシフトバッファからは EIT も拾い、視聴中のチャンネルの番組表を更新する。
+"""
+import collections
+import ctypes
+import os
+import subprocess
+import threading
+import time
+
+import api
+import eit_harvest
+import transcode
+from timeshift import TimeshiftBuffer
+
+LIVE_CLIENT_BUFFER = 8 * 1024 * 1024  # クライアント 1 接続あたりの未送信上限 (bytes)
+LIVE_TUNER_LINGER = 5.0  # 最後の視聴者が抜けてからチューナーを解放するまでの猶予 (秒)
+FFMPEG_READ_CHUNK = 65536
+# 遡り録画でバッファ済みの区間を書き出すとき、受信 1 回ごとに書き出す上限 (bytes)。
+# 受信 1 回 (最大 188 * 1024) より十分大きいので、書き出し位置はリングに追い越されずに追いつく
+REWIND_COPY_CHUNK = 188 * 4096
+
+
+class LiveStreamError(Exception):
+    """ライブセッションの開始失敗 (HTTP ステータス付き)"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _load_tee():
+    """libc の tee(2) を ctypes で取得 (Linux 以外・取得失敗時は None)"""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        tee = libc.tee
+    except (OSError, AttributeError):
+        return None
+    tee.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint)
+    tee.restype = ctypes.c_ssize_t
+
+    def _tee(fd_in, fd_out, count):
+        n = tee(fd_in, fd_out, count, 0)
+        if n < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return n
+    return _tee
+
+
+_tee = _load_tee()
+SPLICE_AVAILABLE = hasattr(os, "splice") and _tee is not None
+
+
+def _splice_all(src_fd, dst_fd, count):
+    """パイプから count バイトをちょうど dst_fd へ splice する"""
+    while count > 0:
+        n = os.splice(src_fd, dst_fd, count)
+        if n == 0:
+            raise OSError("unexpected EOF while splicing")
+        count -= n
+
+
+def _relay_splice(src_fd, encoder, rec_ref, f):
+    """カーネル内転送: 宛先がエンコーダ 1 本と録画ファイルまでの場合
+
+    録画ありなら tee(2) でエンコーダへ複製してから同じバイト数を
+    ファイルへ splice(2) し、無ければエンコーダへ直接 splice する。
+    転送バイト数 (EOF なら 0) を返す。
+    """
+    CHUNK = 188 * 1024
+    if f is None:
+        n = encoder.splice_from(src_fd, CHUNK)
+        if n is None:
+            # エンコーダ停止済み → 読み捨てて受信を続ける
+            return len(os.read(src_fd, CHUNK))
+        return n
+
+    if encoder is not None:
+        n = encoder.tee_from(src_fd, CHUNK)
+    else:
+        n = None
+    if n == 0:
+        return 0
+    try:
+        f.flush()
+        if n is None:
+            return os.splice(src_fd, f.fileno(), CHUNK)
+        _splice_all(src_fd, f.fileno(), n)
+        return n
+    except (OSError, ValueError):
+        # 録画ファイルへの書き込み失敗 → 録画だけ止め、ファイルへ流せなかった分を消費
+        rec_ref["file"] = None
+        rec_ref["path"] = None
+        return len(os.read(src_fd, n or CHUNK))
+
+
+def _relay_copy(src_fd, encoders, rec_ref, f):
+    """ユーザー空間経由の転送 (エンコーダ複数、または splice 非対応環境)"""
+    CHUNK = 188 * 64  # TSパケット境界に揃えた 12032 bytes
+    data = os.read(src_fd, CHUNK)
+    if not data:
+        return 0
+    for encoder in encoders:
+        encoder.write(data)
+    if f is not None:
+        try:
+            f.write(data)
+        except Exception:
+            rec_ref["file"] = None
+            rec_ref["path"] = None
+    return len(data)
+
+
+def _relay_ring(src_fd, ring, encoders, rec_ref, f):
+    """タイムシフトバッファ経由の転送
+
+    受信 TS はまずリングへ入れ (エンコーダ 1 本以下なら tee/splice でカーネル内転送)、
+    録画ファイルへはリング上のデータを copy_file_range で書き出す。
+    転送バイト数 (EOF なら 0) を返す。
+    """
+    CHUNK = 188 * 1024
+    if SPLICE_AVAILABLE and len(encoders) <= 1:
+        n = encoders[0].tee_from(src_fd, CHUNK) if encoders else None
+        if n == 0:
+            return 0
+        if n is None:
+            start, n = ring.splice_from(src_fd, CHUNK)
+        else:
+            start, n = ring.splice_from(src_fd, n, exact=True)
+    else:
+        start, n = ring.read_from(src_fd, 188 * 64)
+        for view in ring.slices(start, start + n):
+            for encoder in encoders:
+                encoder.write(view)
+    if n and f is not None:
+        try:
+            ring.copy_to(f, start, start + n)
+        except (OSError, ValueError):
+            rec_ref["file"] = None
+            rec_ref["path"] = None
+    return n
+
+
+def _relay_thread(recpt1_fd, session, rec_ref, stop_event):
+    """recpt1 stdout → 各エンコーダの stdin に分配しつつ、録画時はファイルにも書き出す
+
+    宛先がエンコーダ 1 本 (+ 録画ファイル) の間は TS を Python に取り込まずに
+    splice/tee で転送し、それ以外は read/write ループにフォールバックする。
+    タイムシフトバッファがあれば全データをそこへ通す。
+    """
+    stats = session.relay_stats
+    ring = session.timeshift
+    backfill = None  # 遡り録画で次にファイルへ書き出すリング上のオフセット
+    cpu_start = time.thread_time()
+    try:
+        while not stop_event.is_set():
+            encoders = session.encoders()
+            f = rec_ref.get("file")
+            if ring is not None:
+                if f is None:
+                    backfill = None
+                elif "rewind" in rec_ref:
+                    backfill = ring.offset_for(rec_ref.pop("rewind"))
+                stats["mode"] = "splice" if SPLICE_AVAILABLE and len(encoders) <= 1 else "copy"
+                # 遡り録画の書き出し中は受信分をファイルへ直接書かない (書き出しが追いつけば含まれる)
+                n = _relay_ring(recpt1_fd, ring, encoders, rec_ref,
+                                f if backfill is None else None)
+                if n and backfill is not None:
+                    # バッファ済みの区間を受信の合間に少しずつ書き出す (受信を止めない)。
+                    # 最古の位置から始めた分は今の受信で上書きされているので、そこから先を書く
+                    backfill = max(backfill, ring.offset_for(float("inf")))
+                    end = min(ring.written, backfill + REWIND_COPY_CHUNK)
+                    try:
+                        ring.copy_to(f, backfill, end)
+                        backfill = end if end < ring.written else None
+                    except (OSError, ValueError):
+                        rec_ref["file"] = None
+                        rec_ref["path"] = None
+                        backfill = None
+            elif SPLICE_AVAILABLE and len(encoders) <= 1 and (encoders or f is not None):
+                stats["mode"] = "splice"
+                n = _relay_splice(recpt1_fd, encoders[0] if encoders else None, rec_ref, f)
+            else:
+                stats["mode"] = "copy"
+                n = _relay_copy(recpt1_fd, encoders, rec_ref, f)
+            if not n:
+                break
+            stats["bytes"] += n
+            stats["cpu_seconds"] = time.thread_time() - cpu_start
+    except OSError:
+        pass
+    finally:
+        f = rec_ref.get("file")
+        if f is not None:
+            try:
+                f.close()
+            except OSError:
+                pass
+            rec_ref["file"] = None
+
+
+def _terminate(proc):
+    """子プロセスを終了 (5秒待って応答がなければ kill)"""
+    if proc is None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+class Subscriber:
+    """クライアント 1 接続分の有界リングバッファ
+
+    push() は配信スレッドから、pop() はクライアントのスレッドから呼ばれる。
+    未送信データが max_bytes を超えたら溢れとして閉じ、以降の push は捨てる。
+    waker を設定すると push・close のたびに (配信スレッドから) 呼ばれる
+    (asyncio 版サーバーは pop(0) とこの通知で待つ)。
+    """
+
+    def __init__(self, client, quality, max_bytes=LIVE_CLIENT_BUFFER):
+        self.client = client
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.sub_id = None
+        self.dropped = False
+        self._chunks = collections.deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self.waker = None
+
+    def push(self, data):
+        """データを追加。溢れ・クローズ済みなら False"""
+        with self._cond:
+            if self._closed:
+                return False
+            if self._size + len(data) > self.max_bytes:
+                self.dropped = True
+                self._closed = True
+                self._chunks.clear()
+                self._size = 0
+                self._cond.notify_all()
+                accepted = False
+            else:
+                self._chunks.append(data)
+                self._size += len(data)
+                self._cond.notify_all()
+                accepted = True
+        self._wake()
+        return accepted
+
+    def pop(self, timeout=None):
+        """次のチャンクを返す。クローズ済みで空なら None"""
+        with self._cond:
+            while not self._chunks and not self._closed:
+                if not self._cond.wait(timeout):
+                    return b""
+            if not self._chunks:
+                return None
+            data = self._chunks.popleft()
+            self._size -= len(data)
+            return data
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._wake()
+
+    def _wake(self):
+        waker = self.waker
+        if waker is not None:
+            waker()
+
+
+class Encoder:
+    """1 画質プリセット分の ffmpeg と、その出力の購読者"""
+
+    def __init__(self, session, quality, quality_args):
+        self.session = session
+        self.quality = quality
+        self.quality_args = quality_args
+        self.ffmpeg = None
+        self.subscribers = []
+        self._write_fd = None
+        self._write_lock = threading.Lock()
+        self._pump = None
+        self.ticket = None
+
+    def start(self):
+        """ffmpeg でトランスコード (MPEG-2 → H.264, ブラウザ MSE 互換)"""
+        self.ticket = transcode.scheduler.acquire(
+            transcode.LIVE, self.quality, label=f"ch{self.session.channel}"
+        )
+        if self.ticket is None:
+            raise LiveStreamError(503, "Transcode CPU budget exceeded")
+        ffmpeg_cmd = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-analyzeduration", "500000", "-probesize", "1000000",
+            "-fflags", "+nobuffer", "-i", "pipe:0",
+        ] + self.quality_args + [
+            "-f", "mpegts", "-mpegts_flags", "+resend_headers", "pipe:1",
+        ]
+        r_fd, w_fd = os.pipe()
+        try:
+            self.ffmpeg = subprocess.Popen(
+                ffmpeg_cmd,
+                stdin=r_fd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            os.close(r_fd)
+            os.close(w_fd)
+            self.ticket.release()
+            raise LiveStreamError(503, "ffmpeg not found (live playback requires ffmpeg for transcoding)")
+        self.ticket.attach(self.ffmpeg)
+        os.close(r_fd)
+        self._write_fd = w_fd
+        self._pump = threading.Thread(target=self._pump_thread, daemon=True)
+        self._pump.start()
+
+    def write(self, data):
+        """relay スレッドから TS を受け取る。エンコーダ停止後は捨てる"""
+        with self._write_lock:
+            if self._write_fd is None:
+                return
+            try:
+                os.write(self._write_fd, data)
+            except OSError:
+                self._close_write()
+
+    def splice_from(self, src_fd, count):
+        """src_fd (パイプ) から ffmpeg へ splice。停止済み・書き込み失敗なら None"""
+        with self._write_lock:
+            if self._write_fd is None:
+                return None
+            try:
+                return os.splice(src_fd, self._write_fd, count)
+            except OSError:
+                self._close_write()
+                return None
+
+    def tee_from(self, src_fd, count):
+        """src_fd (パイプ) の内容を消費せずに ffmpeg へ複製。停止済み・失敗なら None"""
+        with self._write_lock:
+            if self._write_fd is None:
+                return None
+            try:
+                return _tee(src_fd, self._write_fd, count)
+            except OSError:
+                self._close_write()
+                return None
+
+    def _close_write(self):
+        if self._write_fd is not None:
+            try:
+                os.close(self._write_fd)
+            except OSError:
+                pass
+            self._write_fd = None
+
+    def _pump_thread(self):
+        """ffmpeg 出力を全購読者に配る。溢れた購読者はその場で切り離す"""
+        try:
+            while True:
+                data = self.ffmpeg.stdout.read1(FFMPEG_READ_CHUNK)
+                if not data:
+                    break
+                for sub in self.session.subscribers_of(self):
+                    if not sub.push(data):
+                        self.session.detach(sub)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.session.encoder_exited(self)
+
+    def stop(self):
+        """ffmpeg を停止。先に kill することで書き込み中の relay を解放する"""
+        if self.ffmpeg is not None:
+            self.ffmpeg.terminate()
+        with self._write_lock:
+            self._close_write()
+        _terminate(self.ffmpeg)
+        if self.ticket is not None:
+            self.ticket.release()
+
+
+class TimeshiftPlayer:
+    """タイムシフト再生 1 クライアント分
+
+    リングバッファの指定位置から読み出して専用の ffmpeg に流し込む。
+    クライアントが一時停止すると ffmpeg → 読み出しの順に詰まって位置が止まり、
+    リングに追い越された場合は残っている最古の位置から再開する。
+    """
+
+    def __init__(self, session, offset, quality, quality_args, client, rewind):
+        self.session = session
+        self.offset = offset
+        self.quality = quality
+        self.quality_args = quality_args
+        self.client = client
+        self.rewind = rewind
+        self.sub_id = None
+        self.ffmpeg = None
+        self.ticket = None
+        self._stop_event = threading.Event()
+        self._feeder = None
+
+    def start(self):
+        self.ticket = transcode.scheduler.acquire(
+            transcode.LIVE, self.quality, client=self.client,
+            label=f"ch{self.session.channel} -{self.rewind:g}s",
+        )
+        if self.ticket is None:
+            raise LiveStreamError(503, "Transcode CPU budget exceeded")
+        ffmpeg_cmd = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-analyzeduration", "500000", "-probesize", "1000000",
+            "-i", "pipe:0",
+        ] + self.quality_args + [
+            "-f", "mpegts", "-mpegts_flags", "+resend_headers", "pipe:1",
+        ]
+        try:
+            self.ffmpeg = subprocess.Popen(
+                ffmpeg_cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            self.ticket.release()
+            raise LiveStreamError(503, "ffmpeg not found (live playback requires ffmpeg for transcoding)")
+        self.ticket.attach(self.ffmpeg)
+        self._feeder = threading.Thread(target=self._feed_thread, daemon=True)
+        self._feeder.start()
+
+    def _feed_thread(self):
+        ring = self.session.timeshift
+        try:
+            while not self._stop_event.is_set() and not ring.closed:
+                self.offset, data = ring.read_at(self.offset, 188 * 1024)
+                if data:
+                    self.ffmpeg.stdin.write(data)
+        except (OSError, ValueError):
+            pass
+        finally:
+            try:
+                self.ffmpeg.stdin.close()
+            except OSError:
+                pass
+
+    def read(self):
+        """トランスコード済みデータを返す。終了時は空 bytes"""
+        return self.ffmpeg.stdout.read1(FFMPEG_READ_CHUNK)
+
+    def fileno(self):
+        """トランスコード済みデータのパイプ (read() と混ぜて使わない)"""
+        return self.ffmpeg.stdout.fileno()
+
+    def stop(self):
+        self._stop_event.set()
+        _terminate(self.ffmpeg)
+        if self.ticket is not None:
+            self.ticket.release()
+
+
+class LiveSession:
+    """1 チューナー分の recpt1 と、画質ごとのエンコーダ"""
+
+    def __init__(self, hub, channel, channel_name):
+        self.hub = hub
+        self.channel = channel
+        self.channel_name = channel_name
+        self.stream_id = None
+        self.recpt1 = None
+        self.rec_ref = {"file": None, "path": None}
+        self.relay_stats = {"mode": None, "bytes": 0, "cpu_seconds": 0.0}
+        self.timeshift = None
+        self._players = []
+        self.ready = threading.Event()
+        self.error = None
+        self._encoders = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._relay = None
+        self._harvest = None
+        self._linger = None
+        self._stopped = False  # True 以降は購読者を受け付けない
+        self._shut = False
+
+    def start(self):
+        """recpt1 を起動。失敗時は LiveStreamError"""
+        try:
+            self.recpt1 = subprocess.Popen(
+                ["recpt1", "--b25", "--strip", self.channel, "-", "-"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            raise LiveStreamError(503, "recpt1 not found")
+
+        # 0.5秒待って起動エラー検出
+        time.sleep(0.5)
+        if self.recpt1.poll() is not None:
+            stderr_out = self.recpt1.stderr.read().decode("utf-8", errors="replace")
+            raise LiveStreamError(503, f"recpt1 failed to start: {stderr_out[:200]}")
+
+        # チューナー登録 (上限チェック)
+        self.stream_id = api.register_live_stream(
+            self.channel, self.channel_name, self.recpt1.pid, self.rec_ref,
+            self.relay_stats,
+        )
+        if self.stream_id is None:
+            _terminate(self.recpt1)
+            raise LiveStreamError(503, "Max live streams reached")
+
+        if api.TIMESHIFT_SIZE_MB > 0:
+            path = os.path.join(api.TIMESHIFT_DIR, f"ch{self.channel}.ring")
+            try:
+                self.timeshift = TimeshiftBuffer(path, api.TIMESHIFT_SIZE_MB * 1024 * 1024)
+            except OSError:
+                self.timeshift = None  # バッファ無しでもライブ視聴は継続
+        self.rec_ref["timeshift"] = self.timeshift
+        if self.timeshift is not None:
+            # 番組表の取り込み (バッファを読むだけなので relay は待たせない)
+            self._harvest = eit_harvest.start_timeshift_harvest(
+                self.timeshift, self.channel_name, self._stop_event)
+
+        self._relay = threading.Thread(
+            target=self._relay_main,
+            args=(self.recpt1.stdout.fileno(), self, self.rec_ref, self._stop_event),
+            daemon=True,
+        )
+        self._relay.start()
+
+    def _relay_main(self, *args):
+        _relay_thread(*args)
+        # recpt1 終了 (受信断など) → セッション破棄
+        self.hub._discard(self)
+
+    def encoders(self):
+        with self._lock:
+            return list(self._encoders.values())
+
+    def subscribers_of(self, encoder):
+        with self._lock:
+            return list(encoder.subscribers)
+
+    def add_subscriber(self, sub, quality_args):
+        """購読者を追加。該当画質のエンコーダが無ければ起動する"""
+        with self._lock:
+            if self._stopped:
+                return False
+            if self._linger is not None:
+                self._linger.cancel()
+                self._linger = None
+            encoder = self._encoders.get(sub.quality)
+            if encoder is None:
+                encoder = Encoder(self, sub.quality, quality_args)
+                encoder.start()
+                self._encoders[sub.quality] = encoder
+            encoder.subscribers.append(sub)
+        sub.sub_id = api.add_live_subscriber(self.stream_id, sub.client, sub.quality)
+        return True
+
+    def detach(self, sub):
+        """購読者を外す。画質の最後の購読者ならエンコーダも止める"""
+        stop_encoder = None
+        with self._lock:
+            encoder = self._encoders.get(sub.quality)
+            if encoder is None or sub not in encoder.subscribers:
+                return
+            encoder.subscribers.remove(sub)
+            if not encoder.subscribers:
+                del self._encoders[sub.quality]
+                stop_encoder = encoder
+        sub.close()
+        if sub.sub_id is not None:
+            api.remove_live_subscriber(self.stream_id, sub.sub_id)
+        if stop_encoder is not None:
+            stop_encoder.stop()
+
+    def encoder_exited(self, encoder):
+        """ffmpeg が自然終了した → その画質の購読者を閉じる"""
+        with self._lock:
+            if self._encoders.get(encoder.quality) is encoder:
+                del self._encoders[encoder.quality]
+            subscribers = list(encoder.subscribers)
+            encoder.subscribers.clear()
+        for sub in subscribers:
+            sub.close()
+            if sub.sub_id is not None:
+                api.remove_live_subscriber(self.stream_id, sub.sub_id)
+        encoder.stop()
+
+    def add_player(self, player):
+        """タイムシフト再生の視聴者を追加"""
+        with self._lock:
+            if self._stopped:
+                return False
+            if self._linger is not None:
+                self._linger.cancel()
+                self._linger = None
+            self._players.append(player)
+        player.sub_id = api.add_live_subscriber(
+            self.stream_id, player.client, player.quality, player.rewind
+        )
+        return True
+
+    def remove_player(self, player):
+        with self._lock:
+            if player not in self._players:
+                return
+            self._players.remove(player)
+        if player.sub_id is not None:
+            api.remove_live_subscriber(self.stream_id, player.sub_id)
+        player.stop()
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(e.subscribers) for e in self._encoders.values()) + len(self._players)
+
+    def schedule_release(self, callback):
+        """視聴者ゼロになったチューナーを猶予後に解放 (画質切替での再選局を避ける)"""
+        with self._lock:
+            if self._stopped or self._linger is not None:
+                return
+            self._linger = threading.Timer(LIVE_TUNER_LINGER, callback, args=(self,))
+            self._linger.daemon = True
+            self._linger.start()
+
+    def retire_if_idle(self):
+        """視聴者ゼロなら以降の購読を締め切って True を返す"""
+        with self._lock:
+            if self._stopped or self._players or any(e.subscribers for e in self._encoders.values()):
+                return False
+            self._stopped = True
+            return True
+
+    def stop(self):
+        """パイプラインを停止して資源を解放"""
+        with self._lock:
+            if self._shut:
+                return
+            self._shut = True
+            self._stopped = True
+            if self._linger is not None:
+                self._linger.cancel()
+                self._linger = None
+            encoders = list(self._encoders.values())
+            self._encoders.clear()
+            subscribers = [sub for e in encoders for sub in e.subscribers]
+            players = list(self._players)
+            self._players.clear()
+        for sub in subscribers:
+            sub.close()
+        for player in players:
+            player.stop()
+        self._stop_event.set()
+        rec_ref = self.rec_ref
+        # 録画ファイルのクローズ
+        f = rec_ref.get("file")
+        if f is not None:
+            try:
+                f.close()
+            except OSError:
+                pass
+            rec_ref["file"] = None
+        # jikkyo-rec.py の停止
+        jikkyo_proc = rec_ref.get("jikkyo_proc")
+        if jikkyo_proc:
+            _terminate(jikkyo_proc)
+            rec_ref["jikkyo_proc"] = None
+        # recpt1 とエンコーダを終了
+        if self.recpt1 is not None:
+            self.recpt1.terminate()
+        for encoder in encoders:
+            encoder.stop()
+        _terminate(self.recpt1)
+        if self._relay is not None and self._relay is not threading.current_thread():
+            self._relay.join(timeout=5)
+        if self._harvest is not None:
+            self._harvest.join(timeout=5)
+        if self.timeshift is not None:
+            self.timeshift.close()
+        if self.stream_id is not None:
+            api.unregister_live_stream(self.stream_id)
+
+
+class LiveHub:
+    """チャンネルごとの LiveSession を管理するハブ"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel, channel_name, quality, quality_args, client):
+        """購読を開始し (session, subscriber) を返す。失敗時は LiveStreamError"""
+        sub = Subscriber(client, quality)
+        while True:
+            with self._lock:
+                session = self._sessions.get(channel)
+                owner = session is None
+                if owner:
+                    session = LiveSession(self, channel, channel_name)
+                    self._sessions[channel] = session
+
+            if owner:
+                try:
+                    session.start()
+                except LiveStreamError as e:
+                    session.error = e
+                    with self._lock:
+                        if self._sessions.get(channel) is session:
+                            del self._sessions[channel]
+                    session.ready.set()
+                    raise
+                session.ready.set()
+            else:
+                session.ready.wait()
+                if session.error is not None:
+                    raise session.error
+
+            try:
+                added = session.add_subscriber(sub, quality_args)
+            except LiveStreamError:
+                if session.subscriber_count() == 0:
+                    session.schedule_release(self._release_if_idle)
+                raise
+            if added:
+                return session, sub
+            # 停止処理中のセッションを掴んだ場合は作り直す
+
+    def open_timeshift(self, channel, rewind, quality, quality_args, client):
+        """受信中チャンネルのバッファを rewind 秒前から再生。(session, player) を返す"""
+        with self._lock:
+            session = self._sessions.get(channel)
+        if session is None or not session.ready.is_set() or session.timeshift is None:
+            raise LiveStreamError(404, "タイムシフトバッファがありません (受信中のチャンネルのみ)")
+        offset = session.timeshift.offset_for(rewind)
+        player = TimeshiftPlayer(session, offset, quality, quality_args, client, rewind)
+        if not session.add_player(player):
+            raise LiveStreamError(404, "タイムシフトバッファがありません (受信中のチャンネルのみ)")
+        try:
+            player.start()
+        except LiveStreamError:
+            self.close_timeshift(session, player)
+            raise
+        return session, player
+
+    def close_timeshift(self, session, player):
+        """タイムシフト再生を終了"""
+        session.remove_player(player)
+        if session.subscriber_count() == 0:
+            session.schedule_release(self._release_if_idle)
+
+    def unsubscribe(self, session, sub):
+        """購読を終了。チューナーの視聴者がゼロになったら猶予後に解放"""
+        session.detach(sub)
+        if session.subscriber_count() == 0:
+            session.schedule_release(self._release_if_idle)
+
+    def _release_if_idle(self, session):
+        with self._lock:
+            if not session.retire_if_idle():
+                return
+            if self._sessions.get(session.channel) is session:
+                del self._sessions[session.channel]
+        session.stop()
+
+    def _discard(self, session):
+        """recpt1 が終了したセッションを破棄"""
+        with self._lock:
+            if self._sessions.get(session.channel) is session:
+                del self._sessions[session.channel]
+        session.stop()
+
+
+hub = LiveHub()
@@ -0,0 +1,140 @@
+"""録画スケジューラ (常駐, bin/recorder.py)
+
+schedule の録画予定を開始時刻順のヒープに積み、
+開始 (START_OFFSET + RECORD_PREWARM_SECONDS 秒前) の LAUNCH_LEAD 秒前に
+bin/record.sh を起動する。record.sh は準備を済ませてから録画開始時刻まで
+秒未満の精度で待ち、recpt1 を起動する (cron の分単位の起動に依存しない)。
+
+録画予定の変更は SIGHUP で通知を受けて読み直す (api.notify_recorder())。
+通知されない書き込み (sqlite3 コマンドなど) に備えて、
+PRAGMA data_version も POLL_SECONDS ごとに確認する。
+"""
+import fcntl
+import heapq
+import os
+import signal
+import subprocess
+import threading
+import time
+from datetime import datetime
+
+import api
+
+LAUNCH_LEAD = 10.0   # record.sh の準備 (DB 読み出し・ディレクトリ作成など) に見込む秒数
+POLL_SECONDS = 5.0   # 通知が無くても DB の変更を確認する間隔
+LOCK_FILE = os.path.join(api.AUTOREC_DIR, "log", "recorder.lock")  # 常駐は 1 つだけ
+
+
+def _epoch(text):
+    return datetime.fromisoformat(text).timestamp()
+
+
+class Recorder:
+    """録画予定のヒープと起動済みの record.sh"""
+
+    def __init__(self):
+        self.conn = api._get_db(api.AUTOREC_DB)
+        self.heap = []         # (起動時刻 epoch, schedule_id)
+        self.launched = {}     # schedule_id → Popen (起動済みは二度と起動しない)
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self._data_version = None
+
+    def launch_time(self, row):
+        lead = api.START_OFFSET + api.RECORD_PREWARM_SECONDS + LAUNCH_LEAD
+        return _epoch(row["start_time"]) - lead
+
+    def reload(self):
+        """録画予定を読み直してヒープを作り直す"""
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        rows = self.conn.execute(
+            "SELECT id, start_time FROM schedule WHERE status = 'scheduled' AND end_time > ?",
+            (now,),
+        ).fetchall()
+        heap = []
+        for row in rows:
+            if row["id"] in self.launched:
+                continue
+            try:
+                heap.append((self.launch_time(row), row["id"]))
+            except ValueError:
+                print(f"[recorder] 開始時刻を解釈できません: id={row['id']} {row['start_time']}")
+        heapq.heapify(heap)
+        self.heap = heap
+        self._data_version = self._current_data_version()
+
+    def _current_data_version(self):
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _launch(self, schedule_id):
+        log_path = os.path.join(api.AUTOREC_DIR, "log", "record.log")
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        script = os.path.join(api.AUTOREC_DIR, "bin", "record.sh")
+        with open(log_path, "ab") as log:
+            proc = subprocess.Popen(
+                [script, str(schedule_id)],
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                cwd=api.AUTOREC_DIR, start_new_session=True,  # スケジューラの停止で録画を止めない
+            )
+        self.launched[schedule_id] = proc
+        print(f"[recorder] 録画起動: schedule_id={schedule_id} pid={proc.pid}", flush=True)
+
+    def _reap(self):
+        for proc in self.launched.values():
+            if proc is not None and proc.returncode is None:
+                proc.poll()
+
+    def run_once(self):
+        """起動時刻を過ぎた録画を起動し、次に起きるまでの秒数を返す"""
+        if self._current_data_version() != self._data_version:
+            self.reload()
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            _when, schedule_id = heapq.heappop(self.heap)
+            row = self.conn.execute(
+                "SELECT status FROM schedule WHERE id = ?", (schedule_id,)
+            ).fetchone()
+            if row is not None and row["status"] == "scheduled" and schedule_id not in self.launched:
+                self._launch(schedule_id)
+        self._reap()
+        if not self.heap:
+            return POLL_SECONDS
+        return max(0.0, min(POLL_SECONDS, self.heap[0][0] - time.time()))
+
+    def serve(self):
+        """常駐して録画を起動する。既に別のスケジューラが常駐していれば False を返す"""
+        os.makedirs(os.path.dirname(LOCK_FILE), exist_ok=True)
+        lock = open(LOCK_FILE, "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return False
+        with lock:
+            self._serve()
+        return True
+
+    def _serve(self):
+        signal.signal(signal.SIGHUP, lambda *_: self.wakeup.set())
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._stop)
+        os.makedirs(os.path.dirname(api.RECORDER_PID_FILE), exist_ok=True)
+        with open(api.RECORDER_PID_FILE, "w") as f:
+            f.write(str(os.getpid()))
+        try:
+            self.reload()
+            print(f"[recorder] 開始: 録画予定 {len(self.heap)} 件", flush=True)
+            while not self.stopping:
+                timeout = self.run_once()
+                if self.wakeup.wait(timeout):
+                    self.wakeup.clear()
+                    self.reload()
+        finally:
+            try:
+                os.unlink(api.RECORDER_PID_FILE)
+            except OSError:
+                pass
+
+    def _stop(self, *_):
+        self.stopping = True
+        self.wakeup.set()
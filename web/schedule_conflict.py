@@ -0,0 +1,143 @@
+"""録画予定の重なりをチューナー数で解決する
+
+未来の録画予定 (scheduled / conflict) をチューナーの系統 (地上波 / BS・CS) ごとに
+区間として並べ、優先度の高い順に
+「その区間で同時に録画する本数がチューナー数を超えないか」を調べて採否を決める。
+区間グラフなので同時本数がチューナー数以下なら必ず割り当てられ、
+採用した予定は開始時刻順に空いているチューナーへ割り当てる (schedule.tuner)。
+入らなかった予定は conflict にし、後で枠が空けば scheduled に戻す。
+
+優先度: 録画中 > 手動予約 (rule_id が NULL) > rule.priority > 開始が早い順。
+区間は recpt1 が動いている間 (START_OFFSET + RECORD_PREWARM_SECONDS 前から END_OFFSET 後まで)。
+"""
+import bisect
+import heapq
+from datetime import datetime
+
+import api
+import epg_update
+
+CONFLICT_STATUS = "conflict"
+
+
+def _epoch(text):
+    return datetime.fromisoformat(text).timestamp()
+
+
+class _Timeline:
+    """1 系統分の採用済み区間 (開始時刻順)"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.starts = []
+        self.intervals = []
+        self.longest = 0.0
+
+    def fits(self, start, end):
+        """[start, end) に加えても同時本数が capacity 以下か"""
+        if self.capacity <= 0:
+            return False
+        # start より longest 以上前に始まった区間は start までに終わっている
+        lo = bisect.bisect_left(self.starts, start - self.longest)
+        hi = bisect.bisect_left(self.starts, end)
+        points = []
+        for s, e in self.intervals[lo:hi]:
+            if e > start:
+                points.append((max(s, start), 1))
+                points.append((e, -1))
+        if len(points) // 2 < self.capacity:
+            return True
+        points.sort()  # 同時刻なら終了 (-1) を先に数える
+        depth = 0
+        for _t, d in points:
+            depth += d
+            if depth >= self.capacity:
+                return False
+        return True
+
+    def add(self, start, end):
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.intervals.insert(i, (start, end))
+        self.longest = max(self.longest, end - start)
+
+
+def _assign_tuners(accepted):
+    """採用した [(start, end, id)] を開始時刻順に空いているチューナーへ → {id: 番号}"""
+    result = {}
+    busy = []  # (end, tuner)
+    free = []
+    next_tuner = 0
+    for start, end, schedule_id in sorted(accepted):
+        while busy and busy[0][0] <= start:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+        if free:
+            tuner = heapq.heappop(free)
+        else:
+            tuner = next_tuner
+            next_tuner += 1
+        result[schedule_id] = tuner
+        heapq.heappush(busy, (end, tuner))
+    return result
+
+
+def resolve(now=None):
+    """未来の録画予定の採否とチューナーを決め直す → {"scheduled", "conflict", "changed"}"""
+    now = now or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn = api._get_db(api.AUTOREC_DB)
+    rows = conn.execute(
+        "SELECT s.id, s.channel, s.start_time, s.end_time, s.status, s.tuner, s.rule_id, "
+        "r.priority FROM schedule s LEFT JOIN rule r ON s.rule_id = r.id "
+        "WHERE s.status IN ('scheduled', 'recording', ?) AND s.end_time > ?",
+        (CONFLICT_STATUS, now),
+    ).fetchall()
+
+    numbers = {name: number for number, name in api._get_valid_channels().items()}
+    before = api.START_OFFSET + api.RECORD_PREWARM_SECONDS
+    candidates = []
+    for row in rows:
+        try:
+            start = _epoch(row["start_time"]) - before
+            end = _epoch(row["end_time"]) + api.END_OFFSET
+        except ValueError:
+            continue
+        if row["status"] == "recording":
+            rank = 0
+        elif row["rule_id"] is None:
+            rank = 1
+        else:
+            rank = 2
+        candidates.append((rank, -(row["priority"] or 0), start, row["id"], end, row))
+
+    timelines = {}
+    accepted = {}  # 系統 → [(start, end, id)]
+    decided = {}   # id → (status, tuner)
+    for _rank, _priority, start, schedule_id, end, row in sorted(candidates, key=lambda c: c[:4]):
+        group = epg_update.schedule_group(row["channel"], numbers)
+        timeline = timelines.get(group)
+        if timeline is None:
+            timeline = timelines[group] = _Timeline(epg_update.tuner_count(group))
+        if row["status"] == "recording" or timeline.fits(start, end):
+            # 録画中のものは (チューナー数を超えていても) そのまま数える
+            timeline.add(start, end)
+            accepted.setdefault(group, []).append((start, end, schedule_id))
+            decided[schedule_id] = [row["status"] if row["status"] == "recording" else "scheduled",
+                                    None]
+        else:
+            decided[schedule_id] = [CONFLICT_STATUS, None]
+    for intervals in accepted.values():
+        for schedule_id, tuner in _assign_tuners(intervals).items():
+            decided[schedule_id][1] = tuner
+
+    changes = []
+    for row in rows:
+        status, tuner = decided.get(row["id"], (row["status"], row["tuner"]))
+        if (status, tuner) != (row["status"], row["tuner"]):
+            changes.append((status, tuner, row["id"]))
+    if changes:
+        conn.executemany("UPDATE schedule SET status = ?, tuner = ? WHERE id = ?", changes)
+        conn.commit()
+    statuses = [status for status, _tuner in decided.values()]
+    return {"scheduled": statuses.count("scheduled"),
+            "conflict": statuses.count(CONFLICT_STATUS),
+            "changed": len(changes)}
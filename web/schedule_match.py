@@ -0,0 +1,179 @@
+"""録画ルールと番組表の照合 (差分方式)
+
+番組表 (epg.sqlite の programme) は削除せずに蓄積されるため、毎回すべてのルールと
+全番組を突き合わせると番組表が育つほど遅くなる。ここでは
+- 前回から内容が変わっていないルール → 前回以降に更新された番組 (updated_at) だけ
+- 新規・編集されたルール → 未来の番組すべて
+  (キーワードが 3 文字以上なら番組名の全文検索索引で候補を絞る)
+を照合し、録画予定 (schedule) に追加する。
+
+ルールの内容は rule_match.signature に、番組表の処理済み位置は
+match_state の programme_watermark に記録する。
+"""
+import json
+from datetime import datetime
+
+import api
+
+MATCH_FIELDS = ("keyword", "channel", "category", "time_from", "time_to", "weekdays")
+ACTIVE_STATUSES = ("scheduled", "conflict", "recording", "done")
+
+# LIKE と同じく ASCII だけ大文字小文字を区別しない
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def _signature(rule):
+    return json.dumps([rule[f] for f in MATCH_FIELDS], ensure_ascii=False)
+
+
+def _fold(text):
+    return (text or "").translate(_ASCII_LOWER)
+
+
+class Rule:
+    """照合用に前処理したルール"""
+
+    __slots__ = ("id", "priority", "keyword", "phrase", "channel", "category",
+                 "time_from", "time_to", "weekdays")
+
+    def __init__(self, row):
+        self.id = row["id"]
+        self.priority = row["priority"] or 0
+        self.keyword = _fold(row["keyword"]) or None
+        self.phrase = api.fts_phrase(row["keyword"])  # 全文検索で候補を絞れるなら
+        self.channel = row["channel"] or None
+        self.category = _fold(row["category"]) or None
+        self.time_from = row["time_from"] or None
+        self.time_to = row["time_to"] or None
+        self.weekdays = row["weekdays"] or None
+
+    def matches(self, title, category, channel, hm, wd):
+        """title, category は _fold 済み。hm = "HH:MM", wd = 曜日 "0"-"6" (日=0)"""
+        if self.keyword is not None and self.keyword not in title:
+            return False
+        if self.channel is not None and channel != self.channel:
+            return False
+        if self.category is not None and self.category not in category:
+            return False
+        if self.time_from is not None and (hm is None or hm < self.time_from):
+            return False
+        if self.time_to is not None and (hm is None or hm > self.time_to):
+            return False
+        if self.weekdays is not None and (wd is None or wd not in self.weekdays):
+            return False
+        return True
+
+
+_PROGRAMME_QUERY = (
+    "SELECT event_id, channel, title, start_time, end_time, category, "
+    "strftime('%H:%M', start_time), strftime('%w', start_time) "
+    "FROM programme WHERE start_time > ?"
+)
+
+
+def _match_programmes(epg, rules, now, since=None):
+    """番組を順に読み、最初に当てはまったルール (優先度順) と組にして返す
+
+    → ([(rule, 番組の tuple), ...], 読んだ番組数)
+    """
+    query = _PROGRAMME_QUERY
+    args = [now]
+    if since is not None:
+        query += " AND updated_at >= ?"
+        args.append(since)
+    elif all(rule.phrase for rule in rules):
+        # どのルールもキーワード付きなら、番組名の全文検索で候補を絞ってから照合
+        query += (" AND rowid IN (SELECT rowid FROM programme_fts "
+                  "WHERE programme_fts MATCH ?)")
+        args.append("title : (" + " OR ".join(rule.phrase for rule in rules) + ")")
+    cur = epg.cursor()
+    cur.row_factory = None  # sqlite3.Row より tuple の方が速い
+    cur.execute(query, args)
+    found = []
+    examined = 0
+    for p in cur:
+        examined += 1
+        title = _fold(p[2])
+        category = _fold(p[5])
+        for rule in rules:
+            if rule.matches(title, category, p[1], p[6], p[7]):
+                found.append((rule, p))
+                break
+    return found, examined
+
+
+def run(now=None):
+    """照合して録画予定を追加する。統計 dict を返す"""
+    now = now or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn = api._get_db(api.AUTOREC_DB)
+    epg = api._get_db(api.EPG_DB)
+
+    rows = conn.execute(
+        "SELECT * FROM rule WHERE enabled = 1 ORDER BY priority DESC, id"
+    ).fetchall()
+    known = {row["rule_id"]: row["signature"]
+             for row in conn.execute("SELECT rule_id, signature FROM rule_match")}
+    changed = [r for r in rows if known.get(r["id"]) != _signature(r)]
+    unchanged = [r for r in rows if known.get(r["id"]) == _signature(r)]
+
+    state = conn.execute(
+        "SELECT value FROM match_state WHERE name = 'programme_watermark'"
+    ).fetchone()
+    watermark = state["value"] if state else None
+    # 照合中に追加された番組は次回拾う (updated_at は秒単位なので >= で重なりを許す)
+    new_watermark = epg.execute("SELECT MAX(updated_at) FROM programme").fetchone()[0]
+
+    stats = {"full_rules": len(changed), "full_examined": 0,
+             "delta_rules": len(unchanged), "delta_examined": 0, "added": 0}
+    found = []
+    if changed:
+        matched, stats["full_examined"] = _match_programmes(
+            epg, [Rule(r) for r in changed], now)
+        found += matched
+    if unchanged and watermark is not None:
+        matched, stats["delta_examined"] = _match_programmes(
+            epg, [Rule(r) for r in unchanged], now, watermark)
+        found += matched
+
+    # 同じ番組に複数のルールが当てはまったら優先度の高いルールで登録
+    candidates = {}
+    for rule, p in found:
+        key = (p[0], p[1])
+        if key not in candidates or rule.priority > candidates[key][0].priority:
+            candidates[key] = (rule, p)
+
+    placeholders = ",".join("?" * len(ACTIVE_STATUSES))
+    for (event_id, channel), (rule, p) in candidates.items():
+        exists = conn.execute(
+            f"SELECT 1 FROM schedule WHERE event_id = ? AND channel = ? "
+            f"AND status IN ({placeholders})",
+            (event_id, channel) + ACTIVE_STATUSES,
+        ).fetchone()
+        if exists:
+            continue
+        conn.execute(
+            "INSERT INTO schedule (rule_id, event_id, channel, title, start_time, end_time, status) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'scheduled')",
+            (rule.id, event_id, channel, p[2], p[3], p[4]),
+        )
+        stats["added"] += 1
+
+    # 照合済みのルールと番組表の位置を記録 (無効・削除されたルールは忘れる)
+    conn.executemany(
+        "INSERT INTO rule_match (rule_id, signature, matched_at) "
+        "VALUES (?, ?, datetime('now','localtime')) "
+        "ON CONFLICT(rule_id) DO UPDATE SET signature = excluded.signature, "
+        "matched_at = excluded.matched_at",
+        [(r["id"], _signature(r)) for r in changed],
+    )
+    conn.execute(
+        f"DELETE FROM rule_match WHERE rule_id NOT IN ({','.join('?' * len(rows))})",
+        [r["id"] for r in rows],
+    )
+    if new_watermark is not None:
+        conn.execute(
+            "INSERT OR REPLACE INTO match_state (name, value) VALUES ('programme_watermark', ?)",
+            (new_watermark,),
+        )
+    conn.commit()
+    return stats
@@ -3,8 +3,6 @@
 import os
 import subprocess
 import sys
-import threading
-import time
 from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs, unquote, quote
 
@@ -13,6 +11,10 @@ AUTOREC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, os.path.join(AUTOREC_DIR, "web"))
 
 import api
+import hls
+import httpcache
+import live
+import transcode
 
 STATIC_DIR = os.path.join(AUTOREC_DIR, "web", "static")
 
@@ -41,41 +43,9 @@ QUALITY_PRESETS = {
 DEFAULT_QUALITY = "high"
 
 
-def _relay_thread(recpt1_stdout, ffmpeg_write_fd, rec_ref, stop_event):
-    """recpt1 stdout → ffmpeg stdin に転送しつつ、録画時はファイルにも書き出す"""
-    CHUNK = 188 * 64  # TSパケット境界に揃えた 12032 bytes
-    try:
-        while not stop_event.is_set():
-            data = recpt1_stdout.read(CHUNK)
-            if not data:
-                break
-            try:
-                os.write(ffmpeg_write_fd, data)
-            except OSError:
-                break
-            f = rec_ref.get("file")
-            if f is not None:
-                try:
-                    f.write(data)
-                except Exception:
-                    rec_ref["file"] = None
-                    rec_ref["path"] = None
-    finally:
-        try:
-            os.close(ffmpeg_write_fd)
-        except OSError:
-            pass
-        f = rec_ref.get("file")
-        if f is not None:
-            try:
-                f.close()
-            except OSError:
-                pass
-            rec_ref["file"] = None
-
-
-# conf からポートを読み込み
+# conf からポート・サーバー方式を読み込み
 WEB_PORT = 8080
+WEB_SERVER = "threading"  # threading (接続ごとにスレッド) / asyncio (web/aio_server.py)
 _conf_path = os.path.join(AUTOREC_DIR, "conf", "autorec.conf")
 if os.path.exists(_conf_path):
     with open(_conf_path) as f:
@@ -86,6 +56,8 @@ if os.path.exists(_conf_path):
                     WEB_PORT = int(line.split("=", 1)[1].strip().strip('"').strip("'"))
                 except ValueError:
                     pass
+            elif line.startswith("WEB_SERVER="):
+                WEB_SERVER = line.split("=", 1)[1].strip().strip('"').strip("'") or WEB_SERVER
 
 
 class AutorecHandler(SimpleHTTPRequestHandler):
@@ -95,26 +67,34 @@ class AutorecHandler(SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=STATIC_DIR, **kwargs)
 
-    def _get_quality_args(self, params):
+    def _get_quality_name(self, params):
         quality = params.get("quality", [DEFAULT_QUALITY])[0]
-        preset = QUALITY_PRESETS.get(quality, QUALITY_PRESETS[DEFAULT_QUALITY])
+        return quality if quality in QUALITY_PRESETS else DEFAULT_QUALITY
+
+    def _get_quality_args(self, params):
+        preset = QUALITY_PRESETS[self._get_quality_name(params)]
         return preset["video"] + preset["audio"]
 
+    def _client_key(self, params):
+        """録画再生のジョブ置き換え単位 (接続元 + ページごとの client パラメータ)"""
+        return f"{self.client_address[0]}/{params.get('client', [''])[0]}"
+
     def do_GET(self):
         parsed = urlparse(self.path)
         if parsed.path.startswith("/api/"):
             self._handle_api("GET", parsed)
         elif parsed.path == "/recordings/transcode":
             self._serve_recording_transcode(parsed)
+        elif parsed.path == "/recordings/hls/playlist.m3u8":
+            self._serve_hls_playlist(parsed)
+        elif parsed.path.startswith("/recordings/hls/"):
+            self._serve_hls_segment(parsed)
         elif parsed.path.startswith("/recordings/"):
             self._serve_recording(parsed)
         elif parsed.path == "/live/stream":
             self._serve_live_stream(parsed)
         else:
-            # 静的ファイル配信
-            if parsed.path == "/":
-                self.path = "/index.html"
-            super().do_GET()
+            self._serve_static(parsed)
 
     def end_headers(self):
         """静的ファイルに Cache-Control ヘッダを追加"""
@@ -153,23 +133,58 @@ class AutorecHandler(SimpleHTTPRequestHandler):
             if content_length > 0:
                 body = self.rfile.read(content_length)
 
+        headers = {}
         try:
-            status, content_type, response_body = api.handle_request(
-                method, parsed.path, params, body
-            )
+            result = api.handle_request(method, parsed.path, params, body)
+            status, content_type, response_body = result[:3]
+            if len(result) > 3:
+                headers = result[3]
         except Exception as e:
             status = 500
             content_type = "application/json"
             import json
             response_body = json.dumps({"error": str(e)}).encode("utf-8")
 
+        headers = dict(headers, **{"Access-Control-Allow-Origin": "*"})
+        if method == "GET" and status == 200:
+            headers.setdefault("Cache-Control", "no-cache")
+            self._send_negotiated(content_type, response_body, headers)
+            return
         self.send_response(status)
         self.send_header("Content-Type", content_type)
         self.send_header("Content-Length", len(response_body))
-        self.send_header("Access-Control-Allow-Origin", "*")
+        for name, value in headers.items():
+            self.send_header(name, value)
         self.end_headers()
         self.wfile.write(response_body)
 
+    def _send_negotiated(self, content_type, body, headers, gzipped=None):
+        """200 のレスポンスを If-None-Match (→ 304)・Accept-Encoding (→ gzip) に合わせて送る"""
+        not_modified, body, negotiated = httpcache.negotiate(
+            self.headers, content_type, body, headers.pop("ETag", None), gzipped)
+        self.send_response(304 if not_modified else 200)
+        if not not_modified:
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", len(body))
+        for name, value in dict(headers, **negotiated).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(body)
+
+    def _serve_static(self, parsed):
+        """静的ファイル配信 (メモリにキャッシュし、ETag・gzip に対応)"""
+        path = "/index.html" if parsed.path == "/" else unquote(parsed.path)
+        static = httpcache.static_file(STATIC_DIR, path)
+        if static is None:
+            # キャッシュしないもの (ディレクトリ・大きなファイル) と 404 は標準の処理に任せる
+            if parsed.path == "/":
+                self.path = "/index.html"
+            super().do_GET()
+            return
+        self._send_negotiated(static.content_type, static.body, {"ETag": static.etag},
+                              static.gzipped)
+
     def _serve_recording(self, parsed):
         """録画ファイル配信 (Range リクエスト対応)"""
         # パスをデコードして RECORD_DIR 配下のファイルパスを構築
@@ -225,6 +240,8 @@ class AutorecHandler(SimpleHTTPRequestHandler):
 
         if file_path.endswith('.nicojk'):
             content_type = "application/x-ndjson"
+        elif file_path.endswith('.mp4'):
+            content_type = "video/mp4"
         else:
             content_type = "video/mp2t"
         self.send_header("Content-Type", content_type)
@@ -285,30 +302,48 @@ class AutorecHandler(SimpleHTTPRequestHandler):
                 self.send_error(400, "Invalid ss parameter")
                 return
 
+        if hls.enabled():
+            self._serve_segmented_transcode(file_path, float(ss or 0), params)
+            return
+
         cmd = [
             "ffmpeg",
             "-hide_banner", "-loglevel", "error",
             "-analyzeduration", "1000000",
             "-probesize", "2000000",
         ]
-        if ss:
-            cmd += ["-ss", ss]
         quality_args = self._get_quality_args(params)
-        cmd += ["-i", file_path] + quality_args + [
+        input_args, src = api.recording_input(file_path, float(ss or 0))
+        cmd += input_args + quality_args + [
             "-f", "mpegts",
             "-mpegts_flags", "+resend_headers",
             "pipe:1",
         ]
 
+        ticket = transcode.scheduler.acquire(
+            transcode.VOD, self._get_quality_name(params),
+            client=self._client_key(params), label=os.path.basename(file_path),
+        )
+        if ticket is None:
+            if src is not None:
+                src.close()
+            self.send_error(503, "Transcode queue is full")
+            return
         try:
             ffmpeg = subprocess.Popen(
                 cmd,
+                stdin=src or subprocess.DEVNULL,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.DEVNULL,
             )
         except FileNotFoundError:
+            ticket.release()
             self.send_error(503, "ffmpeg not found (playback requires ffmpeg for transcoding)")
             return
+        finally:
+            if src is not None:
+                src.close()
+        ticket.attach(ffmpeg)
 
         try:
             self.send_response(200)
@@ -333,9 +368,142 @@ class AutorecHandler(SimpleHTTPRequestHandler):
             except subprocess.TimeoutExpired:
                 ffmpeg.kill()
                 ffmpeg.wait()
+            ticket.release()
+
+    def _get_segment_store(self, file_path, params):
+        """録画と画質に対応するセグメントキャッシュ。失敗時はエラー送信して None"""
+        try:
+            return hls.get_cache().store(
+                file_path, self._get_quality_name(params), self._get_quality_args(params)
+            )
+        except FileNotFoundError:
+            self.send_error(503, "ffprobe not found (playback requires ffmpeg for transcoding)")
+        except (OSError, KeyError, ValueError, subprocess.TimeoutExpired):
+            self.send_error(500, "Could not determine duration")
+        return None
+
+    def _sendfile(self, path):
+        """ファイル全体を os.sendfile() でソケットへ送る"""
+        with open(path, "rb") as f:
+            self.wfile.flush()
+            out_fd = self.wfile.fileno()
+            in_fd = f.fileno()
+            offset = 0
+            remaining = os.fstat(in_fd).st_size
+            while remaining > 0:
+                sent = os.sendfile(out_fd, in_fd, offset, remaining)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+
+    def _serve_segmented_transcode(self, file_path, ss, params):
+        """セグメントキャッシュを ss を含むセグメントから順に連結して配信
+
+        シーク位置はセグメント境界に切り下げる (クライアントは
+        /api/recordings/duration の segment_duration で基準時刻を合わせる)。
+        """
+        store = self._get_segment_store(file_path, params)
+        if store is None:
+            return
+        index = int(ss // hls.SEGMENT_SECONDS)
+        client = self._client_key(params)
+        first = store.get_segment(index, client=client)
+        if first is None:
+            self.send_error(503, "Segment transcode failed")
+            return
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "video/mp2t")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.send_header("Cache-Control", "no-cache, no-store")
+            self.send_header("X-Segment-Start", str(index * hls.SEGMENT_SECONDS))
+            self.send_header("Connection", "close")
+            self.end_headers()
+
+            path = first
+            while path is not None:
+                self._sendfile(path)
+                index += 1
+                path = store.get_segment(index, client=client)
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
+
+    def _serve_hls_playlist(self, parsed):
+        """GET /recordings/hls/playlist.m3u8?path=...&quality=... - VOD プレイリスト"""
+        if not hls.enabled():
+            self.send_error(404, "HLS cache is disabled")
+            return
+        params = parse_qs(parsed.query)
+        rel_path = params.get("path", [""])[0]
+        if not rel_path:
+            self.send_error(400, "path parameter is required")
+            return
+
+        file_path = os.path.realpath(os.path.join(api.RECORD_DIR, rel_path))
+
+        # パストラバーサル防止
+        record_dir_real = os.path.realpath(api.RECORD_DIR)
+        if not file_path.startswith(record_dir_real + os.sep) and file_path != record_dir_real:
+            self.send_error(403, "Forbidden")
+            return
+
+        if not os.path.isfile(file_path):
+            self.send_error(404, "Not Found")
+            return
+
+        store = self._get_segment_store(file_path, params)
+        if store is None:
+            return
+        client = quote(params.get("client", [""])[0])
+        body = store.playlist(
+            lambda i: f"/recordings/hls/{store.key}/{store.quality}/{i}.ts?client={client}"
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.apple.mpegurl")
+        self.send_header("Content-Length", len(body))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _serve_hls_segment(self, parsed):
+        """GET /recordings/hls/<key>/<quality>/<index>.ts - セグメント配信"""
+        parts = parsed.path[len("/recordings/hls/"):].split("/")
+        if len(parts) != 3 or not parts[2].endswith(".ts"):
+            self.send_error(404, "Not Found")
+            return
+        key, quality, name = parts
+        try:
+            index = int(name[:-3])
+        except ValueError:
+            self.send_error(404, "Not Found")
+            return
+        if quality not in QUALITY_PRESETS or not key.isalnum():
+            self.send_error(404, "Not Found")
+            return
+
+        preset = QUALITY_PRESETS[quality]
+        store = hls.get_cache().lookup(key, quality, preset["video"] + preset["audio"])
+        if store is None:
+            self.send_error(404, "Not Found")
+            return
+        path = store.get_segment(index, client=self._client_key(parse_qs(parsed.query)))
+        if path is None:
+            self.send_error(404, "Segment not available")
+            return
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "video/mp2t")
+            self.send_header("Content-Length", os.path.getsize(path))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.send_header("Cache-Control", "max-age=86400")
+            self.end_headers()
+            self._sendfile(path)
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
 
     def _serve_live_stream(self, parsed):
-        """ライブTV ストリーム配信 (recpt1 → ffmpeg → HTTP)"""
+        """ライブTV ストリーム配信 (recpt1 → ffmpeg → HTTP, 同一チャンネル・画質は共有)"""
         params = parse_qs(parsed.query)
         ch = params.get("ch", [""])[0]
         if not ch:
@@ -348,78 +516,64 @@ class AutorecHandler(SimpleHTTPRequestHandler):
             return
 
         channel_name = valid_channels[ch]
+        quality = self._get_quality_name(params)
+
+        rewind = params.get("rewind", [""])[0]
+        if rewind:
+            try:
+                rewind = float(rewind)
+            except ValueError:
+                self.send_error(400, "Invalid rewind parameter")
+                return
+            if rewind > 0:
+                self._serve_timeshift_stream(ch, rewind, quality, params)
+                return
 
-        # recpt1 起動
         try:
-            recpt1 = subprocess.Popen(
-                ["recpt1", "--b25", "--strip", ch, "-", "-"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+            session, sub = live.hub.subscribe(
+                ch, channel_name, quality, self._get_quality_args(params),
+                self.address_string(),
             )
-        except FileNotFoundError:
-            self.send_error(503, "recpt1 not found")
+        except live.LiveStreamError as e:
+            self.send_error(e.status, e.message)
             return
 
-        # 0.5秒待って起動エラー検出
-        time.sleep(0.5)
-        if recpt1.poll() is not None:
-            stderr_out = recpt1.stderr.read().decode("utf-8", errors="replace")
-            self.send_error(503, f"recpt1 failed to start: {stderr_out[:200]}")
-            return
+        try:
+            # レスポンスヘッダ送信 (Content-Length なし → 接続終了で完了)
+            self.send_response(200)
+            self.send_header("Content-Type", "video/mp2t")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.send_header("Cache-Control", "no-cache, no-store")
+            self.send_header("Connection", "close")
+            self.end_headers()
 
-        # ffmpeg でトランスコード (MPEG-2 → H.264, ブラウザ MSE 互換)
-        quality_args = self._get_quality_args(params)
-        ffmpeg_cmd = [
-            "ffmpeg", "-hide_banner", "-loglevel", "error",
-            "-analyzeduration", "500000", "-probesize", "1000000",
-            "-fflags", "+nobuffer", "-i", "pipe:0",
-        ] + quality_args + [
-            "-f", "mpegts", "-mpegts_flags", "+resend_headers", "pipe:1",
-        ]
-        r_fd, w_fd = os.pipe()
+            # 共有パイプラインの出力をクライアントにストリーミング
+            while True:
+                data = sub.pop()
+                if data is None:
+                    break
+                self.wfile.write(data)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            # クライアント切断
+            pass
+        finally:
+            if sub.dropped:
+                self.log_message("live client dropped (buffer overflow): ch=%s", ch)
+            live.hub.unsubscribe(session, sub)
+
+    def _serve_timeshift_stream(self, ch, rewind, quality, params):
+        """タイムシフト再生 (受信中チャンネルのバッファを rewind 秒前から配信)"""
         try:
-            ffmpeg = subprocess.Popen(
-                ffmpeg_cmd,
-                stdin=r_fd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.DEVNULL,
+            session, player = live.hub.open_timeshift(
+                ch, rewind, quality, self._get_quality_args(params),
+                self.address_string(),
             )
-        except FileNotFoundError:
-            os.close(r_fd)
-            os.close(w_fd)
-            recpt1.terminate()
-            recpt1.wait()
-            self.send_error(503, "ffmpeg not found (live playback requires ffmpeg for transcoding)")
-            return
-        os.close(r_fd)
-
-        rec_ref = {"file": None, "path": None}
-        stop_event = threading.Event()
-        relay = threading.Thread(
-            target=_relay_thread,
-            args=(recpt1.stdout, w_fd, rec_ref, stop_event),
-            daemon=True,
-        )
-        relay.start()
-
-        # ストリーム登録 (上限チェック)
-        stream_id = api.register_live_stream(ch, channel_name, recpt1.pid, rec_ref)
-        if stream_id is None:
-            recpt1.terminate()
-            ffmpeg.terminate()
-            try:
-                ffmpeg.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                ffmpeg.kill()
-            try:
-                recpt1.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                recpt1.kill()
-            self.send_error(503, "Max live streams reached")
+        except live.LiveStreamError as e:
+            self.send_error(e.status, e.message)
             return
 
         try:
-            # レスポンスヘッダ送信 (Content-Length なし → 接続終了で完了)
             self.send_response(200)
             self.send_header("Content-Type", "video/mp2t")
             self.send_header("Access-Control-Allow-Origin", "*")
@@ -427,50 +581,16 @@ class AutorecHandler(SimpleHTTPRequestHandler):
             self.send_header("Connection", "close")
             self.end_headers()
 
-            # ffmpeg 出力をクライアントにストリーミング
             while True:
-                data = ffmpeg.stdout.read(65536)
+                data = player.read()
                 if not data:
                     break
                 self.wfile.write(data)
                 self.wfile.flush()
         except (BrokenPipeError, ConnectionResetError, OSError):
-            # クライアント切断
             pass
         finally:
-            stop_event.set()
-            # 録画ファイルのクローズ
-            f = rec_ref.get("file")
-            if f is not None:
-                try:
-                    f.close()
-                except OSError:
-                    pass
-                rec_ref["file"] = None
-            # jikkyo-rec.py の停止
-            jikkyo_proc = rec_ref.get("jikkyo_proc")
-            if jikkyo_proc:
-                jikkyo_proc.terminate()
-                try:
-                    jikkyo_proc.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    jikkyo_proc.kill()
-                rec_ref["jikkyo_proc"] = None
-            # recpt1 と ffmpeg を終了
-            recpt1.terminate()
-            ffmpeg.terminate()
-            try:
-                ffmpeg.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                ffmpeg.kill()
-                ffmpeg.wait()
-            try:
-                recpt1.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                recpt1.kill()
-                recpt1.wait()
-            relay.join(timeout=5)
-            api.unregister_live_stream(stream_id)
+            live.hub.close_timeshift(session, player)
 
     def do_OPTIONS(self):
         """CORS プリフライト対応"""
@@ -486,19 +606,32 @@ class AutorecHandler(SimpleHTTPRequestHandler):
 
 
 def main():
+    """Usage: python3 server.py [--asyncio | --threading] [PORT]"""
     port = WEB_PORT
-    if len(sys.argv) > 1:
+    mode = WEB_SERVER
+    for arg in sys.argv[1:]:
+        if arg in ("--asyncio", "--threading"):
+            mode = arg[2:]
+            continue
         try:
-            port = int(sys.argv[1])
+            port = int(arg)
         except ValueError:
             pass
 
-    server = ThreadingHTTPServer(("0.0.0.0", port), AutorecHandler)
-    print(f"[web] autorec Web UI 起動: http://0.0.0.0:{port}")
+    print(f"[web] autorec Web UI 起動: http://0.0.0.0:{port} ({mode})")
     print(f"[web] 静的ファイル: {STATIC_DIR}")
     print(f"[web] EPG DB: {api.EPG_DB}")
     print(f"[web] 管理 DB: {api.AUTOREC_DB}")
     print(f"[web] 録画先: {api.RECORD_DIR}")
+    if mode == "asyncio":
+        import aio_server
+        try:
+            aio_server.run(port, STATIC_DIR, QUALITY_PRESETS, DEFAULT_QUALITY)
+        except KeyboardInterrupt:
+            print("\n[web] サーバー停止")
+        return
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), AutorecHandler)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
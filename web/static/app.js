@@ -66,11 +66,14 @@ function escapeHtml(str) {
     return div.innerHTML;
 }
 
-function nowTimestamp() {
-    const d = new Date();
+function localTimestamp(d) {
     return `${d.getFullYear()}-${String(d.getMonth()+1).padStart(2,'0')}-${String(d.getDate()).padStart(2,'0')} ${String(d.getHours()).padStart(2,'0')}:${String(d.getMinutes()).padStart(2,'0')}:${String(d.getSeconds()).padStart(2,'0')}`;
 }
 
+function nowTimestamp() {
+    return localTimestamp(new Date());
+}
+
 function statusBadge(status) {
     return `<span class="badge badge-${status}">${status}</span>`;
 }
@@ -181,16 +184,61 @@ function switchFromDrawer(name, e) {
 // 番組データをグローバルに保持 (onclick軽量化)
 window._programmes = [];
 
+/* 放送日 (4:00 起点) の "YYYY-MM-DD" */
+function broadcastDate(d) {
+    const b = new Date(d.getTime() - 4 * 3600000);
+    return `${b.getFullYear()}-${String(b.getMonth()+1).padStart(2,'0')}-${String(b.getDate()).padStart(2,'0')}`;
+}
+
+/* 番組表グリッドを放送日ごとに取得し、activeAfter 以降に終わる番組の配列に戻す (説明は含まない) */
+async function fetchEPGGrid(activeAfter) {
+    const first = await API.get(`/api/programmes/grid?date=${broadcastDate(activeAfter)}`);
+    const dates = [];
+    if (first.last_date) {
+        const [y, m, d] = first.date.split('-').map(Number);
+        for (let i = 1; i <= 31; i++) {
+            const date = broadcastDate(new Date(y, m - 1, d + i, 12));
+            if (date > first.last_date) break;
+            dates.push(date);
+        }
+    }
+    const grids = [first, ...await Promise.all(dates.map(date => API.get(`/api/programmes/grid?date=${date}`)))];
+
+    const programmes = [];
+    const seen = new Set();  // 日をまたぐ番組は両方の日に入っている
+    grids.forEach(grid => {
+        const base = new Date(grid.base.replace(' ', 'T')).getTime();
+        const cols = grid.programmes;
+        for (let i = 0; i < cols.title.length; i++) {
+            const start = base + cols.start[i] * 1000;
+            const end = start + cols.duration[i] * 1000;
+            if (end <= activeAfter.getTime()) continue;
+            const channel = grid.channels[cols.channel[i]];
+            const key = `${channel}\t${cols.event_id[i]}`;
+            if (seen.has(key)) continue;
+            seen.add(key);
+            programmes.push({
+                event_id: cols.event_id[i],
+                channel,
+                title: cols.title[i],
+                start_time: localTimestamp(new Date(start)),
+                end_time: localTimestamp(new Date(end)),
+                category: cols.category[i] < 0 ? null : grid.categories[cols.category[i]],
+            });
+        }
+    });
+    programmes.sort((a, b) => (a.start_time < b.start_time ? -1 : a.start_time > b.start_time ? 1 :
+                               a.channel < b.channel ? -1 : a.channel > b.channel ? 1 : 0));
+    return programmes;
+}
+
 async function loadEPG() {
     const category = getFilterValue('epg-category');
-    const now = nowTimestamp();
-
-    let url = `/api/programmes?limit=10000&active_after=${encodeURIComponent(now)}`;
-    if (category) url += `&category=${encodeURIComponent(category)}`;
 
     try {
-        const data = await API.get(url);
-        renderEPGTable(data.programmes);
+        let programmes = await fetchEPGGrid(new Date());
+        if (category) programmes = programmes.filter(p => p.category && p.category.includes(category));
+        renderEPGTable(programmes);
     } catch (err) {
         document.getElementById('epg-table').innerHTML =
             `<p style="color:var(--error)">番組表の読み込みに失敗しました: ${escapeHtml(err.message)}</p>`;
@@ -453,7 +501,7 @@ function showProgrammeDetail(el, idx) {
             ${escapeHtml(p.channel)} | ${formatDateTime(p.start_time)} - ${formatTime(p.end_time)}
             ${p.category ? ' | ' + escapeHtml(p.category) : ''}
         </div>
-        <div class="desc">${escapeHtml(p.description || '')}</div>
+        <div class="desc">${p.description === undefined ? '読み込み中...' : escapeHtml(p.description || '')}</div>
         <div style="margin-top:0.75rem;display:flex;gap:0.5rem;flex-wrap:wrap">
             <button class="btn btn-primary btn-sm" onclick="directSchedule(${idx})">
                 録画予約
@@ -479,6 +527,21 @@ function showProgrammeDetail(el, idx) {
         detail.style.left = left + 'px';
     }
     detail.classList.add('active');
+    detail.dataset.idx = idx;
+
+    // 番組表グリッドの番組は説明を持っていないので、表示したときに取得する
+    if (p.description === undefined && !p._detailLoading) {
+        p._detailLoading = true;
+        API.get(`/api/programmes/detail?channel=${encodeURIComponent(p.channel)}&event_id=${p.event_id}`)
+            .then(data => {
+                p.description = data.programme.description || '';
+                if (window._programmes[idx] === p && detail.dataset.idx === String(idx)) {
+                    detail.querySelector('.desc').textContent = p.description;
+                }
+            })
+            .catch(() => {})
+            .finally(() => { p._detailLoading = false; });
+    }
 }
 
 function hideProgrammeDetail() {
@@ -878,12 +941,13 @@ function _buildSeriesHtml(series) {
         s.files.forEach(f => {
             const encodedPath = encodeURIComponent(f.path).replace(/%2F/g, '/');
             const nicojkPath = encodedPath.replace(/\.ts$/, '.nicojk');
+            const transcodedPath = f.transcoded ? encodeURIComponent(f.transcoded).replace(/%2F/g, '/') : '';
             html += `<tr>`;
             html += `<td class="recordings-filename">${escapeHtml(f.name)}</td>`;
             html += `<td style="white-space:nowrap">${formatFileSize(f.size)}</td>`;
             html += `<td style="white-space:nowrap">${escapeHtml(f.mtime)}</td>`;
             html += `<td style="white-space:nowrap">`;
-            html += `<button class="btn btn-primary btn-sm" onclick="playRecording('${encodedPath}', '${escapeHtml(f.name)}', ${!!f.has_nicojk})">再生</button> `;
+            html += `<button class="btn btn-primary btn-sm" onclick="playRecording('${encodedPath}', '${escapeHtml(f.name)}', ${!!f.has_nicojk}, '${transcodedPath}')">再生</button> `;
             html += `<a class="btn btn-secondary btn-sm" href="/recordings/${encodedPath}?download=1">DL</a>`;
             if (f.has_nicojk) {
                 html += ` <a class="btn btn-secondary btn-sm" href="/recordings/${nicojkPath}?download=1">実況DL</a>`;
@@ -896,11 +960,12 @@ function _buildSeriesHtml(series) {
         s.files.forEach(f => {
             const encodedPath = encodeURIComponent(f.path).replace(/%2F/g, '/');
             const nicojkPath = encodedPath.replace(/\.ts$/, '.nicojk');
+            const transcodedPath = f.transcoded ? encodeURIComponent(f.transcoded).replace(/%2F/g, '/') : '';
             html += `<div class="recordings-file-card-item">`;
             html += `<div class="recordings-file-card-name">${escapeHtml(f.name)}</div>`;
             html += `<div class="recordings-file-card-meta">${formatFileSize(f.size)} / ${escapeHtml(f.mtime)}</div>`;
             html += `<div class="recordings-file-card-actions">`;
-            html += `<button class="btn btn-primary btn-sm" onclick="playRecording('${encodedPath}', '${escapeHtml(f.name)}', ${!!f.has_nicojk})">再生</button>`;
+            html += `<button class="btn btn-primary btn-sm" onclick="playRecording('${encodedPath}', '${escapeHtml(f.name)}', ${!!f.has_nicojk}, '${transcodedPath}')">再生</button>`;
             html += `<a class="btn btn-secondary btn-sm" href="/recordings/${encodedPath}?download=1">DL</a>`;
             if (f.has_nicojk) {
                 html += `<a class="btn btn-secondary btn-sm" href="/recordings/${nicojkPath}?download=1">実況DL</a>`;
@@ -1038,8 +1103,12 @@ function filterRecordings() {
 
 let recordingPlayer = null;
 let recordingBaseTime = 0;
+let recordingSegmentDuration = 0;
 let recordingDuration = 0;
 let recordingPath = null;
+let recordingDirectUrl = null;  // 録画後トランスコード済み MP4 (あればリアルタイム変換しない)
+// サーバーはこの ID ごとに古い変換ジョブを止める (シークのたびに ffmpeg が残らないように)
+const transcodeClientId = Math.random().toString(36).slice(2, 10);
 let seekUpdateTimer = null;
 let seekBarDragging = false;
 
@@ -1212,23 +1281,26 @@ const recControls = (() => {
     };
 })();
 
-function playRecording(path, name, hasNicojk) {
+function playRecording(path, name, hasNicojk, transcodedPath) {
     const modal = document.getElementById('video-modal');
     const title = document.getElementById('video-modal-title');
     title.textContent = name || '再生';
 
     closeRecordingPlayer();
 
-    if (typeof mpegts !== 'undefined' && mpegts.isSupported()) {
+    if (transcodedPath || (typeof mpegts !== 'undefined' && mpegts.isSupported())) {
         recordingPath = decodeURIComponent(path);
+        recordingDirectUrl = transcodedPath ? '/recordings/' + transcodedPath : null;
         recordingBaseTime = 0;
         recordingDuration = 0;
+        recordingSegmentDuration = 0;
 
         // 再生時間を取得してシークバー初期化
         API.get(`/api/recordings/duration?path=${encodeURIComponent(recordingPath)}`)
             .then(data => {
                 if (data.duration) {
                     recordingDuration = data.duration;
+                    recordingSegmentDuration = recordingDirectUrl ? 0 : (data.segment_duration || 0);
                     const bar = document.getElementById('video-seek-bar');
                     bar.max = recordingDuration;
                     bar.value = 0;
@@ -1258,6 +1330,20 @@ function playRecording(path, name, hasNicojk) {
 function startRecordingStream(seekTime) {
     const videoEl = document.getElementById('video-player');
 
+    if (recordingDirectUrl) {
+        // 変換済み MP4 は Range リクエストでそのままシークできる
+        recordingBaseTime = 0;
+        if (videoEl.getAttribute('src') !== recordingDirectUrl) {
+            videoEl.src = recordingDirectUrl;
+        }
+        videoEl.currentTime = seekTime;
+        recordingJikkyo.onSeek();
+        videoEl.play().catch(() => {});
+        if (seekUpdateTimer) clearInterval(seekUpdateTimer);
+        seekUpdateTimer = setInterval(updateSeekBar, 500);
+        return;
+    }
+
     if (recordingPlayer) {
         recordingPlayer.destroy();
         recordingPlayer = null;
@@ -1266,10 +1352,14 @@ function startRecordingStream(seekTime) {
     videoEl.removeAttribute('src');
     videoEl.load();
 
+    // セグメントキャッシュ配信ではセグメント境界から再生される
+    if (recordingSegmentDuration > 0) {
+        seekTime = Math.floor(seekTime / recordingSegmentDuration) * recordingSegmentDuration;
+    }
     recordingBaseTime = seekTime;
     recordingJikkyo.onSeek();
 
-    let url = `/recordings/transcode?path=${encodeURIComponent(recordingPath)}&quality=${streamQuality}`;
+    let url = `/recordings/transcode?path=${encodeURIComponent(recordingPath)}&quality=${streamQuality}&client=${transcodeClientId}`;
     if (seekTime > 0) url += `&ss=${seekTime}`;
 
     recordingPlayer = mpegts.createPlayer({
@@ -1315,6 +1405,7 @@ function closeRecordingPlayer() {
     videoEl.removeAttribute('src');
     videoEl.load();
     recordingPath = null;
+    recordingDirectUrl = null;
     recordingBaseTime = 0;
     recordingDuration = 0;
     seekBarDragging = false;
@@ -2533,11 +2624,10 @@ async function init() {
     switchSection(initialSection);
 
     // チャンネル一覧と番組表を並列取得
-    const now = nowTimestamp();
     try {
-        const [chData, epgData, catData] = await Promise.all([
+        const [chData, programmes, catData] = await Promise.all([
             API.get('/api/channels'),
-            API.get(`/api/programmes?limit=10000&active_after=${encodeURIComponent(now)}`),
+            fetchEPGGrid(new Date()),
             API.get('/api/categories'),
         ]);
 
@@ -2565,7 +2655,7 @@ async function init() {
             catGroup.innerHTML = catBtns;
         }
 
-        renderEPGTable(epgData.programmes);
+        renderEPGTable(programmes);
 
         // チャンネルデータ取得完了後、ライブセクション表示中ならグリッド再描画
         if (document.getElementById('section-live').classList.contains('active')) {
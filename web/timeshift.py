@@ -0,0 +1,201 @@
+"""ライブ視聴のタイムシフトバッファ
+
+チャンネルごとに固定サイズのファイルを mmap したリングバッファへ受信 TS を書き続け、
+「N 秒前から再生」「N 秒前から録画」を再選局なしで実現する。
+位置はストリーム先頭からの通算バイト数 (絶対オフセット) で扱い、
+リングサイズは TS パケット長の倍数なのでパケット境界はリング上でも保たれる。
+"""
+import bisect
+import collections
+import mmap
+import os
+import threading
+import time
+
+TS_PACKET_SIZE = 188
+INDEX_INTERVAL = 1.0  # 時刻 → オフセット索引の記録間隔 (秒)
+
+
+def _align_up(offset):
+    return offset + (TS_PACKET_SIZE - offset % TS_PACKET_SIZE) % TS_PACKET_SIZE
+
+
+class TimeshiftBuffer:
+    """1 チャンネル分のリングバッファ
+
+    書き込みは relay スレッドのみ。読み出し側は written を見て追従し、
+    読んでいる間に上書きされた場合は最古位置から読み直す。
+    書き込み側はリングに書く前に writing_end (書き込み中の区間の終わり) を進めるので、
+    written に反映される前の上書きも読み出し側から見える。
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size - size % TS_PACKET_SIZE
+        self.written = 0  # 通算書き込みバイト数
+        self.writing_end = 0  # 書き込み中の区間の終わり (written 以上)
+        self.closed = False
+        self._index_times = collections.deque()
+        self._index_offsets = collections.deque()
+        self._cond = threading.Condition()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            os.ftruncate(self.fd, self.size)
+            self.mm = mmap.mmap(self.fd, self.size)
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.view = memoryview(self.mm)
+
+    # --- 書き込み (relay スレッド) ---
+
+    def _commit(self, n):
+        """n バイト書き込み済みとして通算位置と索引を進める"""
+        now = time.time()
+        with self._cond:
+            self.written += n
+            if not self._index_times or now - self._index_times[-1] >= INDEX_INTERVAL:
+                self._index_times.append(now)
+                self._index_offsets.append(self.written)
+            oldest = self.written - self.size
+            while self._index_offsets and self._index_offsets[0] < oldest:
+                self._index_times.popleft()
+                self._index_offsets.popleft()
+            self._cond.notify_all()
+
+    def read_from(self, src_fd, count):
+        """src_fd から最大 count バイトを直接リングへ読み込む。(開始オフセット, バイト数)"""
+        start = self.written
+        pos = start % self.size
+        count = min(count, self.size - pos)
+        self.writing_end = start + count
+        n = os.readv(src_fd, [self.view[pos:pos + count]])
+        if n:
+            self._commit(n)
+        return start, n
+
+    def splice_from(self, src_fd, count, exact=False):
+        """パイプからリングへ splice (カーネル内転送)。(開始オフセット, バイト数)
+
+        exact=True なら tee 済みの count バイトをちょうど消費するまで繰り返す。
+        """
+        start = self.written
+        self.writing_end = start + count
+        done = 0
+        while done < count:
+            pos = (start + done) % self.size
+            n = os.splice(src_fd, self.fd, min(count - done, self.size - pos), offset_dst=pos)
+            if n == 0:
+                if exact:
+                    raise OSError("unexpected EOF while splicing")
+                break
+            done += n
+            if not exact:
+                break
+        if done:
+            self._commit(done)
+        return start, done
+
+    def slices(self, start, end):
+        """絶対オフセット [start, end) に対応するリング上の memoryview (最大 2 個)"""
+        out = []
+        while start < end:
+            pos = start % self.size
+            n = min(end - start, self.size - pos)
+            out.append(self.view[pos:pos + n])
+            start += n
+        return out
+
+    def copy_to(self, f, start, end):
+        """[start, end) をファイルへ追記 (copy_file_range が使えなければ mmap から write)"""
+        f.flush()
+        out_fd = f.fileno()
+        while start < end:
+            pos = start % self.size
+            n = min(end - start, self.size - pos)
+            try:
+                copied = os.copy_file_range(self.fd, out_fd, n, pos)
+            except (OSError, AttributeError):
+                copied = os.write(out_fd, self.view[pos:pos + n])
+            if copied <= 0:
+                raise OSError("copy to recording file failed")
+            start += copied
+
+    # --- 読み出し ---
+
+    def oldest(self):
+        """上書きされていない最古のオフセット"""
+        return max(0, self.written - self.size)
+
+    def _readable(self):
+        """書き込み中の区間にも上書きされていない最古のオフセット"""
+        return max(0, self.writing_end - self.size)
+
+    def seconds_available(self):
+        with self._cond:
+            if not self._index_times:
+                return 0.0
+            return time.time() - self._index_times[0]
+
+    def offset_for(self, seconds_ago):
+        """「seconds_ago 秒前」に相当するパケット境界のオフセット"""
+        target = time.time() - seconds_ago
+        with self._cond:
+            i = bisect.bisect_left(self._index_times, target)
+            if i >= len(self._index_offsets):
+                offset = self.written
+            elif i == 0:
+                offset = self.oldest()
+            else:
+                # 索引点の間は線形補間
+                t0, t1 = self._index_times[i - 1], self._index_times[i]
+                o0, o1 = self._index_offsets[i - 1], self._index_offsets[i]
+                offset = o0 + int((o1 - o0) * (target - t0) / (t1 - t0)) if t1 > t0 else o0
+        oldest = self.oldest()
+        if offset <= oldest:
+            return _align_up(oldest)
+        return offset - offset % TS_PACKET_SIZE
+
+    def read_at(self, offset, max_bytes, timeout=1.0):
+        """offset から読めるだけ返す → (次のオフセット, bytes)
+
+        データ待ちでタイムアウトしたら空 bytes。上書き済みの位置なら最古位置へ進める。
+        """
+        with self._cond:
+            while offset >= self.written and not self.closed:
+                if not self._cond.wait(timeout):
+                    return offset, b""
+            if offset >= self.written:
+                return offset, b""
+            end = min(self.written, offset + max_bytes)
+        while True:
+            oldest = self._readable()
+            if offset < oldest:
+                offset = _align_up(oldest)
+                end = max(offset, min(self.written, offset + max_bytes))
+            data = b"".join(bytes(v) for v in self.slices(offset, end))
+            # コピー中に追い越されていなければ確定 (書き込み中の区間も追い越しに数える)
+            if offset >= self._readable():
+                return end, data
+
+    def info(self):
+        return {
+            "size": self.size,
+            "bytes": min(self.written, self.size),
+            "seconds": round(self.seconds_available(), 1),
+        }
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        try:
+            self.view.release()
+            self.mm.close()
+        except (BufferError, ValueError):
+            pass
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
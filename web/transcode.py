@@ -0,0 +1,217 @@
+"""トランスコード (ffmpeg) の受付制御
+
+ライブ・タイムシフト・録画再生で起動する ffmpeg をすべてここで受け付け、
+画質ごとの推定 CPU コストの合計が TRANSCODE_CPU_BUDGET (コア数) を超えないようにする。
+
+- ライブは待たせない。予算が足りなければ録画再生のジョブを止めて枠を空ける
+- 録画再生は予算が空くまで待ち行列に並ぶ (TRANSCODE_QUEUE_TIMEOUT 秒で諦める)
+- 同じクライアントが新しい録画再生ジョブを要求したら、前のジョブは即座に kill する
+- SIGSTOP で一時停止中のジョブ (セグメントの先読み待ち) は予算に数えない
+"""
+import itertools
+import os
+import threading
+import time
+
+import api
+
+LIVE = "live"
+VOD = "vod"
+
+# 画質ごとの推定 CPU コスト (コア数, 1080i → H.264 ultrafast を 1.0 とする)
+QUALITY_COST = {"high": 1.0, "low": 0.5, "lowest": 0.3}
+
+
+def budget():
+    return api.TRANSCODE_CPU_BUDGET or float(os.cpu_count() or 1)
+
+
+class Ticket:
+    """受け付けた ffmpeg 1 本分の枠
+
+    attach() で ffmpeg のプロセスを結び付けておくと、
+    横取り・置き換えで取り消されたときにそのプロセスを kill する。
+    """
+
+    def __init__(self, scheduler, ticket_id, kind, quality, client, label, on_cancel):
+        self.scheduler = scheduler
+        self.id = ticket_id
+        self.kind = kind
+        self.quality = quality
+        self.client = client
+        self.label = label
+        self.cost = QUALITY_COST.get(quality, 1.0)
+        self.state = "waiting"  # waiting / running / suspended / done
+        self.cancelled = False
+        self.superseded = False  # 同じクライアントの新しい要求で取り消された
+        self.queued_at = time.time()
+        self.started_at = None
+        self._on_cancel = on_cancel
+        self._proc = None
+
+    def attach(self, proc):
+        """ffmpeg プロセスを結び付ける (取り消し済みなら即 kill)"""
+        with self.scheduler._cond:
+            self._proc = proc
+            cancelled = self.cancelled
+        if cancelled:
+            _kill(proc)
+
+    def suspend(self):
+        """一時停止中は予算を返す"""
+        self.scheduler._set_state(self, "running", "suspended")
+
+    def resume(self):
+        """再開できるだけの予算があれば running に戻して True"""
+        return self.scheduler._resume(self)
+
+    def release(self):
+        self.scheduler._release(self)
+
+    def _cancel(self):
+        """予算を空けるための取り消し (スケジューラのロック外で呼ぶ)"""
+        if self._on_cancel is not None:
+            self._on_cancel()
+        if self._proc is not None:
+            _kill(self._proc)
+
+    def info(self):
+        now = time.time()
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "quality": self.quality,
+            "client": self.client,
+            "label": self.label,
+            "cost": self.cost,
+            "state": "cancelled" if self.cancelled and self.state != "done" else self.state,
+            "waiting_seconds": round((self.started_at or now) - self.queued_at, 1),
+            "running_seconds": round(now - self.started_at, 1) if self.started_at else None,
+        }
+
+
+def _kill(proc):
+    """待たずに kill (終了の回収は起動した側が行う)"""
+    try:
+        proc.kill()
+    except OSError:
+        pass
+
+
+class TranscodeScheduler:
+    """プロセス全体で 1 つの受付窓口"""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._waiting = []  # 録画再生の待ち行列 (FIFO)
+        self._active = []   # running / suspended
+        self._cond = threading.Condition()
+
+    def _used(self):
+        return sum(t.cost for t in self._active if t.state == "running" and not t.cancelled)
+
+    def _fits(self, cost):
+        used = self._used()
+        # 予算より重いジョブでも他に何も動いていなければ通す
+        return used == 0 or used + cost <= budget()
+
+    def acquire(self, kind, quality, client=None, label="", on_cancel=None,
+                timeout=None):
+        """枠を確保して Ticket を返す。確保できなければ None
+
+        on_cancel は横取り・置き換えで取り消されるとき (プロセス kill の直前) に呼ばれる。
+        """
+        ticket = Ticket(self, next(self._ids), kind, quality, client, label, on_cancel)
+        victims = []
+        with self._cond:
+            if kind == VOD and client:
+                # 同じクライアントの古い録画再生ジョブは不要になる
+                for t in self._waiting + self._active:
+                    if t.kind == VOD and t.client == client and not t.cancelled:
+                        t.cancelled = True
+                        t.superseded = True
+                        victims.append(t)
+            if kind == LIVE:
+                if not self._fits(ticket.cost):
+                    victims += self._preempt(ticket.cost)
+                if self._fits(ticket.cost):
+                    self._start(ticket)
+                else:
+                    ticket = None
+            else:
+                self._waiting.append(ticket)
+            self._cond.notify_all()
+        for t in victims:
+            t._cancel()
+        if kind == LIVE:
+            return ticket
+        return self._wait(ticket, api.TRANSCODE_QUEUE_TIMEOUT if timeout is None else timeout)
+
+    def _wait(self, ticket, timeout):
+        """待ち行列の先頭になり予算が空くまで待つ"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not ticket.cancelled:
+                if self._waiting[0] is ticket and self._fits(ticket.cost):
+                    self._waiting.remove(ticket)
+                    self._start(ticket)
+                    return ticket
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self._waiting.remove(ticket)
+            ticket.state = "done"
+            self._cond.notify_all()
+            return None
+
+    def _start(self, ticket):
+        ticket.state = "running"
+        ticket.started_at = time.time()
+        self._active.append(ticket)
+
+    def _preempt(self, cost):
+        """ライブのために録画再生ジョブを新しいものから取り消す"""
+        victims = []
+        for t in sorted(self._active, key=lambda t: t.started_at, reverse=True):
+            if self._fits(cost):
+                break
+            if t.kind == VOD and t.state == "running" and not t.cancelled:
+                t.cancelled = True
+                victims.append(t)
+        return victims
+
+    def _set_state(self, ticket, old, new):
+        with self._cond:
+            if ticket.state == old:
+                ticket.state = new
+                self._cond.notify_all()
+
+    def _resume(self, ticket):
+        with self._cond:
+            if ticket.state != "suspended":
+                return ticket.state == "running"
+            if not self._fits(ticket.cost):
+                return False
+            ticket.state = "running"
+            return True
+
+    def _release(self, ticket):
+        with self._cond:
+            if ticket in self._active:
+                self._active.remove(ticket)
+            ticket.state = "done"
+            self._cond.notify_all()
+
+    def status(self):
+        with self._cond:
+            return {
+                "budget": budget(),
+                "used": round(self._used(), 2),
+                "queue_depth": len(self._waiting),
+                "running": [t.info() for t in self._active],
+                "queued": [t.info() for t in self._waiting],
+            }
+
+
+scheduler = TranscodeScheduler()
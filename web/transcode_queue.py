@@ -0,0 +1,166 @@
+"""録画後トランスコードのジョブキュー
+
+record.sh が録画完了時に transcode_job テーブルへ登録し、
+bin/transcode-worker.py がワーカープールで H.264/AAC の MP4 に変換する。
+変換結果は録画と同じディレクトリに <名前>.mp4 として置き、
+Web UI はこれがあればリアルタイム変換をせずに /recordings/ から直接再生する。
+"""
+import fcntl
+import os
+import subprocess
+import threading
+
+import api
+
+LOCK_FILE = os.path.join(api.AUTOREC_DIR, "db", "transcode-worker.lock")
+
+
+def output_path(file_path):
+    """録画ファイルに対応する変換済みファイルのパス"""
+    return os.path.splitext(file_path)[0] + ".mp4"
+
+
+def _resolve(path):
+    """絶対パス or RECORD_DIR 相対パス → (絶対パス, 相対パス)。RECORD_DIR 外なら ValueError"""
+    file_path = os.path.realpath(os.path.join(api.RECORD_DIR, path))
+    record_dir_real = os.path.realpath(api.RECORD_DIR)
+    if not file_path.startswith(record_dir_real + os.sep):
+        raise ValueError(f"not under RECORD_DIR: {path}")
+    return file_path, os.path.relpath(file_path, record_dir_real)
+
+
+def enqueue(path):
+    """録画ファイルをキューに登録 (登録済みで実行中でなければ再投入)"""
+    _file_path, rel_path = _resolve(path)
+    with api.writing(api.AUTOREC_DB) as conn:
+        conn.execute(
+            "INSERT INTO transcode_job (path) VALUES (?) "
+            "ON CONFLICT(path) DO UPDATE SET status = 'queued', output = NULL, error = NULL, "
+            "created_at = datetime('now','localtime'), started_at = NULL, finished_at = NULL "
+            "WHERE status != 'running'",
+            (rel_path,),
+        )
+    return rel_path
+
+
+def enqueue_missing():
+    """変換済みファイルもジョブもない録画をすべて登録。登録数を返す"""
+    known = {row["path"] for row in
+             api._read_db(api.AUTOREC_DB).execute("SELECT path FROM transcode_job")}
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(api.RECORD_DIR):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for name in filenames:
+            if not name.endswith(".ts"):
+                continue
+            file_path = os.path.join(dirpath, name)
+            if os.path.isfile(output_path(file_path)):
+                continue
+            if os.path.relpath(file_path, api.RECORD_DIR) in known:
+                continue
+            enqueue(file_path)
+            count += 1
+    return count
+
+
+def _claim():
+    """待ち行列の先頭ジョブを running にして返す。なければ None"""
+    with api.writing(api.AUTOREC_DB) as conn:
+        row = conn.execute(
+            "SELECT id, path FROM transcode_job WHERE status = 'queued' ORDER BY id LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE transcode_job SET status = 'running', "
+            "started_at = datetime('now','localtime') WHERE id = ?",
+            (row["id"],),
+        )
+    return dict(row)
+
+
+def _finish(job_id, status, output=None, error=None):
+    with api.writing(api.AUTOREC_DB) as conn:
+        conn.execute(
+            "UPDATE transcode_job SET status = ?, output = ?, error = ?, "
+            "finished_at = datetime('now','localtime') WHERE id = ?",
+            (status, output, error, job_id),
+        )
+
+
+def _transcode_cmd(src, dst):
+    return [
+        "nice", "-n", str(api.TRANSCODE_NICE),
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+        "-i", src,
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-vf", "yadif",
+        "-c:v", "libx264", "-preset", api.TRANSCODE_PRESET, "-crf", str(api.TRANSCODE_CRF),
+        "-c:a", "aac", "-b:a", "192k",
+        "-movflags", "+faststart",
+        "-f", "mp4", dst,
+    ]
+
+
+def run_job(job):
+    """1 ジョブを変換。一時ファイルに書き出して完了後に rename する"""
+    try:
+        src, _rel = _resolve(job["path"])
+    except ValueError as e:
+        _finish(job["id"], "failed", error=str(e))
+        return False
+    if not os.path.isfile(src):
+        _finish(job["id"], "failed", error="source not found")
+        return False
+    dst = output_path(src)
+    tmp = dst + ".part"
+    print(f"[transcode] 開始: {job['path']}", flush=True)
+    try:
+        result = subprocess.run(
+            _transcode_cmd(src, tmp),
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        _finish(job["id"], "failed", error="ffmpeg not found")
+        return False
+    if result.returncode != 0 or not os.path.isfile(tmp):
+        lines = result.stderr.decode("utf-8", "replace").strip().splitlines()
+        error = lines[-1] if lines else f"ffmpeg exited with {result.returncode}"
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        _finish(job["id"], "failed", error=error)
+        print(f"[transcode] 失敗: {job['path']}: {error}", flush=True)
+        return False
+    os.replace(tmp, dst)
+    _finish(job["id"], "done", output=os.path.relpath(dst, os.path.realpath(api.RECORD_DIR)))
+    print(f"[transcode] 完了: {job['path']}", flush=True)
+    return True
+
+
+def _worker_loop():
+    while True:
+        job = _claim()
+        if job is None:
+            return
+        run_job(job)
+
+
+def run(concurrency=None):
+    """キューが空になるまで処理する
+
+    ワーカーはプロセス単位で 1 つだけ動かす (ロックファイルで排他)。
+    先行ワーカーの実行中に起動された場合は終了を待ってから残りを処理する。
+    """
+    concurrency = max(1, concurrency or api.TRANSCODE_CONCURRENCY)
+    with open(LOCK_FILE, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # 前回のワーカーが異常終了して running のまま残ったジョブを戻す
+        with api.writing(api.AUTOREC_DB) as conn:
+            conn.execute("UPDATE transcode_job SET status = 'queued' WHERE status = 'running'")
+        workers = [threading.Thread(target=_worker_loop) for _ in range(concurrency)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
@@ -0,0 +1,595 @@
+"""MPEG-TS の簡易解析 (ffprobe を使わずに再生時間・放送時刻を求める)
+
+ファイルの先頭と末尾の数 MB だけを mmap で読み、
+- PCR (無ければ PES の PTS) の差から再生時間
+- TDT/TOT (ARIB では JST) から録画の開始・終了時刻
+を計算する。途中のデータは読まないので、ライブラリ全体に対しても軽く回せる。
+
+シーク用には、数秒おきのキーフレームの (時刻, バイト位置) を録画ごとの
+サイドカーファイル (.tsidx) に保存しておき、指定時刻の直前のキーフレームから
+ffmpeg に読ませる (SeekIndex)。
+"""
+import bisect
+import functools
+import itertools
+import mmap
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:  # 無ければ標準ライブラリのみで同じ処理をする
+    numpy = None
+
+TS_PACKET_SIZE = 188
+TDT_PID = 0x0014
+CLOCK_WRAP = 1 << 33           # PCR base / PTS は 33 bit (90kHz)
+CLOCK_HZ = 90000
+
+PCR_SCAN_BYTES = 4 * 1024 * 1024    # PCR/PTS を探す範囲 (先頭・末尾それぞれ)
+TDT_SCAN_BYTES = 16 * 1024 * 1024   # TDT/TOT を探す範囲 (ARIB の送出間隔は 5 秒程度)
+
+SEEK_INDEX_SUFFIX = ".tsidx"
+SEEK_INDEX_INTERVAL = 2.0           # キーフレームを記録する間隔 (秒, 目安)
+PES_SCAN_BYTES = 1024 * 1024        # 各ストリームの先頭 PES を探す範囲 (ffmpeg の probe と同程度)
+
+
+def find_sync(buf, start=0, end=None):
+    """3 連続でパケット境界に sync byte (0x47) が並ぶ位置。見つからなければ -1"""
+    if end is None:
+        end = len(buf)
+    limit = min(end - TS_PACKET_SIZE * 3, start + TS_PACKET_SIZE)
+    for i in range(start, limit):
+        if (buf[i] == 0x47
+                and buf[i + TS_PACKET_SIZE] == 0x47
+                and buf[i + TS_PACKET_SIZE * 2] == 0x47):
+            return i
+    return -1
+
+
+def packet_pid(buf, pos):
+    return ((buf[pos + 1] & 0x1F) << 8) | buf[pos + 2]
+
+
+def payload_offset(buf, pos):
+    """パケット内の payload 開始位置。payload が無ければ None"""
+    afc = (buf[pos + 3] >> 4) & 0x03
+    if not (afc & 0x01):
+        return None
+    start = pos + 4
+    if afc == 3:
+        start = pos + 5 + buf[pos + 4]
+    if start >= pos + TS_PACKET_SIZE:
+        return None
+    return start
+
+
+def packet_pcr(buf, pos):
+    """adaptation field の PCR (90kHz 単位の base)。無ければ None"""
+    afc = (buf[pos + 3] >> 4) & 0x03
+    if not (afc & 0x02) or buf[pos + 4] < 7 or not (buf[pos + 5] & 0x10):
+        return None
+    b = buf[pos + 6:pos + 11]
+    return (b[0] << 25) | (b[1] << 17) | (b[2] << 9) | (b[3] << 1) | (b[4] >> 7)
+
+
+def packet_pts(buf, pos):
+    """PES 先頭パケットの PTS (90kHz)。無ければ None"""
+    if not (buf[pos + 1] & 0x40):  # payload_unit_start_indicator
+        return None
+    p = payload_offset(buf, pos)
+    if p is None or p + 14 > pos + TS_PACKET_SIZE:
+        return None
+    if buf[p] != 0 or buf[p + 1] != 0 or buf[p + 2] != 1:
+        return None
+    stream_id = buf[p + 3]
+    if not (0xC0 <= stream_id <= 0xEF):  # 音声・映像のみ
+        return None
+    if not (buf[p + 7] & 0x80):  # PTS_DTS_flags
+        return None
+    b = buf[p + 9:p + 14]
+    return (((b[0] >> 1) & 0x07) << 30) | (b[1] << 22) | ((b[2] >> 1) << 15) | \
+        (b[3] << 7) | (b[4] >> 1)
+
+
+def packet_tdt(buf, pos):
+    """TDT/TOT パケットの時刻 (unix epoch)。該当しなければ None"""
+    if packet_pid(buf, pos) != TDT_PID:
+        return None
+    p = payload_offset(buf, pos)
+    if p is None:
+        return None
+    if buf[pos + 1] & 0x40:  # PUSI → pointer_field
+        p += 1 + buf[p]
+    if p + 8 > pos + TS_PACKET_SIZE:
+        return None
+    if buf[p] not in (0x70, 0x73):  # TDT or TOT
+        return None
+    return arib_time(buf, p + 3)
+
+
+def _bcd(b):
+    return (b >> 4) * 10 + (b & 0x0F)
+
+
+def arib_time(buf, t):
+    """MJD (2 バイト) + 時分秒 BCD (3 バイト) → unix epoch (TDT/TOT・EIT の時刻)"""
+    mjd = (buf[t] << 8) | buf[t + 1]
+    # MJD → Unix days (MJD of Unix epoch = 40587)
+    unix_days = mjd - 40587
+    # ARIB 規格では JST (UTC+9) なので 9時間引く
+    return unix_days * 86400 + _bcd(buf[t + 2]) * 3600 + _bcd(buf[t + 3]) * 60 + \
+        _bcd(buf[t + 4]) - 9 * 3600
+
+
+def bcd_seconds(buf, t):
+    """時分秒 BCD (3 バイト) → 秒数 (EIT の duration)"""
+    return _bcd(buf[t]) * 3600 + _bcd(buf[t + 1]) * 60 + _bcd(buf[t + 2])
+
+
+# --- パケット単位の一括走査 ---
+
+SCAN_CHUNK_PACKETS = 8192  # 一度に調べるパケット数 (約 1.5MB)
+
+
+def iter_packets(buf, pid=None, start=0, end=None, reverse=False, pcr=False):
+    """[start, end) のパケット先頭位置を順に返す
+
+    pid を指定するとその PID だけ、pcr=True なら PCR を持つパケットだけに絞る。
+    reverse=True なら末尾から逆順。
+    バッファを 188 バイト刻みのパケットの列とみなし、sync・PID・adaptation field の
+    判定をチャンク単位でまとめて行う (NumPy があれば NumPy、無ければ
+    ストライドのスライスと bytes.translate)。同期が外れた箇所は探し直して続ける。
+    """
+    if end is None:
+        end = len(buf)
+    end = min(end, len(buf))
+    chunk = SCAN_CHUNK_PACKETS * TS_PACKET_SIZE
+    if not reverse:
+        pos = start
+        while True:
+            chunk_end = min(end, pos + chunk)
+            found, next_pos = _scan_chunk(buf, pos, chunk_end, pid, pcr)
+            yield from found
+            if chunk_end >= end or next_pos <= pos:
+                return
+            pos = next_pos
+    while end > start:
+        chunk_start = max(start, end - chunk)
+        found, _ = _scan_chunk(buf, chunk_start, end, pid, pcr)
+        yield from reversed(found)
+        # チャンクをまたぐパケットは次 (手前) のチャンクで拾う
+        first = _scan_first(buf, chunk_start, end)
+        end = first + TS_PACKET_SIZE - 1 if first > chunk_start else chunk_start
+
+
+def _scan_first(buf, start, end):
+    """[start, end) で最初に同期が取れた位置 (無ければ start)"""
+    pos = find_sync(buf, start, len(buf))
+    return pos if 0 <= pos < end else start
+
+
+def _scan_chunk(buf, start, end, pid, pcr):
+    """[start, end) に収まるパケットのうち条件に合うものの位置 → (位置のリスト, 次の走査開始位置)"""
+    found = []
+    pos = start
+    while pos + TS_PACKET_SIZE <= end:
+        synced = find_sync(buf, pos, len(buf))
+        if synced < 0 or synced >= pos + TS_PACKET_SIZE:
+            # 1 パケット分探しても見つからない: その先から探し直す
+            pos = pos + TS_PACKET_SIZE if synced < 0 else synced
+            continue
+        pos = synced
+        count = (end - pos) // TS_PACKET_SIZE
+        if count <= 0:
+            break
+        syncs = buf[pos:pos + count * TS_PACKET_SIZE:TS_PACKET_SIZE]
+        good = count - len(syncs.lstrip(b"\x47"))
+        if good:
+            found += _match_packets(buf, pos, good, pid, pcr)
+        pos += good * TS_PACKET_SIZE
+        if good == count:
+            break
+        pos += 1  # 同期外れ
+    return found, pos
+
+
+@functools.lru_cache(maxsize=None)
+def _byte_table(kind, value):
+    """bytes.translate 用の表 (条件を満たすバイトを 1、それ以外を 0 にする)"""
+    if kind == "pid_hi":
+        return bytes(int((v & 0x1F) == value) for v in range(256))
+    if kind == "eq":
+        return bytes(int(v == value) for v in range(256))
+    if kind == "ge":
+        return bytes(int(v >= value) for v in range(256))
+    return bytes(int(bool(v & value)) for v in range(256))  # "bit"
+
+
+def _match_packets(buf, pos, count, pid, pcr):
+    """pos から count 個の (同期済み) パケットのうち条件に合うものの位置"""
+    if pid is None and not pcr:
+        return list(range(pos, pos + count * TS_PACKET_SIZE, TS_PACKET_SIZE))
+    if numpy is not None:
+        return _match_packets_numpy(buf, pos, count, pid, pcr)
+
+    def column(offset, kind, value):
+        col = buf[pos + offset:pos + offset + count * TS_PACKET_SIZE:TS_PACKET_SIZE]
+        return int.from_bytes(col.translate(_byte_table(kind, value)), "big")
+
+    mask = -1
+    if pid is not None:
+        mask &= column(1, "pid_hi", pid >> 8) & column(2, "eq", pid & 0xFF)
+    if pcr:
+        # adaptation field あり、長さ 7 以上、PCR_flag
+        mask &= column(3, "bit", 0x20) & column(4, "ge", 7) & column(5, "bit", 0x10)
+    flags = mask.to_bytes(count, "big")
+    return list(itertools.compress(range(pos, pos + count * TS_PACKET_SIZE, TS_PACKET_SIZE), flags))
+
+
+def _match_packets_numpy(buf, pos, count, pid, pcr):
+    packets = numpy.frombuffer(buf, numpy.uint8, count * TS_PACKET_SIZE, pos)
+    packets = packets.reshape(count, TS_PACKET_SIZE)
+    mask = numpy.ones(count, dtype=bool)
+    if pid is not None:
+        mask &= ((packets[:, 1] & 0x1F) == (pid >> 8)) & (packets[:, 2] == (pid & 0xFF))
+    if pcr:
+        mask &= ((packets[:, 3] & 0x20) != 0) & (packets[:, 4] >= 7) & ((packets[:, 5] & 0x10) != 0)
+    result = (numpy.flatnonzero(mask) * TS_PACKET_SIZE + pos).tolist()
+    del packets  # mmap を閉じられるようにバッファの参照を外す
+    return result
+
+
+def _is_packet(buf, pos):
+    """pos がパケット先頭か (前後どちらかのパケットとも sync が揃っているか)"""
+    if pos < 0 or pos + TS_PACKET_SIZE > len(buf) or buf[pos] != 0x47:
+        return False
+    nxt = pos + TS_PACKET_SIZE
+    prev = pos - TS_PACKET_SIZE
+    return (nxt < len(buf) and buf[nxt] == 0x47) or (prev >= 0 and buf[prev] == 0x47)
+
+
+def _walk(buf, pos, step, limit):
+    """pos から step (±188) ずつパケット先頭位置を返す。limit バイト進んだら終わり
+
+    同期が外れたら進行方向に 1 バイトずつずらして探し直す。
+    """
+    stop = pos + limit if step > 0 else pos - limit
+    nudge = 1 if step > 0 else -1
+    while 0 <= pos <= len(buf) - TS_PACKET_SIZE and (pos < stop if step > 0 else pos > stop):
+        if _is_packet(buf, pos):
+            yield pos
+            pos += step
+        else:
+            pos += nudge
+
+
+def _find_clock(buf, pos, step, limit, pid=None):
+    """pos から step 方向に最初の PCR (pid 指定可) → (値, pid, 位置)。無ければ None"""
+    if step > 0:
+        packets = iter_packets(buf, pid, pos, pos + limit, pcr=True)
+    else:
+        packets = iter_packets(buf, pid, max(0, pos - limit), pos + TS_PACKET_SIZE,
+                               reverse=True, pcr=True)
+    for p in packets:
+        pcr = packet_pcr(buf, p)
+        if pcr is not None:
+            return pcr, packet_pid(buf, p), p
+    return None
+
+
+def _find_pts(buf, pos, step, limit):
+    for p in _walk(buf, pos, step, limit):
+        pts = packet_pts(buf, p)
+        if pts is not None:
+            return pts
+    return None
+
+
+def _find_tdt(buf, start, end, reverse=False):
+    """[start, end) の最初 (reverse なら最後) の TDT/TOT → (epoch, 位置) or None"""
+    for p in iter_packets(buf, TDT_PID, start, end, reverse=reverse):
+        epoch = packet_tdt(buf, p)
+        if epoch is not None:
+            return epoch, p
+    return None
+
+
+def _clock_diff(later, earlier):
+    return ((later - earlier) % CLOCK_WRAP) / CLOCK_HZ
+
+
+def _clock_delta(a, b):
+    """a - b (秒)。33 bit の折り返しを考慮し、少しだけ前なら負の値を返す"""
+    d = (a - b) % CLOCK_WRAP
+    if d >= CLOCK_WRAP // 2:
+        d -= CLOCK_WRAP
+    return d / CLOCK_HZ
+
+
+def _last_packet(buf):
+    """末尾の完全なパケットの先頭位置。見つからなければ -1"""
+    size = len(buf)
+    pos = size - TS_PACKET_SIZE
+    while pos >= max(0, size - TS_PACKET_SIZE * 8):
+        if buf[pos] == 0x47 and (pos < TS_PACKET_SIZE or buf[pos - TS_PACKET_SIZE] == 0x47):
+            return pos
+        pos -= 1
+    return -1
+
+
+def probe(file_path):
+    """再生時間と放送時刻を求める。TS として解析できなければ None
+
+    返り値: {"duration", "start_time", "end_time", "tdt_epoch", "tdt_offset"}
+    (時刻が取れなかった項目は None)
+    """
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < TS_PACKET_SIZE * 4:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _probe(mm, size)
+
+
+def _probe(mm, size):
+    first = find_sync(mm)
+    last = _last_packet(mm)
+    if first < 0 or last < 0:
+        return None
+
+    head_clock = _find_clock(mm, first, TS_PACKET_SIZE, PCR_SCAN_BYTES)
+    tail_clock = None
+    if head_clock is not None:
+        pcr_pid = head_clock[1]
+        tail_clock = _find_clock(mm, last, -TS_PACKET_SIZE, PCR_SCAN_BYTES, pcr_pid)
+    if head_clock is not None and tail_clock is not None:
+        first_clock, last_clock = head_clock[0], tail_clock[0]
+    else:
+        # PCR が無ければ PES の PTS で代用
+        pcr_pid = None
+        first_clock = _find_pts(mm, first, TS_PACKET_SIZE, PCR_SCAN_BYTES)
+        last_clock = _find_pts(mm, last, -TS_PACKET_SIZE, PCR_SCAN_BYTES)
+        if first_clock is None or last_clock is None:
+            return None
+    duration = _clock_diff(last_clock, first_clock)
+
+    result = {
+        "duration": duration, "start_time": None, "end_time": None,
+        "tdt_epoch": None, "tdt_offset": None,
+    }
+    head_tdt = _find_tdt(mm, first, min(size, TDT_SCAN_BYTES))
+    if head_tdt is not None:
+        epoch, pos = head_tdt
+        result["tdt_epoch"] = epoch
+        result["tdt_offset"] = pos - first
+        # TDT はファイル先頭ではなく数秒後にある。直前の PCR で位置を時間に換算
+        pcr = pcr_pid is not None and _find_clock(mm, pos, -TS_PACKET_SIZE, PCR_SCAN_BYTES, pcr_pid)
+        if pcr:
+            result["start_time"] = epoch - _clock_diff(pcr[0], first_clock)
+        else:
+            result["start_time"] = epoch - duration * (pos - first) / size
+    tail_tdt = _find_tdt(mm, max(first, size - TDT_SCAN_BYTES), size, reverse=True)
+    if tail_tdt is not None:
+        epoch, pos = tail_tdt
+        pcr = pcr_pid is not None and _find_clock(mm, pos, -TS_PACKET_SIZE, PCR_SCAN_BYTES, pcr_pid)
+        if pcr:
+            result["end_time"] = epoch + _clock_diff(last_clock, pcr[0])
+        else:
+            result["end_time"] = epoch + duration * (size - pos) / size
+    elif result["start_time"] is not None:
+        result["end_time"] = result["start_time"] + duration
+    return result
+
+
+def first_tdt(file_path, max_bytes=TDT_SCAN_BYTES):
+    """先頭から最初の TDT/TOT を探す → (unix_epoch, 最初のパケットからのバイト位置) or None"""
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < TS_PACKET_SIZE * 4:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            first = find_sync(mm)
+            if first < 0:
+                return None
+            found = _find_tdt(mm, first, min(size, max_bytes))
+            if found is None:
+                return None
+            return found[0], found[1] - first
+
+
+# --- シーク索引 ---
+
+_SEEK_MAGIC = b"ATSIDX1\n"
+_SEEK_HEADER = struct.Struct("<8sQqI")  # magic, 元ファイルのサイズ, mtime_ns, 件数
+_SEEK_ENTRY = struct.Struct("<ddQ")     # キーフレーム時刻, 読み始めたときの先頭時刻, バイト位置
+
+
+def seek_index_path(file_path):
+    return os.path.splitext(file_path)[0] + SEEK_INDEX_SUFFIX
+
+
+class SeekIndex:
+    """キーフレームの (時刻, バイト位置) の表
+
+    時刻はファイル先頭 (各ストリームの最初の PTS の最小値) からの秒数で、
+    ffmpeg の -ss と同じ基準。start はそのバイト位置から読ませたときに
+    ffmpeg が 0 秒とみなす時刻 (音声など他のストリームの PTS の方が早いことがある)。
+    """
+
+    def __init__(self, entries):
+        self.entries = entries  # [(key_time, start, offset), ...] (時刻順)
+        self._times = [e[0] for e in entries]
+        self._offsets = [e[2] for e in entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, seconds):
+        """seconds 以前で最後のキーフレーム → (バイト位置, 読み始めの時刻) or None"""
+        i = bisect.bisect_right(self._times, seconds) - 1
+        if i < 0:
+            return None
+        _key_time, start, offset = self.entries[i]
+        return offset, start
+
+    def time_at(self, offset):
+        """バイト位置に対応する時刻 (前後のキーフレームから線形補間)"""
+        if not self.entries:
+            return None
+        i = bisect.bisect_right(self._offsets, offset) - 1
+        if i < 0:
+            return self._times[0]
+        if i + 1 >= len(self.entries):
+            return self._times[i]
+        t0, t1 = self._times[i], self._times[i + 1]
+        o0, o1 = self._offsets[i], self._offsets[i + 1]
+        return t0 + (t1 - t0) * (offset - o0) / (o1 - o0)
+
+
+def load_seek_index(file_path):
+    """サイドカーの索引を読む。無い・元ファイルと (サイズ, mtime) が違えば None"""
+    try:
+        st = os.stat(file_path)
+        with open(seek_index_path(file_path), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if len(data) < _SEEK_HEADER.size:
+        return None
+    magic, size, mtime_ns, count = _SEEK_HEADER.unpack_from(data)
+    if (magic != _SEEK_MAGIC or size != st.st_size or mtime_ns != st.st_mtime_ns
+            or len(data) != _SEEK_HEADER.size + count * _SEEK_ENTRY.size):
+        return None
+    return SeekIndex(list(_SEEK_ENTRY.iter_unpack(data[_SEEK_HEADER.size:])))
+
+
+def build_seek_index(file_path):
+    """索引を作ってサイドカーに保存する。TS として解析できなければ None"""
+    st = os.stat(file_path)
+    with open(file_path, "rb") as f:
+        if st.st_size < TS_PACKET_SIZE * 4:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            entries = _build_entries(mm, st.st_size)
+    if not entries:
+        return None
+    data = _SEEK_HEADER.pack(_SEEK_MAGIC, st.st_size, st.st_mtime_ns, len(entries))
+    data += b"".join(_SEEK_ENTRY.pack(*e) for e in entries)
+    path = seek_index_path(file_path)
+    tmp_path = path + ".part"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return SeekIndex(entries)
+
+
+def _pes_stream_id(buf, pos):
+    """PES 先頭パケットの stream_id。PES の先頭でなければ None"""
+    if not (buf[pos + 1] & 0x40):
+        return None
+    p = payload_offset(buf, pos)
+    if p is None or p + 4 > pos + TS_PACKET_SIZE:
+        return None
+    if buf[p] != 0 or buf[p + 1] != 0 or buf[p + 2] != 1:
+        return None
+    return buf[p + 3]
+
+
+def _random_access(buf, pos):
+    """adaptation field の random_access_indicator (ARIB ではキーフレーム先頭)"""
+    afc = (buf[pos + 3] >> 4) & 0x03
+    return bool(afc & 0x02) and buf[pos + 4] > 0 and bool(buf[pos + 5] & 0x40)
+
+
+def _pusi_header(pid):
+    return bytes([0x47, 0x40 | (pid >> 8), pid & 0xFF])
+
+
+def _scan_streams(buf, first):
+    """先頭付近から映像・音声の PID を調べる → (映像 PID, RAI が使えるか, PES の PID 一覧)"""
+    video_pid = None
+    use_rai = False
+    pes_pids = []
+    for p in _walk(buf, first, TS_PACKET_SIZE, PCR_SCAN_BYTES):
+        stream_id = _pes_stream_id(buf, p)
+        if stream_id is None or not (0xC0 <= stream_id <= 0xEF):
+            continue
+        pid = packet_pid(buf, p)
+        if pid not in pes_pids:
+            pes_pids.append(pid)
+        if stream_id >= 0xE0:
+            if video_pid is None:
+                video_pid = pid
+            if pid == video_pid and _random_access(buf, p):
+                use_rai = True
+                if p - first >= PES_SCAN_BYTES:
+                    break
+    return video_pid, use_rai, pes_pids
+
+
+def _first_pes_pts(buf, pos, pes_pids):
+    """pos 以降の各ストリームの最初の PTS の最小値 (ffmpeg が 0 秒とみなす時刻)"""
+    end = min(len(buf), pos + PES_SCAN_BYTES)
+    result = None
+    for pid in pes_pids:
+        header = _pusi_header(pid)
+        i = pos
+        while True:
+            i = buf.find(header, i, end)
+            if i < 0:
+                break
+            if _is_packet(buf, i):
+                pts = packet_pts(buf, i)
+                if pts is not None:
+                    if result is None or _clock_delta(pts, result) < 0:
+                        result = pts
+                    break
+            i += 1
+    return result
+
+
+def _next_keyframe(buf, pos, end, video_pid, use_rai):
+    """pos 以降で最初のキーフレーム → (PTS, 位置) or None"""
+    header = _pusi_header(video_pid)
+    while True:
+        i = buf.find(header, pos, end)
+        if i < 0:
+            return None
+        if _is_packet(buf, i) and (not use_rai or _random_access(buf, i)):
+            pts = packet_pts(buf, i)
+            if pts is not None:
+                return pts, i
+        pos = i + 1
+
+
+def _build_entries(mm, size):
+    """ファイル全体を読まずに、平均ビットレートから数秒おきの位置へ飛んで
+    その直後のキーフレームを拾う"""
+    first = find_sync(mm)
+    if first < 0:
+        return None
+    meta = _probe(mm, size)
+    if meta is None or meta["duration"] <= 0:
+        return None
+    video_pid, use_rai, pes_pids = _scan_streams(mm, first)
+    if video_pid is None:
+        return None
+    zero = _first_pes_pts(mm, first, pes_pids)
+    if zero is None:
+        return None
+
+    step = max(TS_PACKET_SIZE, int(size / meta["duration"] * SEEK_INDEX_INTERVAL))
+    entries = []
+    pos = first
+    while pos < size:
+        found = _next_keyframe(mm, pos, size, video_pid, use_rai)
+        if found is None:
+            break
+        pts, offset = found
+        start = _first_pes_pts(mm, offset, pes_pids)
+        key_time = _clock_delta(pts, zero)
+        if not entries or key_time > entries[-1][0]:
+            entries.append((key_time, _clock_delta(start, zero), offset))
+        pos = max(offset + TS_PACKET_SIZE, pos + step)
+    return entries